@@ -1,219 +1,779 @@
 import streamlit as st
-import subprocess
-import json
 import tempfile
 import os
 import time
+import hashlib
+import hmac
+import ipaddress
+import threading
+import secrets
+import shutil
+import zipfile
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from typing import List, Optional
 
+from audio_engine import (
+    DEFAULT_QUALITY, LOUDNESS_TARGET_LUFS, LOUDNESS_TRUE_PEAK_DBTP, OUTPUT_FORMATS, SEAM_METHODS,
+    batch_worker_count, combine_hash, create_percentage_progress, ffmpeg_capabilities, format_duration,
+    get_audio_info, get_job_manager, get_output_cache, get_scheduler, job_trace, prefetch_source,
+    process_audio_ffmpeg, process_batch_ffmpeg, process_combine_extend_ffmpeg, process_combine_ffmpeg,
+    prometheus_text, record_rerun, record_stage, render_cache_key, render_seam_preview, stage,
+    supported_formats, validate_parameters,
+)
+
 st.set_page_config(
     page_title="🎵 Smart Audio Editor",
     page_icon="🎵",
     layout="wide"
 )
 
-def save_uploaded_file(uploaded_file):
-    """Save uploaded file to temp location"""
-    temp_path = f"temp_{int(time.time())}_{uploaded_file.name}"
-    with open(temp_path, 'wb') as f:
-        f.write(uploaded_file.getvalue())
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "audio_editor_uploads")
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Uploads are spilled, probed and handed to the PCM prefetch on these threads as they arrive
+UPLOAD_INGEST_THREADS = 4
+# Spills left by closed tabs, expired sessions and earlier server processes
+# are swept once unused this long; a session still holding one spills it again
+UPLOAD_TTL_SECONDS = int(os.environ.get("AUDIO_UPLOAD_TTL_SECONDS", str(6 * 60 * 60)))
+UPLOAD_SWEEP_SECONDS = 10 * 60
+
+def save_uploaded_file(uploaded_file, hasher=None):
+    """Save uploaded file to temp location in chunks, without copying the whole buffer.
+
+    Reads through a view of the upload's buffer rather than its file
+    position, so it is safe to run off the script thread.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    temp_path = os.path.join(UPLOAD_DIR, f"{secrets.token_hex(8)}_{os.path.basename(uploaded_file.name)}")
+    with uploaded_file.getbuffer() as data, open(temp_path, 'wb') as f:
+        for offset in range(0, len(data), UPLOAD_CHUNK_BYTES):
+            chunk = data[offset:offset + UPLOAD_CHUNK_BYTES]
+            if hasher:
+                hasher.update(chunk)
+            f.write(chunk)
     return temp_path
 
-def get_audio_info(audio_path):
-    """Get audio information using ffprobe"""
+def ingest_upload(uploaded_file):
+    """Spill, hash and probe an upload, then start decoding it into the PCM cache.
+
+    Runs on the upload executor as soon as a file arrives, so by the time
+    the user presses Process its duration is known and its decode is done
+    or under way.
+    """
+    hasher = hashlib.sha256()
+    started = time.perf_counter()
+    path = save_uploaded_file(uploaded_file, hasher)
+    entry = {
+        "path": path, "sha256": hasher.hexdigest(), "size": uploaded_file.size,
+        "spill_seconds": time.perf_counter() - started, "info": get_audio_info(path),
+    }
+    if entry["info"]:
+        prefetch_source(path, entry["sha256"])
+    return entry
+
+@st.cache_resource
+def get_upload_executor():
+    return ThreadPoolExecutor(max_workers=UPLOAD_INGEST_THREADS, thread_name_prefix="upload")
+
+def ingest_uploads(uploaded_files):
+    """Start ingesting every upload this session has not seen yet"""
+    spilled = st.session_state.setdefault("spilled_uploads", {})
+    for uploaded_file in uploaded_files or []:
+        future = spilled.get(uploaded_file.file_id)
+        if future is None or (future.done() and (future.exception() or not os.path.exists(future.result()["path"]))):
+            spilled[uploaded_file.file_id] = get_upload_executor().submit(ingest_upload, uploaded_file)
+
+def spill_upload(uploaded_file):
+    """Path, sha256 and probed info of an upload, waiting for its ingest if needed.
+
+    Reruns and repeated clicks reuse the same file, so the upload is written
+    and hashed exactly once.
+    """
+    ingest_uploads([uploaded_file])
+    entry = st.session_state["spilled_uploads"][uploaded_file.file_id].result()
     try:
-        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', audio_path]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            info = json.loads(result.stdout)
-            duration = float(info['format']['duration'])
-            return {"duration": duration, "format": info['format']['format_name']}
-        return None
-    except:
+        # Marks it used, so the sweeper keeps it for the job about to start
+        os.utime(entry["path"])
+    except FileNotFoundError:
+        pass
+    return entry
+
+def ingested_upload(uploaded_file):
+    """The upload's entry if its ingest has finished, else None; never waits"""
+    future = st.session_state.get("spilled_uploads", {}).get(uploaded_file.file_id)
+    if future is None or not future.done() or future.exception():
         return None
+    return future.result()
+
+def validate_uploads(mode, uploads, file_names, target_duration_ms, crossfade_duration):
+    """validate_parameters against the probed durations of ingested uploads"""
+    for upload, name in zip(uploads, file_names):
+        if not upload["info"]:
+            return False, f"Could not read audio from {name}"
+    durations_ms = [int(upload["info"]["duration"] * 1000) for upload in uploads]
+    if mode == "batch_extend":
+        for duration_ms, name in zip(durations_ms, file_names):
+            valid, message = validate_parameters("extend", target_duration_ms, duration_ms, crossfade_duration, 1)
+            if not valid:
+                return False, f"{name}: {message}"
+        return True, "Ready to process"
+    if mode == "extend":
+        original_ms = durations_ms[0]
+    else:
+        original_ms = sum(durations_ms) - int(crossfade_duration * 1000) * (len(durations_ms) - 1)
+    valid, message = validate_parameters(mode, target_duration_ms, original_ms, crossfade_duration, len(uploads))
+    return valid, "Ready to process" if valid else message
+
+def forget_stale_uploads(uploaded_files, keep=()):
+    """Delete spilled copies of uploads that were removed from the uploader, except ``keep`` paths"""
+    spilled = st.session_state.get("spilled_uploads", {})
+    current = {uploaded_file.file_id for uploaded_file in uploaded_files or []}
+    for file_id in [f for f in spilled if f not in current]:
+        future = spilled[file_id]
+        if future.done() and not future.exception() and future.result()["path"] in keep:
+            continue
+        del spilled[file_id]
+
+        def remove(done):
+            if not done.exception() and os.path.exists(done.result()["path"]):
+                os.unlink(done.result()["path"])
+
+        # A spill still being written is removed once it finishes
+        future.add_done_callback(remove)
+
+def sweep_uploads(now=None):
+    """Remove spilled uploads unused for UPLOAD_TTL_SECONDS; returns how many were removed"""
+    now = now or time.time()
+    try:
+        entries = list(os.scandir(UPLOAD_DIR))
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False) and now - entry.stat(follow_symlinks=False).st_mtime > UPLOAD_TTL_SECONDS:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+@st.cache_resource
+def start_upload_sweeper():
+    """Sweep UPLOAD_DIR now and every UPLOAD_SWEEP_SECONDS, once per process"""
+    def sweep_forever():
+        while True:
+            try:
+                sweep_uploads()
+            except OSError:
+                pass
+            time.sleep(UPLOAD_SWEEP_SECONDS)
 
-def process_audio_ffmpeg(input_path, output_path, target_minutes, crossfade_duration, method="basic_crossfade", progress_callback=None):
-    """Process audio using FFmpeg with Streamlit Cloud compatibility"""
-
-    target_duration = target_minutes * 60
-
-    # Get audio info
-    info = get_audio_info(input_path)
-    if not info:
-        return False, "Could not analyze audio file"
-
-    original_duration = info['duration']
-
-    if progress_callback:
-        progress_callback(10, "🔍 Analyzing audio...")
-
-    # Detect environment and use appropriate method
-    concat_file = None
-    if is_streamlit_cloud():
-        # Streamlit Cloud compatible method - use concat demuxer approach
-        loops_needed = int(target_duration / original_duration) + 1
+    sweeper = threading.Thread(target=sweep_forever, name="upload-sweeper", daemon=True)
+    sweeper.start()
+    return sweeper
 
-        if progress_callback:
-            progress_callback(30, f"🌐 Streamlit Cloud mode: concat method ({loops_needed} loops)...")
+def is_streamlit_cloud():
+    """Detect if running on Streamlit Cloud"""
+    return os.environ.get('STREAMLIT_SHARING', False) or 'streamlit.io' in os.environ.get('HOSTNAME', '')
 
-        # Create a file list for concat demuxer (more reliable than stream_loop)
-        concat_file = f"temp_concat_{int(time.time())}.txt"
+# Large results are streamed from disk by a small side server instead of
+# passing through Streamlit's in-memory media storage. It listens on loopback
+# unless told otherwise; port 0 picks a free one, so it never takes the port
+# a second Streamlit process falls back to
+DOWNLOAD_HOST = os.environ.get("AUDIO_DOWNLOAD_HOST", "127.0.0.1")
+DOWNLOAD_PORT = int(os.environ.get("AUDIO_DOWNLOAD_PORT", "0"))
+DOWNLOAD_BASE_URL = os.environ.get("AUDIO_DOWNLOAD_BASE_URL", "")
+DOWNLOAD_TTL_SECONDS = 6 * 60 * 60
+# /metrics exposes job names and timings: with a token set every scrape must
+# send "Authorization: Bearer <token>", otherwise only loopback clients that
+# did not come through a reverse proxy may scrape
+METRICS_TOKEN = os.environ.get("AUDIO_METRICS_TOKEN", "")
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+class DownloadServer:
+    """Serve registered files, and zip archives built on the fly, from disk in chunks"""
+
+    def __init__(self, host, port):
+        self.entries = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.loopback = host in ("127.0.0.1", "localhost", "::1")
+        threading.Thread(target=self.httpd.serve_forever, name="download-server", daemon=True).start()
+
+    def register_file(self, path, filename, mime, inline=False):
+        """Expose one file for download (or inline playback) and return its URL path"""
+        return self._register({"kind": "file", "path": path, "filename": filename, "mime": mime, "inline": inline})
+
+    def register_zip(self, members, filename):
+        """Expose (path, name) members as one zip streamed at request time"""
+        return self._register({"kind": "zip", "members": members, "filename": filename, "mime": "application/zip"})
+
+    def _register(self, entry):
+        # Every rerun that shows a result registers it again; keep its URL
+        # so players and links stay valid
+        signature = repr(sorted(entry.items()))
+        entry["created"] = time.time()
+        with self.lock:
+            self._expire()
+            token = self.tokens.get(signature)
+            if token not in self.entries:
+                token = self.tokens[signature] = secrets.token_urlsafe(16)
+            self.entries[token] = entry
+        return f"/{token}/{quote(entry['filename'])}"
+
+    def _expire(self):
+        cutoff = time.time() - DOWNLOAD_TTL_SECONDS
+        for token in [t for t, e in self.entries.items() if e["created"] < cutoff]:
+            del self.entries[token]
+        for signature in [s for s, t in self.tokens.items() if t not in self.entries]:
+            del self.tokens[signature]
+
+    def handle(self, request):
+        if request.path == "/metrics":
+            if self._metrics_allowed(request):
+                self._send_metrics(request)
+            else:
+                request.send_error(403, "Metrics not available to this client")
+            return
+        token = request.path.lstrip('/').split('/', 1)[0]
+        with self.lock:
+            entry = self.entries.get(token)
+        if not entry:
+            request.send_error(404, "Download expired")
+            return
+
+        paths = [entry["path"]] if entry["kind"] == "file" else [path for path, _ in entry["members"]]
+        if not all(os.path.exists(path) for path in paths):
+            request.send_error(404, "File no longer available")
+            return
+
+        disposition = "inline" if entry.get("inline") else "attachment"
         try:
-            with open(concat_file, 'w') as f:
-                for i in range(loops_needed):
-                    f.write(f"file '{input_path}'\n")
-
-            fade_start = target_duration - 3
-            cmd = [
-                'ffmpeg', '-f', 'concat', '-safe', '0', '-i', concat_file,
-                '-af', f'afade=t=out:st={fade_start}:d=3',
-                '-t', str(target_duration),
-                '-c:a', 'libmp3lame', '-b:a', '192k',
-                '-y', output_path
-            ]
-        except Exception as e:
-            return False, f"Failed to create concat file: {str(e)}"
-    else:
-        # Local development - use advanced crossfade
-        loops_needed = max(2, int(target_duration / original_duration) + 1)
-
-        if progress_callback:
-            progress_callback(30, f"💻 Local mode: Advanced crossfade (loops: {loops_needed})...")
-
-        if loops_needed <= 5:
-            # Build inputs for crossfade
-            inputs = []
-            for i in range(loops_needed):
-                inputs.extend(['-i', input_path])
-
-            # Build crossfade filter
-            if loops_needed == 2:
-                filter_complex = f"[0:a][1:a]acrossfade=d={crossfade_duration}[out]"
-            elif loops_needed == 3:
-                filter_complex = f"[0:a][1:a]acrossfade=d={crossfade_duration}[af1];[af1][2:a]acrossfade=d={crossfade_duration}[out]"
-            elif loops_needed == 4:
-                filter_complex = f"[0:a][1:a]acrossfade=d={crossfade_duration}[af1];[af1][2:a]acrossfade=d={crossfade_duration}[af2];[af2][3:a]acrossfade=d={crossfade_duration}[out]"
-            elif loops_needed == 5:
-                filter_complex = f"[0:a][1:a]acrossfade=d={crossfade_duration}[af1];[af1][2:a]acrossfade=d={crossfade_duration}[af2];[af2][3:a]acrossfade=d={crossfade_duration}[af3];[af3][4:a]acrossfade=d={crossfade_duration}[out]"
-
-            # Add fade out
-            fade_start = target_duration - 3
-            filter_with_fadeout = f"{filter_complex};[out]afade=t=out:st={fade_start}:d=3[final]"
-
-            cmd = ['ffmpeg'] + inputs + [
-                '-filter_complex', filter_with_fadeout,
-                '-map', '[final]',
-                '-t', str(target_duration),
-                '-c:a', 'mp3', '-b:a', '320k',
-                '-y', output_path
-            ]
+            if entry["kind"] == "file":
+                self._send_file(request, entry, disposition)
+            else:
+                request.send_response(200)
+                request.send_header("Content-Type", entry["mime"])
+                request.send_header("Content-Disposition", f"{disposition}; filename*=UTF-8''{quote(entry['filename'])}")
+                # Length is unknown up front; the archive is written straight
+                # to the socket (zipfile handles unseekable streams)
+                request.send_header("Connection", "close")
+                request.end_headers()
+                request.close_connection = True
+                with zipfile.ZipFile(request.wfile, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+                    for path, name in entry["members"]:
+                        info = zipfile.ZipInfo.from_file(path, name)
+                        with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as dst:
+                            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_BYTES)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client went away mid-download
+
+    def _metrics_allowed(self, request):
+        if METRICS_TOKEN:
+            return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+        # Proxied requests arrive from loopback too
+        return not DOWNLOAD_BASE_URL and ipaddress.ip_address(request.client_address[0]).is_loopback
+
+    def _send_metrics(self, request):
+        """Job metrics of this process for Prometheus to scrape"""
+        body = prometheus_text().encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "text/plain; version=0.0.4")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _send_file(self, request, entry, disposition):
+        """Send a file, honouring single byte ranges so audio players can seek"""
+        size = os.path.getsize(entry["path"])
+        start, end = 0, size - 1
+        byte_range = request.headers.get("Range", "")
+        if byte_range.startswith("bytes=") and ',' not in byte_range:
+            first, _, last = byte_range[6:].partition('-')
+            try:
+                if first:
+                    start = int(first)
+                    end = min(int(last), size - 1) if last else size - 1
+                else:
+                    start = max(size - int(last), 0)
+            except ValueError:
+                start, end = 0, size - 1
+            if start >= size or start > end:
+                request.send_response(416)
+                request.send_header("Content-Range", f"bytes */{size}")
+                request.end_headers()
+                return
+            request.send_response(206)
+            request.send_header("Content-Range", f"bytes {start}-{end}/{size}")
         else:
-            # Fallback to simple method for many loops
-            fade_start = target_duration - 3
-            cmd = [
-                'ffmpeg', '-stream_loop', '-1', '-i', input_path,
-                '-af', f'afade=t=out:st={fade_start}:d=3',
-                '-t', str(target_duration),
-                '-c:a', 'mp3', '-b:a', '320k',
-                '-y', output_path
-            ]
-
-    if progress_callback:
-        progress_callback(50, f"⚡ Running FFmpeg...")
-
-    # Execute FFmpeg command
+            request.send_response(200)
+
+        request.send_header("Content-Type", entry["mime"])
+        request.send_header("Content-Disposition", f"{disposition}; filename*=UTF-8''{quote(entry['filename'])}")
+        request.send_header("Accept-Ranges", "bytes")
+        request.send_header("Content-Length", str(end - start + 1))
+        request.end_headers()
+
+        remaining = end - start + 1
+        with open(entry["path"], 'rb') as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(DOWNLOAD_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                request.wfile.write(chunk)
+                remaining -= len(chunk)
+
+@st.cache_resource
+def get_download_server():
+    """Start the download side server once per process; None if it cannot bind"""
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)  # 5 min timeout
+        return DownloadServer(DOWNLOAD_HOST, DOWNLOAD_PORT)
+    except OSError:
+        return None
 
-        if progress_callback:
-            progress_callback(90, "✅ Finalizing...")
+def browser_host():
+    """Host name the browser reached this app by"""
+    context = getattr(st, "context", None)
+    if context is not None and context.headers.get("Host"):
+        return context.headers["Host"].rsplit(':', 1)[0]
+    return "localhost"
 
-        if result.returncode == 0 and os.path.exists(output_path):
-            method_used = "Streamlit Concat Method" if is_streamlit_cloud() else f"Local Crossfade (d={crossfade_duration})"
-            return True, f"Success! {method_used}"
-        else:
-            return False, f"FFmpeg error: {result.stderr[:200] if result.stderr else 'Unknown error'}"
+def session_download_server():
+    """The download server if this session's browser can reach it, else None.
 
-    except subprocess.TimeoutExpired:
-        return False, "Processing timeout - try shorter duration"
-    except Exception as e:
-        return False, f"Processing error: {str(e)}"
+    Without it (Streamlit Cloud, port unavailable, or a remote browser and a
+    loopback-only server) results fall back to Streamlit's in-memory media.
+    """
+    if is_streamlit_cloud():
+        return None
+    server = get_download_server()
+    if server is None:
+        return None
+    if DOWNLOAD_BASE_URL or not server.loopback or browser_host() in ("localhost", "127.0.0.1", "[::1]"):
+        return server
+    return None
+
+def download_url(server, url_path):
+    """Absolute URL for a download path, as reachable from the browser"""
+    if DOWNLOAD_BASE_URL:
+        return DOWNLOAD_BASE_URL.rstrip('/') + url_path
+    return f"http://{browser_host()}:{server.port}{url_path}"
+
+def render_cached_outputs(source_hash, target_minutes, crossfade_duration, audio_method, normalize, formats, render, on_progress, job_kind, output_seconds, cancel_event=None):
+    """Serve each (format, quality) from the output cache and render the missing ones together.
+
+    ``render(output_path, output_format, quality, extra_outputs)`` renders
+    the first missing format plus the others as extra outputs in a single
+    pass and returns (success, message). The render waits for a slot of
+    the process-wide scheduler, reporting its queue position meanwhile.
+    Returns the cached paths in ``formats`` order.
+    """
+    cache = get_output_cache()
+    keys = [
+        render_cache_key(source_hash, target_minutes, crossfade_duration, audio_method, fmt, fmt_quality, normalize)
+        for fmt, fmt_quality in formats
+    ]
+    with stage("cache_lookup", formats=len(formats)):
+        result_paths = [cache.get(key, fmt) for key, (fmt, _) in zip(keys, formats)]
+    missing = [i for i, path in enumerate(result_paths) if not path]
+    if not missing:
+        on_progress(90, "⚡ Served from cache")
+        return result_paths
+
+    def on_wait(position, eta):
+        on_progress(0, f"⏳ Queued: position {position}, starts in about {format_duration(eta)}")
+
+    render_paths = {i: cache.reserve(keys[i], formats[i][0]) for i in missing}
+    first, *rest = missing
+    try:
+        with get_scheduler().slot(job_kind, output_seconds, len(missing), cancel_event=cancel_event, on_wait=on_wait):
+            on_progress(0, "Starting processing...")
+            success, message = render(
+                render_paths[first], formats[first][0], formats[first][1],
+                [(render_paths[i], *formats[i]) for i in rest]
+            )
+        if success:
+            with stage("cache_commit", bytes=sum(os.path.getsize(path) for path in render_paths.values())):
+                for i in missing:
+                    result_paths[i] = cache.commit(keys[i], formats[i][0], render_paths[i])
     finally:
-        # Clean up concat file if it exists
-        if concat_file and os.path.exists(concat_file):
-            try:
-                os.unlink(concat_file)
-            except:
-                pass  # Ignore cleanup errors
+        # Cleanup the partial renders; spilled uploads are kept for reruns
+        for render_path in render_paths.values():
+            if os.path.exists(render_path):
+                os.unlink(render_path)
+
+    if not success:
+        raise Exception(message)
+    return result_paths
+
+def render_job(job):
+    """Background work of an extend, combine or combine-extend job; returns the output path per format"""
+    info = job.info
+    paths = [upload["path"] for upload in info["uploads"]]
+    source_hashes = [upload["sha256"] for upload in info["uploads"]]
+    target_minutes = info["target_minutes"]
+    crossfade_duration, audio_method, normalize = info["crossfade"], info["method"], info["normalize"]
+    mode = info["mode"]
 
-def create_percentage_progress(current, total, message):
-    """Create percentage-based progress display"""
-    percentage = int((current / total) * 100) if total > 0 else 0
-    return f"{percentage}% - {message}"
+    if mode == "extend":
+        source_hash, output_seconds = source_hashes[0], target_minutes * 60
 
-# Old pydub function removed - now using FFmpeg
+        def render(output_path, fmt, fmt_quality, extra_outputs):
+            return process_audio_ffmpeg(
+                paths[0], output_path, target_minutes, crossfade_duration, audio_method,
+                job.update, job.cancel_event, source_hashes[0], fmt, fmt_quality, extra_outputs, normalize
+            )
 
-# Old pydub function removed - now using FFmpeg
+    elif mode == "combine":
+        source_hash, output_seconds = combine_hash(source_hashes, crossfade_duration, audio_method), info["estimated_seconds"]
+        target_minutes = None
 
-# Old pydub function removed - FFmpeg handles export directly
+        def render(output_path, fmt, fmt_quality, extra_outputs):
+            return process_combine_ffmpeg(
+                paths, output_path, crossfade_duration, audio_method, job.update, job.cancel_event,
+                source_hashes, fmt, fmt_quality, extra_outputs, normalize
+            )
 
-def format_duration(seconds):
-    """Format duration in seconds to readable format"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+    else:
+        source_hash, output_seconds = combine_hash(source_hashes, crossfade_duration, audio_method), target_minutes * 60
+
+        def render(output_path, fmt, fmt_quality, extra_outputs):
+            return process_combine_extend_ffmpeg(
+                paths, output_path, target_minutes, crossfade_duration, audio_method, job.update,
+                job.cancel_event, source_hashes, fmt, fmt_quality, extra_outputs, normalize
+            )
+
+    with job_trace(mode, session_job=job.id):
+        # Uploads were spilled by the script before the job started
+        record_stage(
+            "spill", sum(upload.get("spill_seconds", 0) for upload in info["uploads"]),
+            bytes_in=sum(upload["size"] for upload in info["uploads"])
+        )
+        result_paths = render_cached_outputs(
+            source_hash, target_minutes, crossfade_duration, audio_method, normalize, info["formats"],
+            render, job.update, mode, output_seconds, job.cancel_event
+        )
+    job.update(100, "✅ Processing complete!")
+    return result_paths
+
+def batch_job(job):
+    """Background work of a batch extend; returns (output_path, name, error) per upload"""
+    info = job.info
+    output_format, quality = info["formats"][0]
+    cache = get_output_cache()
+    files = job.detail["files"] = [(0, "⏳ Queued")] * len(info["uploads"])
+    outputs = []
+    jobs = []
+    pending = []
+    for i, upload in enumerate(info["uploads"]):
+        key = render_cache_key(
+            upload["sha256"], info["target_minutes"], info["crossfade"], info["method"], output_format, quality, info["normalize"]
+        )
+        cached = cache.get(key, output_format)
+        outputs.append(cached)
+        if cached:
+            files[i] = (100, "⚡ Cached")
+            continue
+        jobs.append((upload["path"], cache.reserve(key, output_format), upload["sha256"]))
+        pending.append((i, key))
+    job.update(0, f"⚙️ {len(jobs)} files to render on {batch_worker_count(len(jobs))} parallel workers, {len(outputs) - len(jobs)} from cache")
+
+    def on_progress(job_index, percent, message):
+        files[pending[job_index][0]] = (percent, message)
+        job.percent = sum(percent for percent, _ in files) // len(files)
+
+    results = process_batch_ffmpeg(
+        jobs, info["target_minutes"], info["crossfade"], info["method"], on_progress, job.cancel_event,
+        output_format=output_format, quality=quality, normalize=info["normalize"], scheduler=get_scheduler()
+    )
 
-def check_ffmpeg():
-    """Check if FFmpeg is available and get version info"""
+    errors = {}
+    for (index, key), (_, tmp_path, _), (success, message) in zip(pending, jobs, results):
+        if success:
+            outputs[index] = cache.commit(key, output_format, tmp_path)
+            files[index] = (100, "✅ Done")
+        else:
+            errors[index] = message
+            files[index] = (0, f"❌ {message}")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return [(output, name, errors.get(index)) for index, (output, name) in enumerate(zip(outputs, info["output_names"]))]
+
+def preview_job(job):
+    """Background work of a seam preview; returns the seam and ending MP3 paths"""
+    info = job.info
+    # Waits here, off the script thread, if the upload is still being spilled
+    upload = info["upload"].result()
+    cache = get_output_cache()
+    keys = [
+        render_cache_key(
+            upload["sha256"], info["target_minutes"], info["crossfade"], info["method"], info["format"],
+            f"{part}-preview", info["normalize"]
+        )
+        for part in ("seam", "ending")
+    ]
+    paths = [cache.get(key, "mp3") for key in keys]
+    if all(paths):
+        return paths
+    render_paths = [cache.reserve(key, "mp3") for key in keys]
     try:
-        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=10)
-        if result.returncode == 0:
-            # Extract version for debugging
-            version_line = result.stdout.split('\n')[0] if result.stdout else "Unknown version"
-            return True, version_line
-        return False, "FFmpeg not working"
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        return False, "FFmpeg not found"
-
-def is_streamlit_cloud():
-    """Detect if running on Streamlit Cloud"""
-    return os.environ.get('STREAMLIT_SHARING', False) or 'streamlit.io' in os.environ.get('HOSTNAME', '')
-
-def validate_parameters(mode: str, target_duration_ms: int, original_duration_ms: int, crossfade_duration: float, num_files: int) -> tuple[bool, str]:
-    """Validate processing parameters based on mode"""
+        success, message = render_seam_preview(
+            upload["path"], *render_paths, info["target_minutes"], info["crossfade"], info["method"],
+            upload["sha256"], info["format"], info["normalize"], job.cancel_event
+        )
+        if not success:
+            raise Exception(message)
+        return [cache.commit(key, "mp3", path) for key, path in zip(keys, render_paths)]
+    finally:
+        for render_path in render_paths:
+            if os.path.exists(render_path):
+                os.unlink(render_path)
+
+def show_result_file(output_path, download_filename, mime, create_preview):
+    """Preview and download a result straight from disk"""
+    server = session_download_server()
+    size_mb = os.path.getsize(output_path) / (1024*1024)
+
+    if server:
+        if create_preview:
+            st.markdown("#### 🎧 Result Preview")
+            st.audio(download_url(server, server.register_file(output_path, download_filename, mime, inline=True)))
+            st.caption("Preview: FFmpeg processed with 3s fade out")
+        st.link_button(
+            f"📥 Download Result ({size_mb:.1f} MB)",
+            download_url(server, server.register_file(output_path, download_filename, mime)),
+            type="primary", help=f"Download: {download_filename}"
+        )
+        return
+
+    # No reachable download server (e.g. Streamlit Cloud exposes a single port), so fall back to in-memory media
+    with open(output_path, 'rb') as f:
+        audio_bytes = f.read()
+    if create_preview:
+        st.markdown("#### 🎧 Result Preview")
+        st.audio(audio_bytes, format=mime)
+        st.caption("Preview: FFmpeg processed with 3s fade out")
+    st.download_button(
+        label=f"📥 Download Result ({size_mb:.1f} MB)",
+        data=audio_bytes,
+        file_name=download_filename,
+        mime=mime,
+        help=f"Download: {download_filename}"
+    )
 
-    if crossfade_duration < 0:
-        return False, "Crossfade duration cannot be negative"
+def show_batch_result(job):
+    """Per-file status and downloads of a finished batch extend"""
+    mime = OUTPUT_FORMATS[job.info["formats"][0][0]]['mime']
+    server = session_download_server()
+    finished = []
+    for upload_name, (output_path, name, error) in zip(job.info["file_names"], job.result):
+        if not error and not os.path.exists(output_path):
+            error = "Evicted from the output cache; process again"
+        if error:
+            st.progress(0, text=f"{upload_name}: ❌ {error}")
+            continue
+        st.progress(100, text=f"{upload_name}: ✅ Done")
+        finished.append((output_path, name))
+
+    st.success(f"🎉 {len(finished)} of {len(job.result)} files extended")
+    for output_path, name in finished:
+        size_mb = os.path.getsize(output_path) / (1024*1024)
+        if server:
+            st.link_button(f"📥 {name} ({size_mb:.1f} MB)", download_url(server, server.register_file(output_path, name, mime)))
+        else:
+            # No reachable download server, so fall back to in-memory downloads
+            with open(output_path, 'rb') as f:
+                st.download_button(f"📥 {name} ({size_mb:.1f} MB)", f.read(), file_name=name, mime=mime)
+
+    if server and len(finished) > 1:
+        st.link_button(
+            f"🗜️ Download all ({len(finished)} files, zip)",
+            download_url(server, server.register_zip(finished, "extended_audio.zip")),
+            type="primary"
+        )
 
-    if mode == "extend":
-        if target_duration_ms <= 0:
-            return False, "Target duration must be greater than 0"
-        if target_duration_ms > 24 * 60 * 60 * 1000:  # 24 hours
-            return False, "Target duration cannot exceed 24 hours"
-        loops_needed = target_duration_ms / original_duration_ms
-        if loops_needed > 1000:
-            return False, f"Too many loops required ({loops_needed:.0f}x). Consider a shorter target duration."
+def show_render_result(job):
+    """Metrics, preview and downloads of a finished extend/combine job"""
+    info = job.info
+    result_paths = job.result
+    output_path = result_paths[0]
+    output_format, quality = info["formats"][0]
 
-    elif mode == "combine":
-        if num_files < 2:
-            return False, "Need at least 2 files to combine"
+    st.success("🎉 Audio processing completed successfully!")
 
-    elif mode == "combine_extend":
-        if num_files < 2:
-            return False, "Need at least 2 files to combine and extend"
-        if target_duration_ms <= 0:
-            return False, "Target duration must be greater than 0"
+    # Results metrics
+    result_col1, result_col2, result_col3 = st.columns(3)
+    with result_col1:
+        if info["mode"] == "combine":
+            st.metric("Tracks", len(info["uploads"]))
+        else:
+            st.metric("Final Duration", f"{info['target_minutes']} minutes")
+    with result_col2:
+        st.metric("File Size", f"{os.path.getsize(output_path) / (1024*1024):.1f} MB")
+    with result_col3:
+        st.metric("Method", "FFmpeg + Fade Out")
+
+    # Preview and download are served from disk, never held in memory
+    download_base = info["download_base"]
+    show_result_file(
+        output_path, f"{download_base}.{output_format}", OUTPUT_FORMATS[output_format]['mime'], info["create_preview"]
+    )
+    for (fmt, _), path in zip(info["formats"][1:], result_paths[1:]):
+        st.markdown(f"#### 📁 {fmt.upper()}")
+        show_result_file(path, f"{download_base}.{fmt}", OUTPUT_FORMATS[fmt]['mime'], False)
+
+    # Processing statistics
+    with st.expander("📊 Processing Statistics", expanded=False):
+        st.write(f"**Processing Mode:** {info['mode_label']}")
+        st.write(f"**Audio Method:** {info['method_label']}")
+        st.write(f"**Input Files:** {len(info['uploads'])}")
+        if info["mode"] != "combine":
+            st.write(f"**Target Duration:** {info['target_minutes']} minutes")
+            st.write(f"**FFmpeg Seam:** {SEAM_METHODS[info['method']]['filters']}, d={info['crossfade']}s")
+            st.write(f"**Fade Out:** 3 seconds")
+        st.write(f"**Crossfade Used:** {info['crossfade']}s")
+        st.write(f"**Final Quality:** {quality}")
+        st.write(f"**Processing Time:** {format_duration(job.finished - job.created)}")
+        cache_stats = get_output_cache().stats()
+        st.write(
+            f"**Output Cache:** {cache_stats['hits']} hits / {cache_stats['misses']} misses, "
+            f"{cache_stats['entries']} entries, {cache_stats['bytes'] / (1024**3):.2f} of "
+            f"{cache_stats['max_bytes'] / (1024**3):.0f} GB"
+        )
 
-    return True, "Parameters valid"
+# The job ID lives in session state and in the URL, so a refresh or a
+# reconnect (which starts a new session) still finds the job
+JOB_POLL_SECONDS = 1.0
+
+def active_job():
+    """This session's background job, if it still exists"""
+    job_id = st.session_state.get("job_id") or st.query_params.get("job")
+    job = get_job_manager().get(job_id) if job_id else None
+    if job is None and job_id:
+        forget_job()
+    elif job is not None:
+        st.session_state["job_id"] = job.id
+    return job
+
+def forget_job():
+    st.session_state.pop("job_id", None)
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+def submit_job(work, key, info):
+    """Start a background job and remember it for this session and URL"""
+    job = get_job_manager().submit(work, key, info)
+    st.session_state["job_id"] = job.id
+    st.query_params["job"] = job.id
+    return job
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(job_id):
+    """Live progress of a running job; reruns only this fragment until the job ends"""
+    job = get_job_manager().get(job_id)
+    if job is None or job.done:
+        st.rerun()
+    if job.info["mode"] == "batch_extend":
+        st.caption(job.message)
+        for name, (percent, message) in zip(job.info["file_names"], job.detail.get("files", [])):
+            st.progress(percent, text=f"{name}: {create_percentage_progress(percent, 100, message)}")
+    else:
+        st.progress(job.percent, text=create_percentage_progress(job.percent, 100, job.message))
+    # Cancelling stops FFmpeg through the job's event; a plain rerun no longer does
+    st.button("⏹️ Cancel", key=f"cancel_{job.id}", on_click=job.cancel)
+
+def show_seam_preview(uploaded_file, target_minutes, crossfade_duration, audio_method, output_format, normalize):
+    """Play the first loop seam and the ending of an extend job before rendering it in full.
+
+    The preview renders as a background job, so no rerun waits for it: a
+    settings change starts the preview for the new settings (cancelling the
+    previous one) and a fragment polls it until the clips are ready.
+    """
+    ingest_uploads([uploaded_file])
+    key = ("preview", uploaded_file.file_id, target_minutes, crossfade_duration, audio_method, output_format, normalize)
+    manager = get_job_manager()
+    job = manager.get(st.session_state.get("preview_job_id"))
+    if job is None or job.key != key or (job.state == "done" and not all(os.path.exists(path) for path in job.result)):
+        if job is not None and not job.done:
+            job.cancel()
+        info = {
+            "upload": st.session_state["spilled_uploads"][uploaded_file.file_id], "target_minutes": target_minutes,
+            "crossfade": crossfade_duration, "method": audio_method, "format": output_format, "normalize": normalize,
+        }
+        job = manager.submit(preview_job, key, info)
+        st.session_state["preview_job_id"] = job.id
+
+    if not job.done:
+        preview_progress(job.id)
+        return
+    if job.state == "failed":
+        st.warning(f"⚠️ Preview unavailable: {job.error}")
+    if job.state != "done":
+        return
+    paths = job.result
+
+    # A few seconds each, so they are sent inline rather than through the download server
+    seam_col, ending_col = st.columns(2)
+    with seam_col:
+        st.caption("🔁 First loop seam")
+        with open(paths[0], 'rb') as f:
+            st.audio(f.read(), format="audio/mpeg")
+    with ending_col:
+        st.caption("🔚 Ending with fade out")
+        with open(paths[1], 'rb') as f:
+            st.audio(f.read(), format="audio/mpeg")
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def preview_progress(job_id):
+    """Placeholder while a preview job runs; reruns the page once the clips are ready"""
+    job = get_job_manager().get(job_id)
+    if job is None or job.done:
+        st.rerun()
+    st.caption("🎧 Rendering seam preview...")
+
+def show_job(job):
+    """Progress of a background job, or its result once it has finished"""
+    st.markdown("### 🧾 Current Job")
+    if not job.done:
+        job_progress(job.id)
+        return
+
+    if job.state == "done":
+        if job.info["mode"] == "batch_extend":
+            show_batch_result(job)
+        elif all(os.path.exists(path) for path in job.result):
+            show_render_result(job)
+        else:
+            st.warning("⚠️ The result has been evicted from the output cache; process the audio again")
+    elif job.state == "cancelled":
+        st.warning("⏹️ Processing cancelled")
+    else:
+        st.error(f"❌ Processing failed: {job.error}")
+        st.error("💡 **Try:** Reduce duration • Check FFmpeg • Verify file integrity")
+    st.button("🗑️ Clear", key=f"clear_{job.id}", on_click=forget_job)
 
 def main():
     st.title("🎵 Audio Editor")
 
-    # Check FFmpeg availability for Streamlit deployment
-    ffmpeg_available, ffmpeg_info = check_ffmpeg()
-    if not ffmpeg_available:
+    # Check FFmpeg availability for Streamlit deployment; probed once per process, not per rerun
+    capabilities = ffmpeg_capabilities()
+    ffmpeg_info = capabilities["version"]
+    if not capabilities["available"]:
         st.error("❌ FFmpeg not found!")
         st.markdown("""
         **For local development:**
@@ -229,17 +789,22 @@ def main():
 
     # Show environment info
     if is_streamlit_cloud():
-        st.success("✅ FFmpeg ready! 🌐 Streamlit Cloud mode (simple loop method)")
+        st.success("✅ FFmpeg ready! 🌐 Streamlit Cloud mode (segment copy)")
         st.caption(f"FFmpeg: {ffmpeg_info}")
     else:
-        st.success("✅ FFmpeg ready! 💻 Local mode (advanced crossfade)")
+        st.success("✅ FFmpeg ready! 💻 Local mode (segment copy)")
         st.caption(f"FFmpeg: {ffmpeg_info}")
+    if not capabilities["libmp3lame"]:
+        st.warning("⚠️ This FFmpeg build has no libmp3lame encoder, so MP3 output is unavailable")
+    if capabilities["missing_filters"]:
+        st.warning(f"⚠️ This FFmpeg build lacks filters some methods need: {', '.join(capabilities['missing_filters'])}")
+    available_formats = supported_formats()
 
     # Mode selection at the top
     st.markdown("### 🎯 Choose Your Mode")
     mode = st.radio(
         "What do you want to do?",
-        ["🔄 Extend Single Audio", "🔗 Combine Multiple Audio", "🔄➕ Combine Then Extend"],
+        ["🔄 Extend Single Audio", "📚 Batch Extend", "🔗 Combine Multiple Audio", "🔄➕ Combine Then Extend"],
         horizontal=True,
         help="Choose your audio processing mode"
     )
@@ -247,6 +812,7 @@ def main():
     # Convert to internal mode names
     mode_map = {
         "🔄 Extend Single Audio": "extend",
+        "📚 Batch Extend": "batch_extend",
         "🔗 Combine Multiple Audio": "combine",
         "🔄➕ Combine Then Extend": "combine_extend"
     }
@@ -282,16 +848,16 @@ def main():
             max_value=10.0,
             value=3.0,  # Default 3s like your test
             step=0.1,
-            help=f"Dynamic crossfade duration - uses acrossfade=d={{value}} in FFmpeg"
+            help="Length of each loop seam (and of the joins between tracks in the combine modes)"
         )
 
-        st.caption(f"🔧 FFmpeg filter: acrossfade=d={crossfade_duration}")
+        st.caption(f"🔧 FFmpeg seam: {SEAM_METHODS[audio_method]['filters']}, d={crossfade_duration}s")
 
         # Output format settings
         st.subheader("📁 Output Format")
         output_format = st.selectbox(
             "File Format",
-            ["mp3", "wav", "m4a", "flac"],
+            [fmt for fmt in ["mp3", "wav", "m4a", "flac"] if fmt in available_formats],
             index=0,
             help="Choose your preferred output format"
         )
@@ -304,9 +870,19 @@ def main():
         else:
             quality = "high"
 
+        # Extra formats come from the same decode and filter pass
+        extra_formats = st.multiselect(
+            "Also export as",
+            [fmt for fmt in available_formats if fmt != output_format],
+            help="Rendered from the same decode as the main format (default quality)"
+        )
+
         # Audio processing
         st.subheader("🎛️ Audio Processing")
-        normalize_audio = st.checkbox("Normalize Audio", value=True)
+        normalize_audio = st.checkbox(
+            "Normalize Audio", value=True,
+            help=f"Gain to {LOUDNESS_TARGET_LUFS:.0f} LUFS (true peak ≤ {LOUDNESS_TRUE_PEAK_DBTP} dBTP), measured once per source"
+        )
         create_preview = st.checkbox("Create Audio Preview", value=True)
 
         # File naming
@@ -327,6 +903,13 @@ def main():
             2. Set target duration
             3. Audio will loop with crossfade
             """)
+        elif current_mode == "batch_extend":
+            st.markdown("### 📝 Batch Extend")
+            st.markdown(f"""
+            1. Upload any number of audio files
+            2. Set target duration
+            3. Every file is extended in parallel ({os.cpu_count() or 1} cores)
+            """)
         elif current_mode == "combine":
             st.markdown("### 📝 Combine Mode")
             st.markdown("""
@@ -334,7 +917,7 @@ def main():
             2. Files combine with crossfade
             3. Download merged result
             """)
-        else:  # combine_extend
+        elif current_mode == "combine_extend":
             st.markdown("### 📝 Combine + Extend")
             st.markdown("""
             1. Upload multiple audio files
@@ -348,7 +931,7 @@ def main():
         help_text = "Upload 1 audio file to extend"
     else:
         max_files = None
-        help_text = "Upload multiple audio files to combine"
+        help_text = "Upload multiple audio files to extend" if current_mode == "batch_extend" else "Upload multiple audio files to combine"
 
     uploaded_files = st.file_uploader(
         "🎧 Choose audio files",
@@ -360,27 +943,45 @@ def main():
     # Convert single file to list for consistent handling
     if uploaded_files and not isinstance(uploaded_files, list):
         uploaded_files = [uploaded_files]
+    job = active_job()
+    # A running job still reads the uploads it was started with
+    forget_stale_uploads(uploaded_files, {upload["path"] for upload in job.info["uploads"]} if job and not job.done else ())
+    # Spill, probe and decode new uploads in the background while settings are chosen
+    start_upload_sweeper()
+    ingest_uploads(uploaded_files)
 
     if uploaded_files:
         # Show uploaded files info (FFmpeg will handle the processing)
         st.markdown("### 📂 Uploaded Files")
 
+        ingested = [ingested_upload(uploaded_file) for uploaded_file in uploaded_files]
         for i, uploaded_file in enumerate(uploaded_files):
             with st.expander(f"🎧 File {i+1}: {uploaded_file.name}", expanded=(i==0)):
-                # Just show basic file info
-                size_mb = len(uploaded_file.getvalue()) / (1024*1024)
-                st.metric("File Size", f"{size_mb:.1f} MB")
+                # Just show basic file info; duration once the background probe is back
+                size_mb = uploaded_file.size / (1024*1024)
+                size_col, duration_col = st.columns(2)
+                size_col.metric("File Size", f"{size_mb:.1f} MB")
+                if ingested[i] and ingested[i]["info"]:
+                    audio_info = ingested[i]["info"]
+                    duration_col.metric("Duration", format_duration(audio_info["duration"]))
+                    st.caption(f"{audio_info['format']} · {audio_info['sample_rate']} Hz · {audio_info['channels']} ch")
+                elif ingested[i]:
+                    duration_col.metric("Duration", "unreadable")
+                else:
+                    duration_col.metric("Duration", "reading...")
 
                 # Show processing info
-                st.info(f"🔧 FFmpeg: acrossfade=d={crossfade_duration} + 3s fade out")
+                st.info(f"🔧 FFmpeg: {SEAM_METHODS[audio_method]['filters']}, d={crossfade_duration}s + 3s fade out")
                 st.info(f"📄 Method: {selected_method}")
 
         # Note about multi-file modes
-        if current_mode in ["combine", "combine_extend"]:
-            st.info("ℹ️ Multi-file modes: Will use FFmpeg with exact test filter + 3s fade out (coming soon). Currently only extend mode is implemented.")
+        if current_mode == "combine":
+            st.info(f"ℹ️ {len(uploaded_files)} tracks are joined in upload order with {crossfade_duration}s crossfades + 3s fade out")
+        elif current_mode == "combine_extend":
+            st.info(f"ℹ️ {len(uploaded_files)} tracks are combined once, then the combined audio loops to the target duration")
 
         # Duration settings (for extend and combine_extend modes)
-        if current_mode in ["extend", "combine_extend"]:
+        if current_mode in ["extend", "batch_extend", "combine_extend"]:
             st.markdown("### 🎯 Duration Settings")
             st.markdown("**Set your target duration (Hours & Minutes only):**")
 
@@ -422,7 +1023,7 @@ def main():
                 st.success(f"✅ Target: {hours:02d}:{minutes:02d}:00")
 
         # Simplified validation (no heavy calculations until button press)
-        if current_mode in ["extend", "combine_extend"]:
+        if current_mode in ["extend", "batch_extend", "combine_extend"]:
             # Basic validation only
             if target_duration_ms <= 0:
                 is_valid = False
@@ -448,6 +1049,13 @@ def main():
                 is_valid = True
                 validation_message = "Ready to process"
 
+        # Real durations once every upload has been probed (loop count, unreadable files)
+        if is_valid and all(ingested):
+            is_valid, validation_message = validate_uploads(
+                current_mode, ingested, [uploaded_file.name for uploaded_file in uploaded_files],
+                target_duration_ms if current_mode != "combine" else 0, crossfade_duration
+            )
+
         # Show processing settings summary
         with st.expander("📋 Processing Settings Summary", expanded=False):
             col1, col2 = st.columns(2)
@@ -457,129 +1065,90 @@ def main():
                 st.write(f"**Crossfade:** {crossfade_duration}s")
             with col2:
                 st.write(f"**Format:** {output_format.upper()} ({quality})")
+                if extra_formats and current_mode != "batch_extend":
+                    st.write(f"**Also:** {', '.join(fmt.upper() for fmt in extra_formats)}")
                 st.write(f"**Method:** {selected_method}")
                 st.write(f"**Normalize:** {'Yes' if normalize_audio else 'No'}")
-                if current_mode in ["extend", "combine_extend"]:
+                if current_mode in ["extend", "batch_extend", "combine_extend"]:
                     st.write(f"**Target:** {hours:02d}:{minutes:02d}:00")
 
         if not is_valid:
             st.error(f"❌ {validation_message}")
 
+        # A few seconds around the seam, re-rendered in the background whenever the settings change
+        if current_mode == "extend" and create_preview and is_valid:
+            st.markdown("### 🎧 Seam Preview")
+            show_seam_preview(
+                uploaded_files[0], target_duration_ms // 60000, crossfade_duration, audio_method, output_format, normalize_audio
+            )
+
         # Process button
         button_text = "🚀 Process Audio" if is_valid else f"❌ {validation_message}"
 
-        if st.button(button_text, disabled=not is_valid, type="primary"):
-            progress_container = st.container()
-
-            with progress_container:
-                progress_bar = st.progress(0, text="Starting processing...")
-
-                try:
-                    crossfade_ms = int(crossfade_duration * 1000)
-
-                    if current_mode == "extend":
-                        # Process with FFmpeg (exact test filter + 3s fade out)
-                        input_path = save_uploaded_file(uploaded_files[0])
-                        output_path = f"output_{int(time.time())}.mp3"
-
-                        def progress_callback(percent, message):
-                            progress_bar.progress(percent, text=create_percentage_progress(percent, 100, message))
-
-                        success, message = process_audio_ffmpeg(
-                            input_path, output_path, target_duration_ms // 60000,
-                            crossfade_duration, audio_method, progress_callback
-                        )
-
-                        if not success:
-                            raise Exception(message)
-
-                        # Read the result file
-                        with open(output_path, 'rb') as f:
-                            audio_bytes = f.read()
-
-                        # Cleanup temp files
-                        if os.path.exists(input_path):
-                            os.unlink(input_path)
-                        if os.path.exists(output_path):
-                            os.unlink(output_path)
-
-                    elif current_mode == "combine":
-                        # TODO: Implement FFmpeg combine with 3s fade out
-                        raise Exception("Combine mode: Coming soon with FFmpeg + 3s fade out")
-
-                    elif current_mode == "combine_extend":
-                        # TODO: Implement FFmpeg combine+extend with 3s fade out
-                        raise Exception("Combine+extend mode: Coming soon with FFmpeg + 3s fade out")
-
-                    # FFmpeg already processed and exported the file with 3s fade out
-                    progress_bar.progress(100, text="100% - ✅ FFmpeg processing complete with fade out!")
-
-                    progress_bar.progress(100, text="✅ Processing complete!")
-                    progress_bar.empty()
-
-                    # Results
-                    st.success("🎉 Audio processing completed successfully!")
-
-                    # Results metrics
-                    result_col1, result_col2, result_col3 = st.columns(3)
-                    with result_col1:
-                        st.metric("Final Duration", f"{target_duration_ms // 60000} minutes")
-                    with result_col2:
-                        st.metric("File Size", f"{len(audio_bytes) / (1024*1024):.1f} MB")
-                    with result_col3:
-                        st.metric("Method", "FFmpeg + Fade Out")
-
-                    # Audio preview
-                    if create_preview and len(audio_bytes) > 0:
-                        st.markdown("#### 🎧 Result Preview")
-                        st.audio(audio_bytes, format='audio/mp3')
-                        st.caption("Preview: FFmpeg processed with 3s fade out")
-
-                    # Download
-                    if len(uploaded_files) == 1:
-                        filename_base = uploaded_files[0].name.rsplit('.', 1)[0]
-                    else:
-                        filename_base = "combined_audio"
-
-                    if custom_suffix:
-                        download_filename = f"{filename_base}_{custom_suffix}.{output_format}"
-                    else:
-                        mode_suffix = {"extend": "extended", "combine": "combined", "combine_extend": "combined_extended"}
-                        download_filename = f"{filename_base}_{mode_suffix[current_mode]}.{output_format}"
-
-                    mime_types = {
-                        "mp3": "audio/mp3",
-                        "wav": "audio/wav",
-                        "m4a": "audio/mp4",
-                        "flac": "audio/flac"
-                    }
-
-                    st.download_button(
-                        label=f"📥 Download Result ({output_format.upper()})",
-                        data=audio_bytes,
-                        file_name=download_filename,
-                        mime=mime_types.get(output_format, "audio/*"),
-                        help=f"Download: {download_filename}"
-                    )
-
-                    # Processing statistics
-                    with st.expander("📊 Processing Statistics", expanded=False):
-                        st.write(f"**Processing Mode:** {mode}")
-                        st.write(f"**Audio Method:** {selected_method}")
-                        st.write(f"**Input Files:** {len(uploaded_files)}")
-                        if current_mode != "combine":
-                            st.write(f"**Target Duration:** {target_duration_ms // 60000} minutes")
-                            st.write(f"**FFmpeg Filter:** acrossfade=d={crossfade_duration}")
-                            st.write(f"**Fade Out:** 3 seconds")
-                        st.write(f"**Crossfade Used:** {crossfade_duration}s")
-                        st.write(f"**Final Quality:** {quality}")
-
-                except Exception as e:
-                    progress_bar.empty()
-                    st.error(f"❌ Processing failed: {str(e)}")
-                    st.error("💡 **Try:** Reduce duration • Check FFmpeg • Verify file integrity")
+        queue_status = get_scheduler().status()
+        if queue_status["running"] >= queue_status["max_concurrent"] or queue_status["queued"]:
+            st.caption(
+                f"🚦 Server busy: {queue_status['running']} jobs running, {queue_status['queued']} waiting; "
+                f"new jobs are queued"
+            )
+
+        # Renders run in the background, so reruns and reconnects keep them;
+        # one job per session at a time
+        job_running = job is not None and not job.done
+        if job_running:
+            button_text = "⏳ Processing in background..."
+
+        if st.button(button_text, disabled=not is_valid or job_running, type="primary"):
+            target_minutes = None if current_mode == "combine" else target_duration_ms // 60000
+            info = {
+                "mode": current_mode, "mode_label": mode, "method": audio_method, "method_label": selected_method,
+                "uploads": [spill_upload(uploaded_file) for uploaded_file in uploaded_files],
+                "file_names": [uploaded_file.name for uploaded_file in uploaded_files],
+                "target_minutes": target_minutes, "crossfade": crossfade_duration, "normalize": normalize_audio,
+                "create_preview": create_preview,
+            }
+            # Clicked before the background probe was back: check the real durations now
+            is_valid, validation_message = validate_uploads(
+                current_mode, info["uploads"], info["file_names"], (target_minutes or 0) * 60000, crossfade_duration
+            )
+            if not is_valid:
+                st.error(f"❌ {validation_message}")
+                st.stop()
+
+            if current_mode == "batch_extend":
+                work = batch_job
+                info["formats"] = [(output_format, quality)]
+                info["output_names"] = [
+                    f"{name.rsplit('.', 1)[0]}_{custom_suffix or 'extended'}.{output_format}" for name in info["file_names"]
+                ]
+            else:
+                work = render_job
+                info["formats"] = [(output_format, quality)] + [(fmt, DEFAULT_QUALITY[fmt]) for fmt in extra_formats]
+                if current_mode == "combine":
+                    info["estimated_seconds"] = sum(upload["info"]["duration"] for upload in info["uploads"])
+
+                filename_base = uploaded_files[0].name.rsplit('.', 1)[0] if len(uploaded_files) == 1 else "combined_audio"
+                if custom_suffix:
+                    info["download_base"] = f"{filename_base}_{custom_suffix}"
+                else:
+                    mode_suffix = {"extend": "extended", "combine": "combined", "combine_extend": "combined_extended"}
+                    info["download_base"] = f"{filename_base}_{mode_suffix[current_mode]}"
+
+            # The same work submitted again (e.g. a second click) joins the running job
+            job_key = (
+                current_mode, tuple(upload["sha256"] for upload in info["uploads"]), target_minutes,
+                crossfade_duration, audio_method, normalize_audio, tuple(info["formats"]),
+                info.get("download_base"), tuple(info.get("output_names", ())),
+            )
+            submit_job(work, job_key, info)
+            st.rerun()
+
+        if job is not None:
+            show_job(job)
 
     else:
+        if job is not None:
+            show_job(job)
         # Welcome screen with mode-specific info
         st.markdown(f"""
         <div style='text-align: center; padding: 3rem; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); border-radius: 10px; color: white; margin: 2rem 0;'>
@@ -608,7 +1177,16 @@ def main():
             with col3:
                 st.markdown("**📊 Analysis**\n- Duration calculation\n- File statistics\n- Preview each file")
 
-        else:  # combine_extend
+        elif current_mode == "batch_extend":
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.markdown("**📚 Batch Extend**\n- Extend many files\n- Same settings for all\n- One ZIP download")
+            with col2:
+                st.markdown("**⚡ Parallel**\n- One file per core\n- Shared render queue\n- Per-file progress")
+            with col3:
+                st.markdown("**🎵 High Quality**\n- Multiple formats\n- Normalization\n- Cached results")
+
+        elif current_mode == "combine_extend":
             col1, col2, col3 = st.columns(3)
             with col1:
                 st.markdown("**🔄➕ Combine + Extend**\n- Merge then loop\n- Double processing\n- Maximum flexibility")
@@ -618,4 +1196,9 @@ def main():
                 st.markdown("**🎯 Powerful**\n- Best of both modes\n- Complex audio projects\n- Professional results")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Every widget change reruns the script; time it against the rerun budget (see metrics.py)
+    rerun_started = time.perf_counter()
+    try:
+        main()
+    finally:
+        record_rerun(time.perf_counter() - rerun_started)
@@ -0,0 +1,38 @@
+"""Headless audio engine behind the Streamlit app.
+
+Everything needed to probe, extend and combine audio without importing
+Streamlit, for scripts, workers and the ``python -m audio_engine`` CLI.
+"""
+from .analysis import (
+    LOUDNESS_TARGET_LUFS, LOUDNESS_TRUE_PEAK_DBTP, SEAM_METHODS,
+    find_loop_points, get_loudness, normalization_gain_db, plan_seam,
+)
+from .cache import CACHE_DIR, RENDER_VERSION, DiskCache, cache_lease, get_output_cache, render_cache_key
+from .combine import combine_hash, combine_sources, process_combine_extend_ffmpeg, process_combine_ffmpeg
+from .ffmpeg import FFmpegCancelled, FFmpegStalled, check_ffmpeg, ffmpeg_capabilities, get_audio_info, run_ffmpeg
+from .formats import (
+    DEFAULT_QUALITY, FADE_OUT_SECONDS, OUTPUT_FORMATS, encoder_args, get_wav_info, supported_formats,
+)
+from .jobs import Job, JobManager, get_job_manager
+from .metrics import job_trace, prometheus_text, record_rerun, record_stage, stage
+from .pcm import PCM_CACHE_DIR, get_pcm_cache, hash_file, ingest_source, load_pcm, prefetch_source
+from .render import (
+    batch_worker_count, plan_extend, plan_loop, process_audio_ffmpeg, process_batch_ffmpeg, render_seam_preview,
+)
+from .scheduler import JobRejected, JobScheduler, get_scheduler
+from .utils import create_percentage_progress, format_duration, validate_parameters
+
+__all__ = [
+    "CACHE_DIR", "DEFAULT_QUALITY", "FADE_OUT_SECONDS", "LOUDNESS_TARGET_LUFS",
+    "LOUDNESS_TRUE_PEAK_DBTP", "OUTPUT_FORMATS", "PCM_CACHE_DIR", "RENDER_VERSION",
+    "SEAM_METHODS", "DiskCache", "FFmpegCancelled", "FFmpegStalled", "Job", "JobManager",
+    "JobRejected", "JobScheduler",
+    "batch_worker_count", "cache_lease", "check_ffmpeg", "combine_hash", "combine_sources",
+    "create_percentage_progress", "encoder_args", "ffmpeg_capabilities", "find_loop_points", "format_duration",
+    "get_audio_info", "get_job_manager", "get_loudness", "get_output_cache", "get_pcm_cache",
+    "get_scheduler", "get_wav_info", "hash_file", "ingest_source", "job_trace", "load_pcm",
+    "normalization_gain_db", "plan_extend", "plan_loop", "plan_seam", "prefetch_source", "process_audio_ffmpeg",
+    "process_batch_ffmpeg", "process_combine_extend_ffmpeg", "process_combine_ffmpeg",
+    "prometheus_text", "record_rerun", "record_stage", "render_cache_key", "render_seam_preview",
+    "run_ffmpeg", "stage", "supported_formats", "validate_parameters",
+]
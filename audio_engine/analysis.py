@@ -0,0 +1,266 @@
+"""Source analysis: loop points, loudness and seam methods"""
+import hashlib
+import json
+import numpy as np
+
+from .ffmpeg import run_ffmpeg
+from .pcm import get_pcm_cache, load_pcm
+
+# Loop-point analysis for the phase-aligned method runs on a mono copy
+# decimated to about LOOP_ANALYSIS_RATE Hz; bump LOOP_ANALYSIS_VERSION
+# whenever the search changes so cached results are recomputed
+LOOP_ANALYSIS_VERSION = 2
+LOOP_ANALYSIS_RATE = 4000
+# Seconds searched at either end of the file; never less than two crossfades
+LOOP_SEARCH_SECONDS = 8
+LOOP_ONSET_CANDIDATES = 16
+ENVELOPE_HOP_SECONDS = 0.01
+
+def sliding_pearson(template, signal):
+    """Pearson correlation of ``template`` against every offset of ``signal`` (FFT based)"""
+    n = len(template)
+    template = template - template.mean()
+    size = 1 << int(len(signal) + n - 1).bit_length()
+    corr = np.fft.irfft(np.fft.rfft(signal, size) * np.conj(np.fft.rfft(template, size)), size)[:len(signal) - n + 1]
+    sums = np.concatenate(([0.0], np.cumsum(signal, dtype=np.float64)))
+    squares = np.concatenate(([0.0], np.cumsum(signal.astype(np.float64) ** 2)))
+    window_var = (squares[n:] - squares[:-n]) - (sums[n:] - sums[:-n]) ** 2 / n
+    return corr / (np.sqrt(np.maximum(window_var, 0) * (template ** 2).sum()) + 1e-9)
+
+def analyze_loop_points(pcm, sample_rate, crossfade_duration, frame_samples=1):
+    """Find loop-in/loop-out points whose crossfade lines up in phase and level.
+
+    Candidate loop-in points are the start of the file and the strongest
+    onsets near it; each is matched against every position near the end by
+    FFT cross-correlation of the waveform and of the RMS envelope. The best
+    pair is refined at full rate, keeping the loop length on the
+    ``frame_samples`` grid so the render can still stream-copy it. Returns
+    the whole file with score None when it is too short to search.
+    """
+    frames = len(pcm)
+    crossfade_samples = int(round(crossfade_duration * sample_rate))
+    default = {"loop_start": 0, "loop_end": frames, "score": None}
+
+    factor = max(1, sample_rate // LOOP_ANALYSIS_RATE)
+    usable = frames // factor * factor
+    mono = pcm[:usable].reshape(-1, factor * pcm.shape[1]).mean(axis=1, dtype=np.float32)
+    mono -= mono.mean()
+    rate = sample_rate / factor
+    window = max(int(crossfade_duration * rate), 16)
+    search = min(max(int(LOOP_SEARCH_SECONDS * rate), 2 * window), (len(mono) - 2 * window) // 4)
+    if search < window:
+        return default
+
+    hop = max(1, int(ENVELOPE_HOP_SECONDS * rate))
+    envelope = np.sqrt((mono[:len(mono) // hop * hop].reshape(-1, hop) ** 2).mean(axis=1))
+    onsets = np.maximum(np.diff(np.log(envelope[:search // hop] + 1e-3)), 0)
+    candidates = np.unique(np.concatenate(([0], (np.argsort(onsets)[-LOOP_ONSET_CANDIDATES:] + 1) * hop)))
+
+    # Out points: where the loop-in material would be crossfaded in
+    region_start = len(mono) - search - window
+    region = mono[region_start:]
+    env_region = envelope[region_start // hop:]
+    positions = region_start + np.arange(len(region) - window + 1)
+
+    best = (-np.inf, 0, 0)
+    for start in candidates:
+        wave_score = sliding_pearson(mono[start:start + window], region)
+        env_score = sliding_pearson(envelope[start // hop:(start + window) // hop], env_region)
+        env_score = np.interp((positions - region_start) / hop, np.arange(len(env_score)), env_score)
+        score = 0.5 * wave_score + 0.5 * env_score
+        if frame_samples > factor:
+            # Only lags that land on the encoder frame grid are usable
+            lag_error = ((positions - start) * factor) % frame_samples
+            score = np.where(np.minimum(lag_error, frame_samples - lag_error) <= factor / 2, score, -np.inf)
+        index = int(np.argmax(score))
+        if score[index] > best[0]:
+            best = (float(score[index]), int(start) * factor, int(positions[index]) * factor)
+
+    score, loop_start, out_point = best
+    if not np.isfinite(score):
+        return default
+    lag = max(frame_samples, round((out_point - loop_start) / frame_samples) * frame_samples)
+
+    # Full-rate refinement of the lag for phase; on a coarse frame grid the
+    # lag is already fixed and only the grid-aligned candidate remains
+    span = min(crossfade_samples, 8192)
+    reach = 2 * factor // frame_samples
+    lags = [lag + frame_samples * k for k in range(-reach, reach + 1)]
+    lags = [l for l in lags if loop_start + l + max(crossfade_samples, span) <= frames and l >= crossfade_samples]
+    if not lags:
+        return default
+    head = pcm[loop_start:loop_start + span].mean(axis=1, dtype=np.float32)
+    head -= head.mean()
+
+    def phase_match(l):
+        tail = pcm[loop_start + l:loop_start + l + span].mean(axis=1, dtype=np.float32)
+        tail -= tail.mean()
+        return float((head * tail).sum() / (np.sqrt((head ** 2).sum() * (tail ** 2).sum()) + 1e-9))
+
+    lag = max(lags, key=phase_match)
+    return {"loop_start": loop_start, "loop_end": loop_start + lag + crossfade_samples, "score": score}
+
+def find_loop_points(source, crossfade_duration, frame_samples=1, pcm_cache=None):
+    """Cached ``analyze_loop_points`` for an ingested source"""
+    pcm_cache = pcm_cache or get_pcm_cache()
+    key = hashlib.sha256(
+        f"loop-v{LOOP_ANALYSIS_VERSION}:{source['sha256']}:{round(float(crossfade_duration), 3)}:{frame_samples}".encode()
+    ).hexdigest()
+    path = pcm_cache.get(key, "json")
+    if path:
+        with open(path) as f:
+            return json.load(f)
+
+    points = analyze_loop_points(load_pcm(source['path']), source['sample_rate'], crossfade_duration, frame_samples)
+    tmp_path = pcm_cache.reserve(key, "json")
+    with open(tmp_path, 'w') as f:
+        json.dump(points, f)
+    pcm_cache.commit(key, "json", tmp_path)
+    return points
+
+# Loudness is measured once per source (EBU R128, loudnorm's analysis pass)
+# and cached next to its PCM; renders then apply one static gain, so
+# normalizing costs nothing per output hour. Bump LOUDNESS_VERSION if the
+# measurement changes.
+LOUDNESS_VERSION = 1
+LOUDNESS_TARGET_LUFS = -16.0
+LOUDNESS_TRUE_PEAK_DBTP = -1.5
+
+def measure_loudness(wav_path, expected_seconds=None, on_progress=None, cancel_event=None):
+    """Integrated loudness, true peak, LRA and threshold of a file"""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-i', wav_path,
+        '-af', f'loudnorm=I={LOUDNESS_TARGET_LUFS}:TP={LOUDNESS_TRUE_PEAK_DBTP}:print_format=json',
+        '-f', 'null', '-'
+    ]
+    result = run_ffmpeg(cmd, expected_seconds, on_progress, cancel_event)
+    report = result.stderr[result.stderr.rfind('{'):result.stderr.rfind('}') + 1]
+    if result.returncode != 0 or not report:
+        raise RuntimeError(f"Loudness measurement failed: {result.stderr[-200:]}")
+    measured = json.loads(report)
+    return {name: float(measured[f"input_{name}"]) for name in ("i", "tp", "lra", "thresh")}
+
+def get_loudness(source, pcm_cache=None, on_progress=None, cancel_event=None):
+    """Cached ``measure_loudness`` for an ingested source"""
+    pcm_cache = pcm_cache or get_pcm_cache()
+    key = hashlib.sha256(f"loudness-v{LOUDNESS_VERSION}:{source['sha256']}".encode()).hexdigest()
+    path = pcm_cache.get(key, "json")
+    if path:
+        with open(path) as f:
+            return json.load(f)
+
+    loudness = measure_loudness(source['path'], source['frames'] / source['sample_rate'], on_progress, cancel_event)
+    tmp_path = pcm_cache.reserve(key, "json")
+    with open(tmp_path, 'w') as f:
+        json.dump(loudness, f)
+    pcm_cache.commit(key, "json", tmp_path)
+    return loudness
+
+def normalization_gain_db(loudness):
+    """Static gain that reaches the loudness target without pushing the true peak over its ceiling"""
+    if not np.isfinite(loudness['i']):
+        # Digital silence: nothing to normalize
+        return 0.0
+    gain = LOUDNESS_TARGET_LUFS - loudness['i']
+    return round(min(gain, LOUDNESS_TRUE_PEAK_DBTP - loudness['tp']), 2)
+
+# Seam methods. Each builds the filter chain that joins the loop-out window
+# [tail] into the loop-in window [head] as [seam], from parameters measured
+# on those two windows only. The seam is rendered once per job and the loop
+# unit around it is stream-copied, so no method's cost depends on the
+# target duration.
+
+def seam_windows(pcm, plan):
+    """Mono float copies of the loop-out and loop-in crossfade windows"""
+    xfade = plan['crossfade_samples']
+    tail = pcm[plan['intro_samples']:plan['intro_samples'] + xfade].mean(axis=1, dtype=np.float32)
+    head = pcm[plan['loop_start']:plan['loop_start'] + xfade].mean(axis=1, dtype=np.float32)
+    return tail, head
+
+def analyze_seam_spectrum(pcm, plan):
+    """Shelf/peak gains (dB) that move the outgoing window towards the incoming one's spectrum"""
+    tail, head = seam_windows(pcm, plan)
+    freqs = np.fft.rfftfreq(len(tail), 1 / plan['sample_rate'])
+    tail_power = np.abs(np.fft.rfft(tail)) ** 2
+    head_power = np.abs(np.fft.rfft(head)) ** 2
+    params = {}
+    for name, low, high in (("low_db", 0, 250), ("mid_db", 250, 4000), ("high_db", 4000, np.inf)):
+        band = (freqs >= low) & (freqs < high)
+        ratio = (head_power[band].sum() + 1e-3) / (tail_power[band].sum() + 1e-3)
+        params[name] = float(np.clip(10 * np.log10(ratio), -9, 9))
+    return params
+
+def analyze_seam_level(pcm, plan):
+    """Level ratio across the seam, and whether the two windows are correlated"""
+    tail, head = seam_windows(pcm, plan)
+    tail_rms = np.sqrt((tail ** 2).mean()) + 1e-3
+    head_rms = np.sqrt((head ** 2).mean()) + 1e-3
+    correlation = float((tail * head).mean() / (tail_rms * head_rms))
+    return {
+        "gain": float(np.clip(head_rms / tail_rms, 0.5, 2.0)),
+        # Uncorrelated material keeps constant power with an equal-power curve
+        "curve": "tri" if correlation > 0.5 else "qsin",
+    }
+
+def crossfade_seam(xfade, sample_rate, params):
+    """Plain crossfade with the method's fade curve"""
+    curve = params['curve']
+    return (
+        f"[tail]afade=t=out:curve={curve}:nb_samples={xfade}[fo];"
+        f"[head]afade=t=in:curve={curve}:nb_samples={xfade}[fi];"
+        "[fo][fi]amix=inputs=2:normalize=0[seam]"
+    )
+
+def eq_matched_seam(xfade, sample_rate, params):
+    """Crossfade whose outgoing side is EQ'd towards the incoming spectrum as it fades.
+
+    The outgoing window is split into a dry part weighted (1-r)^2 and an
+    EQ'd part weighted r(1-r); together they still fade as 1-r, starting
+    fully dry so there is no step at either edge of the seam.
+    """
+    duration = xfade / sample_rate
+    eq = (
+        f"lowshelf=f=250:g={params['low_db']:.2f},"
+        f"equalizer=f=1000:t=o:w=2:g={params['mid_db']:.2f},"
+        f"highshelf=f=4000:g={params['high_db']:.2f}"
+    )
+    return (
+        "[tail]asplit[td][te];"
+        f"[td]afade=t=out:curve=qua:nb_samples={xfade}[fd];"
+        f"[te]{eq},aeval='val(ch)*(t/{duration})*(1-t/{duration})':c=same[fe];"
+        f"[head]afade=t=in:curve={params['curve']}:nb_samples={xfade}[fi];"
+        "[fd][fe][fi]amix=inputs=3:normalize=0[seam]"
+    )
+
+def level_matched_seam(xfade, sample_rate, params):
+    """Crossfade where both sides ramp to meet in level, unity at the seam edges"""
+    duration = xfade / sample_rate
+    gain = params['gain']
+    curve = params['curve']
+    return (
+        f"[tail]aeval='val(ch)*(1+({gain}-1)*t/{duration})':c=same,afade=t=out:curve={curve}:nb_samples={xfade}[fo];"
+        f"[head]aeval='val(ch)*(1/{gain}+(1-1/{gain})*t/{duration})':c=same,afade=t=in:curve={curve}:nb_samples={xfade}[fi];"
+        "[fo][fi]amix=inputs=2:normalize=0[seam]"
+    )
+
+# ``filters`` says in the UI which FFmpeg filters build each method's seam
+SEAM_METHODS = {
+    "basic_crossfade": {"curve": "tri", "analyze": None, "build": crossfade_seam,
+                        "filters": "afade (linear) + amix"},
+    "smooth_curves": {"curve": "qsin", "analyze": None, "build": crossfade_seam,
+                      "filters": "afade (quarter sine) + amix"},
+    "eq_matched": {"curve": "tri", "analyze": analyze_seam_spectrum, "build": eq_matched_seam,
+                   "filters": "afade + amix, outgoing side EQ'd by lowshelf/equalizer/highshelf"},
+    "phase_aligned": {"curve": "tri", "analyze": None, "build": crossfade_seam, "loop_search": True,
+                      "filters": "afade (linear) + amix at phase-aligned loop points"},
+    "dynamic_normalized": {"curve": "qsin", "analyze": analyze_seam_level, "build": level_matched_seam,
+                           "filters": "afade + amix with aeval level ramps"},
+}
+
+def plan_seam(method, source, plan):
+    """Attach the method and its measured seam parameters to a loop plan"""
+    spec = SEAM_METHODS[method]
+    params = {"curve": spec['curve']}
+    if spec['analyze']:
+        params.update(spec['analyze'](load_pcm(source['path']), plan))
+    return dict(plan, method=method, seam=params)
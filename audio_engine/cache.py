@@ -0,0 +1,233 @@
+"""Content-addressed disk cache for rendered outputs and decoded sources"""
+import contextvars
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import record_cache
+
+# Rendered outputs are cached by content hash; bump RENDER_VERSION whenever
+# the renderer's output changes so stale entries are never served
+RENDER_VERSION = 6
+CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "audio_editor_cache"))
+CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", str(10 * 1024**3)))
+CACHE_STALE_TMP_SECONDS = 24 * 60 * 60
+
+def render_cache_key(source_hash, target_minutes, crossfade_duration, method, output_format, quality, normalize=False):
+    """Cache key covering the input bytes and every parameter that changes the render"""
+    params = {
+        "version": RENDER_VERSION,
+        "source": source_hash,
+        "target_minutes": target_minutes,
+        "crossfade_duration": round(float(crossfade_duration), 3),
+        "method": method,
+        "format": output_format,
+        "quality": quality,
+        "normalize": bool(normalize),
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+class DiskCache:
+    """Content-addressed disk cache (rendered outputs, decoded PCM) with a byte budget.
+
+    Entries are written to a temporary name inside the cache directory and
+    moved into place with ``os.replace``, so readers never see a partial file.
+    Least-recently-used entries (by mtime, refreshed on every hit) are evicted
+    once the directory exceeds ``max_bytes``. The directory is the source of
+    truth, so several app processes can share one cache. Entries a job of
+    this process still uses are pinned (see ``cache_lease``) and skipped by
+    eviction until the job ends.
+    """
+
+    def __init__(self, root, max_bytes, name=None):
+        self.root = root
+        self.name = name or os.path.basename(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Path -> number of leases holding it
+        self.pins = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, key, ext):
+        return os.path.join(self.root, f"{key}.{ext}")
+
+    def get(self, key, ext):
+        """Return the cached path for ``key`` and mark it recently used, or None"""
+        path = self.path_for(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            record_cache(self.name, False)
+            return None
+        with self.lock:
+            self.hits += 1
+        record_cache(self.name, True)
+        self._hold(path)
+        return path
+
+    def reserve(self, key, ext):
+        """Unique temporary path to render ``key`` into before committing it"""
+        return os.path.join(self.root, f"{key}.{secrets.token_hex(4)}.tmp.{ext}")
+
+    def commit(self, key, ext, tmp_path):
+        """Atomically publish a finished render and enforce the byte budget"""
+        path = self.path_for(key, ext)
+        os.replace(tmp_path, path)
+        self._hold(path)
+        self.evict(keep=path)
+        return path
+
+    def release(self, path):
+        """Let ``path`` be evicted again before the current lease ends, once its job is done reading it"""
+        lease = _lease.get()
+        if lease is not None:
+            lease.release(self, path)
+
+    def pin(self, path):
+        with self.lock:
+            self.pins[path] = self.pins.get(path, 0) + 1
+
+    def unpin(self, path):
+        with self.lock:
+            if self.pins.get(path, 0) > 1:
+                self.pins[path] -= 1
+            else:
+                self.pins.pop(path, None)
+
+    def _hold(self, path):
+        lease = _lease.get()
+        if lease is not None:
+            lease.hold(self, path)
+
+    def evict(self, keep=None):
+        """Delete least-recently-used entries until the cache fits its budget.
+
+        ``keep`` and pinned entries are never evicted, so an entry larger
+        than the whole budget still reaches the caller that just committed
+        it and stays until the jobs reading it are done.
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if '.tmp.' in entry.name:
+                # Leftovers from renders that crashed before commit
+                if now - stat.st_mtime > CACHE_STALE_TMP_SECONDS:
+                    self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        with self.lock:
+            pinned = set(self.pins)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep and path not in pinned and self._remove(path):
+                total -= size
+                with self.lock:
+                    self.evictions += 1
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        total = 0
+        count = 0
+        for entry in os.scandir(self.root):
+            if '.tmp.' not in entry.name:
+                try:
+                    total += entry.stat().st_size
+                    count += 1
+                except FileNotFoundError:
+                    pass
+        with self.lock:
+            return {
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": count, "bytes": total, "max_bytes": self.max_bytes,
+            }
+
+_lease = contextvars.ContextVar("audio_cache_lease", default=None)
+
+class CacheLease:
+    """Cache entries pinned for one job, released together when it ends"""
+
+    def __init__(self):
+        self.held = []
+        self.lock = threading.Lock()
+
+    def hold(self, cache, path):
+        cache.pin(path)
+        with self.lock:
+            self.held.append((cache, path))
+
+    def release(self, cache, path):
+        with self.lock:
+            if (cache, path) not in self.held:
+                return
+            self.held.remove((cache, path))
+        cache.unpin(path)
+
+    def close(self):
+        with self.lock:
+            held, self.held = self.held, []
+        for cache, path in held:
+            cache.unpin(path)
+
+@contextmanager
+def cache_lease():
+    """Pin every cache entry looked up or committed in the block until it ends.
+
+    Jobs hold a lease while they read cached files by path, so a commit by
+    the same job or another session cannot evict a source, e.g. a combined
+    playlist bigger than the whole budget, while FFmpeg still has to open
+    it. Worker threads started with ``contextvars.copy_context().run``
+    share the lease; inside another lease the block joins that one. Pins
+    only protect entries from evictions by this process.
+    """
+    current = _lease.get()
+    if current is not None:
+        yield current
+        return
+    lease = CacheLease()
+    token = _lease.set(lease)
+    try:
+        yield lease
+    finally:
+        _lease.reset(token)
+        lease.close()
+
+# One DiskCache per cache directory and process, shared by every caller
+# (Streamlit sessions, CLI worker threads) so their locks and LRU agree
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+def shared_cache(root, max_bytes, name=None):
+    """The process-wide DiskCache for ``root``, created on first use"""
+    with _shared_caches_lock:
+        cache = _shared_caches.get(root)
+        if cache is None:
+            cache = _shared_caches[root] = DiskCache(root, max_bytes, name)
+        return cache
+
+def get_output_cache():
+    """One output cache shared by every session in this process"""
+    return shared_cache(CACHE_DIR, CACHE_MAX_BYTES, "output")
@@ -0,0 +1,381 @@
+"""Encoding long outputs as parallel, checkpointed time ranges joined at frame boundaries"""
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from .cache import RENDER_VERSION
+from .ffmpeg import FFmpegCancelled
+from .formats import (
+    OUTPUT_FORMATS, concat_segments, copy_frames, encoder_args, flac_frames, frame_offsets, join_flac_pieces,
+    remux_adts_to_m4a, remux_mp3_gapless,
+)
+from .metrics import stage
+from .pcm import hash_file
+from .workspace import directory_bytes
+
+# LAME and FFmpeg's FLAC/AAC encoders use about one core each, so an 8-hour
+# output is cut into one range per worker. Ranges shorter than this cost
+# more in FFmpeg start-up and joining than the extra cores save.
+CHUNK_MIN_SECONDS = 5 * 60
+ENCODE_WORKERS = int(os.environ.get("AUDIO_ENCODE_WORKERS", "0")) or os.cpu_count() or 1
+
+# Finished ranges are kept in a checkpoint until their outputs are joined, so
+# a failed, cancelled or killed job that is run again only encodes the ranges
+# it is missing. No range is longer than CHECKPOINT_SEGMENT_SECONDS, which
+# bounds the work lost to an interruption. Point AUDIO_CHECKPOINT_DIR at
+# persistent storage to resume across container restarts.
+CHECKPOINT_DIR = os.environ.get(
+    "AUDIO_CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "audio_editor_checkpoints")
+)
+CHECKPOINT_SEGMENT_SECONDS = 30 * 60
+# Checkpoints of jobs that were never retried are removed after this long.
+# A failed render's ranges can be as large as its outputs, so past
+# CHECKPOINT_MAX_BYTES the least recently touched ones go first
+CHECKPOINT_TTL_SECONDS = int(os.environ.get("AUDIO_CHECKPOINT_TTL_SECONDS", str(2 * 24 * 60 * 60)))
+CHECKPOINT_MAX_BYTES = int(os.environ.get("AUDIO_CHECKPOINT_MAX_BYTES", str(20 * 1024**3)))
+MANIFEST_FILE = "manifest.json"
+
+def chunk_count(total_samples, sample_rate, workers=None):
+    """How many ranges to encode an output of ``total_samples`` in.
+
+    One per worker once each gets CHUNK_MIN_SECONDS, and at least enough
+    that none is longer than CHECKPOINT_SEGMENT_SECONDS.
+    """
+    workers = workers or ENCODE_WORKERS
+    seconds = total_samples / sample_rate
+    return max(1, min(workers, int(seconds // CHUNK_MIN_SECONDS)), math.ceil(seconds / CHECKPOINT_SEGMENT_SECONDS))
+
+def plan_chunks(total_samples, grid, count):
+    """Split [0, total_samples) into ``count`` ranges with inner boundaries on ``grid``"""
+    grid_units = total_samples // grid
+    bounds = [grid_units * n // count * grid for n in range(count)] + [total_samples]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+class Checkpoint:
+    """Range files of one chunked encode and a manifest of the finished ones.
+
+    ``plan`` (the timeline, range bounds and output formats) names the
+    checkpoint and is stored in its manifest. Every finished range is added
+    with the size and sha256 of its files, and ``open`` keeps only ranges
+    whose files still match, so a resumed job re-encodes ranges that are
+    missing or corrupted and reuses the rest.
+    """
+
+    def __init__(self, plan):
+        self.plan = json.loads(json.dumps(plan, sort_keys=True, default=str))
+        key = hashlib.sha256(json.dumps(self.plan, sort_keys=True).encode()).hexdigest()
+        self.path = os.path.join(CHECKPOINT_DIR, key)
+        self.manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        self.done = {}
+        self._lock = threading.Lock()
+
+    def range_paths(self, index):
+        return [os.path.join(self.path, f"{n}_{index}.raw") for n in range(len(self.plan["outputs"]))]
+
+    def open(self):
+        """Create or reopen the checkpoint; returns the indexes of ranges that can be reused"""
+        sweep_checkpoints()
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get("plan") == self.plan:
+            for index, files in manifest.get("ranges", {}).items():
+                if all(self._matches(path, file) for path, file in zip(self.range_paths(int(index)), files)):
+                    self.done[index] = files
+        self._write()
+        return {int(index) for index in self.done}
+
+    def commit(self, index):
+        """Record range ``index`` as finished"""
+        files = [{"bytes": os.path.getsize(path), "sha256": hash_file(path)} for path in self.range_paths(index)]
+        with self._lock:
+            self.done[str(index)] = files
+            self._write()
+
+    def invalidate(self, indexes):
+        with self._lock:
+            for index in indexes:
+                self.done.pop(str(index), None)
+            self._write()
+
+    def remove(self):
+        """Delete the checkpoint; the caller holds its lock"""
+        remove_checkpoint(self.path)
+
+    def _matches(self, path, file):
+        try:
+            return os.path.getsize(path) == file["bytes"] and hash_file(path) == file["sha256"]
+        except OSError:
+            return False
+
+    def _write(self):
+        tmp_path = f"{self.manifest_path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"plan": self.plan, "ranges": self.done, "updated": time.time()}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+def lock_checkpoint(path):
+    """Lock the checkpoint at ``path`` without waiting; the open lock file, or None if it is held.
+
+    The lock is an flock on ``<path>.lock``, so jobs of the web app and the
+    CLI sharing CHECKPOINT_DIR exclude each other. The lock file is deleted
+    with its checkpoint; a lock that was taken on a file unlinked meanwhile
+    is given up and taken again on the current one.
+    """
+    lock_path = f"{path}.lock"
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    while True:
+        lock = open(lock_path, 'ab')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+def remove_checkpoint(path):
+    """Delete a checkpoint and its lock file while holding its lock"""
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.unlink(f"{path}.lock")
+    except FileNotFoundError:
+        pass
+
+def sweep_checkpoints(now=None):
+    """Remove checkpoints whose manifest has not changed for CHECKPOINT_TTL_SECONDS,
+    then the least recently touched ones while all of them exceed CHECKPOINT_MAX_BYTES.
+
+    Checkpoints a job of any process holds are skipped.
+    """
+    now = now or time.time()
+    try:
+        entries = list(os.scandir(CHECKPOINT_DIR))
+    except FileNotFoundError:
+        return
+    checkpoints = []
+    for entry in entries:
+        if entry.name.endswith(".lock"):
+            # Left by a job that died before creating its checkpoint
+            path = entry.path[:-len(".lock")]
+            if not os.path.exists(path):
+                checkpoints.append((entry.stat().st_mtime, path, 0))
+            continue
+        try:
+            touched = os.stat(os.path.join(entry.path, MANIFEST_FILE)).st_mtime
+        except FileNotFoundError:
+            touched = entry.stat(follow_symlinks=False).st_mtime
+        checkpoints.append((touched, entry.path, directory_bytes(entry.path)))
+    total = sum(size for _, _, size in checkpoints)
+    for touched, path, size in sorted(checkpoints):
+        if now - touched <= CHECKPOINT_TTL_SECONDS and total <= CHECKPOINT_MAX_BYTES:
+            break
+        lock = lock_checkpoint(path)
+        if lock is None:
+            continue
+        with lock:
+            remove_checkpoint(path)
+        total -= size
+
+def _range_readable(path, spec, start, end):
+    """Whether a range file parses as whole frames of its format, enough of them for the join"""
+    frame = spec['frame_samples']
+    needed = -(-(end - start) // frame)
+    if spec['chunk'] != "flac":
+        # Past the first range, MP3/ADTS ranges lead with pre-roll frames the join drops
+        needed = (spec['preroll_frames'] if start else 0) + (end - start) // frame
+    try:
+        if spec['chunk'] == "flac":
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                frames = sum(1 for _ in flac_frames(data))
+        else:
+            frames = len(frame_offsets(path, spec['chunk'])) - 1
+        return frames >= needed
+    except (OSError, ValueError, IndexError, RuntimeError):
+        return False
+
+# How many jobs of this process want each checkpoint; the last one removes it
+_active = {}
+_active_lock = threading.Lock()
+# How often a job waiting for the same render retries the lock
+WAIT_POLL_SECONDS = 0.5
+
+def encode_chunked(encode_windows, outputs, total_samples, sample_rate, fade, count, scratch_dir, workers=None, on_progress=None, cancel_event=None, timeline=None):
+    """Encode (path, format, quality) outputs as ``count`` ranges in parallel FFmpeg processes.
+
+    ``encode_windows(windows, targets, on_progress, cancel_event)`` renders
+    (start, end, fade) windows of the caller's timeline into
+    (path, encoder_args) targets in one FFmpeg run; ``fade`` is the output's
+    (start_sample, nb_samples) fade-out. Range boundaries sit on every
+    format's frame grid. MP3 and ADTS ranges are encoded with the format's
+    pre-roll/post-roll frames and trimmed back like the loop pieces, so the
+    encoder delay and padding of each range are dropped and only the first
+    range's delay and the last range's padding remain, as in one continuous
+    encode, and the joined output declares them so players trim them (see
+    remux_mp3_gapless and remux_adts_to_m4a). FLAC ranges are encoded on
+    fixed blocks and renumbered.
+
+    Range files are checkpointed under CHECKPOINT_DIR, keyed by
+    ``timeline`` (a JSON-able description of everything ``encode_windows``
+    renders from) with the ranges and formats, until the outputs are joined;
+    ranges a previous run finished are reused. Without a ``timeline`` there
+    is nothing to resume from. A job that asks for a checkpoint another job
+    (of this or another process) is encoding waits for its lock, then joins
+    the finished ranges into its own outputs (or resumes them if that job
+    failed); the last job of the process to use a checkpoint removes it. A range that turns out unjoinable is
+    encoded once more. ``scratch_dir`` holds the join's temporary files. Returns the
+    number of reused ranges.
+    """
+    specs = [OUTPUT_FORMATS[fmt] for _, fmt, _ in outputs]
+    if timeline is None:
+        timeline = secrets.token_hex(8)
+    grid = math.lcm(*(spec['frame_samples'] for spec in specs))
+    chunks = plan_chunks(total_samples, grid, count)
+    checkpoint = Checkpoint({
+        "version": RENDER_VERSION, "timeline": timeline, "total_samples": total_samples, "fade": fade,
+        "ranges": chunks, "outputs": [(fmt, quality) for _, fmt, quality in outputs],
+    })
+    with _active_lock:
+        _active[checkpoint.path] = _active.get(checkpoint.path, 0) + 1
+    try:
+        # Another job rendering the same output: wait, then reuse its ranges
+        lock = lock_checkpoint(checkpoint.path)
+        while lock is None:
+            if cancel_event and cancel_event.is_set():
+                raise FFmpegCancelled("Cancelled while waiting for the same render")
+            time.sleep(WAIT_POLL_SECONDS)
+            lock = lock_checkpoint(checkpoint.path)
+        with lock:
+            return _encode_checkpoint(
+                checkpoint, encode_windows, specs, outputs, chunks, total_samples, sample_rate, fade,
+                scratch_dir, workers, on_progress, cancel_event
+            )
+    finally:
+        with _active_lock:
+            _active[checkpoint.path] -= 1
+            if not _active[checkpoint.path]:
+                del _active[checkpoint.path]
+
+def _encode_checkpoint(checkpoint, encode_windows, specs, outputs, chunks, total_samples, sample_rate, fade, scratch_dir, workers, on_progress, cancel_event):
+    """Encode the ranges ``checkpoint`` is missing and join them into ``outputs``; returns the number reused"""
+    resumed = checkpoint.open()
+    _encode_ranges(
+        checkpoint, encode_windows, specs, outputs, chunks, total_samples, fade,
+        [index for index in range(len(chunks)) if index not in resumed], workers, on_progress, cancel_event
+    )
+    with stage("join", ranges=len(chunks), resumed=len(resumed)):
+        try:
+            _join_ranges(checkpoint, specs, outputs, chunks, total_samples, sample_rate, scratch_dir, cancel_event)
+        except RuntimeError:
+            bad = [
+                index for index in range(len(chunks))
+                if not all(
+                    _range_readable(path, spec, *chunks[index])
+                    for path, spec in zip(checkpoint.range_paths(index), specs)
+                )
+            ]
+            if not bad:
+                raise
+            checkpoint.invalidate(bad)
+            resumed -= set(bad)
+            _encode_ranges(checkpoint, encode_windows, specs, outputs, chunks, total_samples, fade, bad, workers, None, cancel_event)
+            _join_ranges(checkpoint, specs, outputs, chunks, total_samples, sample_rate, scratch_dir, cancel_event)
+    # Jobs still waiting for this render join the same ranges
+    with _active_lock:
+        if _active[checkpoint.path] == 1:
+            checkpoint.remove()
+    return len(resumed)
+
+def _encode_ranges(checkpoint, encode_windows, specs, outputs, chunks, total_samples, fade, indexes, workers, on_progress, cancel_event):
+    """Encode and checkpoint the ranges in ``indexes``, ``workers`` at a time.
+
+    After a range fails no new ones are started, but running ones finish and
+    are checkpointed for the retry.
+    """
+    if not indexes:
+        return
+    failed = threading.Event()
+    fractions = [0.0 if index in indexes else 1.0 for index in range(len(chunks))]
+    lock = threading.Lock()
+    parallel = min(len(indexes), workers or ENCODE_WORKERS)
+
+    def chunk_progress(index):
+        if not on_progress:
+            return None
+
+        def report(fraction, speed, eta):
+            with lock:
+                fractions[index] = fraction
+                overall = sum(f * (end - start) for f, (start, end) in zip(fractions, chunks)) / total_samples
+            # Ranges run side by side at about the same speed each
+            on_progress(overall, speed and speed * parallel, eta)
+        return report
+
+    def encode_chunk(index):
+        if failed.is_set():
+            raise FFmpegCancelled("Stopped after another range failed")
+        start, end = chunks[index]
+        last = index == len(chunks) - 1
+        windows, targets = [], []
+        for spec, path, (_, fmt, quality) in zip(specs, checkpoint.range_paths(index), outputs):
+            margin = spec['preroll_frames'] * spec['frame_samples']
+            window_end = total_samples if last else end + margin
+            windows.append((max(0, start - margin), window_end, fade if window_end > fade[0] else None))
+            targets.append((path, encoder_args(fmt, quality, piece=True)))
+        try:
+            encode_windows(windows, targets, chunk_progress(index), cancel_event)
+        except Exception:
+            failed.set()
+            raise
+        checkpoint.commit(index)
+
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="chunk") as executor:
+        # Each range's FFmpeg run is recorded in the caller's job trace
+        futures = [executor.submit(copy_context().run, encode_chunk, index) for index in indexes]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        # A range that was skipped because another one failed is not the cause
+        raise next((e for e in errors if not isinstance(e, FFmpegCancelled)), errors[0])
+
+def _join_ranges(checkpoint, specs, outputs, chunks, total_samples, sample_rate, scratch_dir, cancel_event):
+    """Join the checkpointed ranges into every output, leaving the range files in place"""
+    with tempfile.TemporaryDirectory(prefix="join_", dir=scratch_dir) as work_dir:
+        for n, (spec, (path, _, _)) in enumerate(zip(specs, outputs)):
+            raw_paths = [checkpoint.range_paths(index)[n] for index in range(len(chunks))]
+            if spec['chunk'] == "flac":
+                join_flac_pieces([(raw, start // spec['frame_samples']) for raw, (start, _) in zip(raw_paths, chunks)], path)
+                continue
+
+            frame = spec['frame_samples']
+            pieces = []
+            for index, (raw_path, (start, end)) in enumerate(zip(raw_paths, chunks)):
+                seg_path = os.path.join(work_dir, f"{n}_{index}.seg")
+                first = spec['preroll_frames'] if start else 0
+                count_frames = None if index == len(chunks) - 1 else (end - start) // frame
+                copy_frames(raw_path, seg_path, spec['chunk'], first, count_frames)
+                pieces.append((seg_path, 1))
+            joined_path = os.path.join(work_dir, f"{n}_joined.{'mp3' if spec['chunk'] == 'mp3' else 'aac'}")
+            concat_segments(pieces, joined_path)
+            if spec['chunk'] == "mp3":
+                remux_mp3_gapless(joined_path, path, total_samples, sample_rate, cancel_event=cancel_event)
+            else:
+                remux_adts_to_m4a(joined_path, path, total_samples, sample_rate, cancel_event=cancel_event)
+            for seg_path, _ in pieces:
+                os.unlink(seg_path)
@@ -0,0 +1,194 @@
+"""Run a manifest of extend/combine jobs without a web server.
+
+    python -m audio_engine jobs.json --jobs 4
+
+The manifest is a JSON list of jobs, a JSON object ``{"defaults": {...},
+"jobs": [...]}`` or JSON Lines with one job per line. A job is::
+
+    {"input": "in.mp3", "output": "out/in_2h.mp3", "target_minutes": 120}
+
+with optional ``mode`` ("extend", "combine", "combine_extend"; combine
+modes take ``inputs`` instead of ``input``), ``crossfade`` (seconds),
+``method``, ``format`` (defaults to the output's extension), ``quality``,
+``normalize`` and ``also`` (extra outputs from the same decode, each
+``{"output": ..., "format": ..., "quality": ...}``). Relative paths are
+resolved against the manifest's directory.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .analysis import SEAM_METHODS
+from .chunks import ENCODE_WORKERS
+from .combine import process_combine_extend_ffmpeg, process_combine_ffmpeg
+from .ffmpeg import check_ffmpeg, get_audio_info
+from .formats import OUTPUT_FORMATS
+from .render import batch_worker_count, process_audio_ffmpeg
+from .utils import format_duration, validate_parameters
+
+JOB_DEFAULTS = {"mode": "extend", "crossfade": 3.0, "method": "basic_crossfade", "quality": None, "normalize": False}
+
+class ManifestError(Exception):
+    """The manifest cannot be read or describes an invalid job"""
+
+def load_manifest(path):
+    """Read a manifest file into a list of job dicts with defaults applied"""
+    with open(path) as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            data = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except json.JSONDecodeError as e:
+            raise ManifestError(f"{path}: not JSON or JSON Lines ({e})")
+
+    defaults = {}
+    if isinstance(data, dict):
+        defaults = data.get("defaults", {})
+        data = data.get("jobs", [])
+    if not isinstance(data, list) or not all(isinstance(job, dict) for job in data):
+        raise ManifestError(f"{path}: expected a list of job objects")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return [normalize_job({**JOB_DEFAULTS, **defaults, **job}, base_dir, index) for index, job in enumerate(data, 1)]
+
+def output_format_for(path, output_format=None):
+    """Explicit format, else the output's extension"""
+    output_format = output_format or os.path.splitext(path)[1].lstrip('.').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ManifestError(f"unsupported output format '{output_format}' for {path}")
+    return output_format
+
+def normalize_job(job, base_dir, index):
+    """Resolve paths and formats of one manifest job, checking what needs no I/O"""
+    def resolve(path):
+        return os.path.join(base_dir, os.path.expanduser(path))
+
+    try:
+        if job["mode"] not in ("extend", "combine", "combine_extend"):
+            raise ManifestError(f"unknown mode '{job['mode']}'")
+        if job["method"] not in SEAM_METHODS:
+            raise ManifestError(f"unknown method '{job['method']}'")
+        if job["mode"] == "extend":
+            job["inputs"] = [resolve(job.pop("input"))]
+        else:
+            job["inputs"] = [resolve(path) for path in job["inputs"]]
+        if job["mode"] != "combine":
+            job["target_minutes"] = float(job["target_minutes"])
+        job["crossfade"] = float(job["crossfade"])
+        job["output"] = resolve(job["output"])
+        job["format"] = output_format_for(job["output"], job.get("format"))
+        job["also"] = [
+            (resolve(extra["output"]), output_format_for(extra["output"], extra.get("format")), extra.get("quality"))
+            for extra in job.get("also", [])
+        ]
+    except KeyError as e:
+        raise ManifestError(f"job {index}: missing {e.args[0]}")
+    except (TypeError, ValueError, ManifestError) as e:
+        raise ManifestError(f"job {index}: {e}")
+    return job
+
+def run_job(job, cancel_event, skip_existing=False, encode_workers=None):
+    """Validate and render one job; returns (success, message)"""
+    if cancel_event.is_set():
+        return False, "Processing cancelled"
+    outputs = [job["output"]] + [path for path, _, _ in job["also"]]
+    if skip_existing and all(os.path.exists(path) for path in outputs):
+        return True, "Skipped, output exists"
+    missing = [path for path in job["inputs"] if not os.path.isfile(path)]
+    if missing:
+        return False, f"Input not found: {missing[0]}"
+
+    mode = job["mode"]
+    target_ms = int(job.get("target_minutes", 0) * 60 * 1000)
+    original_ms = 0
+    if mode == "extend":
+        info = get_audio_info(job["inputs"][0])
+        if not info:
+            return False, f"Could not read audio info: {job['inputs'][0]}"
+        original_ms = int(info["duration"] * 1000)
+    valid, message = validate_parameters(mode, target_ms, original_ms, job["crossfade"], len(job["inputs"]))
+    if not valid:
+        return False, message
+
+    for path in outputs:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    options = dict(
+        method=job["method"], cancel_event=cancel_event, output_format=job["format"],
+        quality=job["quality"], extra_outputs=job["also"], normalize=job["normalize"],
+        encode_workers=encode_workers,
+    )
+    if mode == "extend":
+        return process_audio_ffmpeg(job["inputs"][0], job["output"], job["target_minutes"], job["crossfade"], **options)
+    if mode == "combine":
+        return process_combine_ffmpeg(job["inputs"], job["output"], job["crossfade"], **options)
+    return process_combine_extend_ffmpeg(job["inputs"], job["output"], job["target_minutes"], job["crossfade"], **options)
+
+def run_manifest(jobs, workers, skip_existing=False, log=print):
+    """Run every job on a pool of ``workers`` threads, logging each as it finishes.
+
+    Every job's work happens in FFmpeg child processes, so N threads keep N
+    encoders busy. Ctrl-C cancels running jobs and skips the pending ones.
+    Returns one result dict per job, in manifest order.
+    """
+    cancel_event = threading.Event()
+    results = [None] * len(jobs)
+    # Cores not taken by parallel jobs go to splitting each job's encode
+    encode_workers = max(1, ENCODE_WORKERS // workers)
+
+    def timed(index):
+        started = time.perf_counter()
+        success, message = run_job(jobs[index], cancel_event, skip_existing, encode_workers)
+        return {"output": jobs[index]["output"], "ok": success, "message": message,
+                "seconds": round(time.perf_counter() - started, 2)}
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job") as executor:
+        futures = {executor.submit(timed, index): index for index in range(len(jobs))}
+        remaining = set(futures)
+        while remaining:
+            try:
+                for future in as_completed(remaining):
+                    remaining.discard(future)
+                    result = results[futures[future]] = future.result()
+                    done += 1
+                    status = "ok" if result["ok"] else "FAILED"
+                    log(f"[{done}/{len(jobs)}] {status:<6} {format_duration(result['seconds'])}  {result['output']}"
+                        + ("" if result["ok"] else f"  ({result['message']})"))
+            except KeyboardInterrupt:
+                cancel_event.set()
+                log("Cancelling...")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m audio_engine", description="Render a manifest of audio jobs")
+    parser.add_argument("manifest", help="JSON or JSON Lines file of jobs")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="Jobs to run in parallel (default: one per CPU core)")
+    parser.add_argument("--skip-existing", action="store_true", help="Skip jobs whose outputs already exist")
+    parser.add_argument("--report", help="Write per-job results as JSON here")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ManifestError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+    ffmpeg_ok, ffmpeg_message = check_ffmpeg()
+    if not ffmpeg_ok:
+        print(f"error: {ffmpeg_message}", file=sys.stderr)
+        return 2
+
+    started = time.perf_counter()
+    results = run_manifest(jobs, args.jobs or batch_worker_count(len(jobs)), args.skip_existing)
+    failed = sum(1 for result in results if not result["ok"])
+    print(f"{len(results) - failed}/{len(results)} jobs succeeded in {format_duration(time.perf_counter() - started)}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
@@ -0,0 +1,277 @@
+"""Joining many tracks with crossfades, optionally extended afterwards"""
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+import numpy as np
+
+from .analysis import SEAM_METHODS, get_loudness, normalization_gain_db
+from .cache import cache_lease
+from .chunks import chunk_count, encode_chunked
+from .ffmpeg import FFmpegCancelled, FFmpegStalled, run_ffmpeg
+from .formats import (
+    FADE_OUT_SECONDS, OUTPUT_FORMATS, WAV_HEADER_BYTES, encoder_args, estimate_output_bytes, get_wav_info,
+    write_wav_header,
+)
+from .metrics import stage, traced
+from .pcm import PCM_FORMAT_VERSION, get_pcm_cache, hash_file, ingest_source, load_pcm
+from .render import batch_worker_count, process_audio_ffmpeg
+from .utils import format_duration, stage_progress
+from .workspace import Workspace
+
+# Combine streams tracks one at a time from the PCM cache; only the
+# crossfade overlap with the previous track is held in memory
+COMBINE_CHUNK_FRAMES = 1 << 18
+
+def combine_hash(source_hashes, crossfade_duration, method="basic_crossfade"):
+    """Content hash of a combined playlist, usable wherever a source hash is"""
+    params = {
+        "version": PCM_FORMAT_VERSION,
+        "sources": list(source_hashes),
+        "crossfade_duration": round(float(crossfade_duration), 3),
+        "curve": SEAM_METHODS[method]['curve'],
+    }
+    return hashlib.sha256(f"combine:{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+
+def ingest_ahead(input_paths, source_hashes, pcm_cache, pcm_format, cancel_event=None, max_workers=None):
+    """Yield ingested tracks in order, decoding at most ``max_workers`` ahead"""
+    workers = max_workers or batch_worker_count(len(input_paths))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest") as executor:
+        futures = deque()
+        for input_path, source_hash in zip(input_paths, source_hashes):
+            futures.append(executor.submit(
+                copy_context().run, ingest_source, input_path, source_hash, pcm_cache, None, cancel_event, pcm_format
+            ))
+            if len(futures) > workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def combine_sources(input_paths, crossfade_duration, source_hashes=None, progress_callback=None, cancel_event=None, max_workers=None, method="basic_crossfade"):
+    """Join tracks with crossfades (in the method's fade curve) into one canonical WAV in the PCM cache.
+
+    Tracks are decoded (or served from the PCM cache) a few at a time ahead
+    of a single sequential pass that copies each track's body straight from
+    its memory map and mixes only the overlaps, so memory and open files
+    stay bounded and time grows linearly with the total audio length. The
+    result is stored like an ingested source under ``combine_hash``, and
+    the returned dict matches ``ingest_source``.
+    """
+    pcm_cache = get_pcm_cache()
+    source_hashes = list(source_hashes or [hash_file(path) for path in input_paths])
+    combined_hash = combine_hash(source_hashes, crossfade_duration, method)
+    equal_power = SEAM_METHODS[method]['curve'] == "qsin"
+    key = hashlib.sha256(f"pcm-v{PCM_FORMAT_VERSION}:{combined_hash}".encode()).hexdigest()
+
+    path = pcm_cache.get(key, "wav")
+    if path:
+        source = get_wav_info(path)
+        source.update({"path": path, "sha256": combined_hash, "cached": True})
+        return source
+
+    # Every track is brought to the first track's rate, in stereo
+    first = ingest_source(input_paths[0], source_hashes[0], pcm_cache, cancel_event=cancel_event)
+    pcm_format = (first['sample_rate'], 2)
+    crossfade_samples = int(round(crossfade_duration * first['sample_rate']))
+    num_tracks = len(input_paths)
+
+    tmp_path = pcm_cache.reserve(key, "wav")
+    try:
+        with open(tmp_path, 'wb') as out:
+            out.write(bytes(WAV_HEADER_BYTES))
+            held = None
+            data_frames = 0
+            for index, track in enumerate(ingest_ahead(input_paths, source_hashes, pcm_cache, pcm_format, cancel_event, max_workers)):
+                pcm = load_pcm(track['path'])
+                frames = len(pcm)
+                start = 0
+                if held is not None:
+                    # Short tracks shrink the crossfade rather than overlap twice
+                    overlap = min(len(held), frames // 2)
+                    out.write(held[:len(held) - overlap].tobytes())
+                    if overlap:
+                        ramp = ((np.arange(overlap, dtype=np.float32) + 0.5) / overlap)[:, None]
+                        fade_in, fade_out = (np.sin(ramp * np.pi / 2), np.cos(ramp * np.pi / 2)) if equal_power else (ramp, 1 - ramp)
+                        mixed = held[len(held) - overlap:] * fade_out + pcm[:overlap].astype(np.float32) * fade_in
+                        out.write(np.clip(np.rint(mixed), -32768, 32767).astype('<i2').tobytes())
+                    data_frames += len(held)
+                    start = overlap
+
+                # Hold back the tail the next track will crossfade into
+                keep = min(crossfade_samples, frames - start) if index < num_tracks - 1 else 0
+                for chunk_start in range(start, frames - keep, COMBINE_CHUNK_FRAMES):
+                    out.write(pcm[chunk_start:min(chunk_start + COMBINE_CHUNK_FRAMES, frames - keep)].tobytes())
+                data_frames += frames - keep - start
+                held = pcm[frames - keep:].astype(np.float32)
+                del pcm
+                # Consumed; only tracks still ahead of the pass stay pinned
+                pcm_cache.release(track['path'])
+
+                if progress_callback:
+                    progress_callback(index + 1, num_tracks)
+
+            out.seek(0)
+            write_wav_header(out, data_frames * 2 * pcm_format[1], pcm_format[0], pcm_format[1], 2)
+        path = pcm_cache.commit(key, "wav", tmp_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    source = get_wav_info(path)
+    source.update({"path": path, "sha256": combined_hash, "cached": False})
+    return source
+
+def encode_pcm_windows(wav_path, windows, outputs, on_progress=None, cancel_event=None, gain_db=None):
+    """Encode (start, end, fade) windows of a PCM WAV into (path, encoder_args) outputs in one run.
+
+    The input is opened as raw PCM past the first window's start, so a
+    range deep into a long file starts without reading what precedes it.
+    """
+    info = get_wav_info(wav_path)
+    base = min(start for start, _, _ in windows)
+    length = max(end for _, end, _ in windows) - base
+    gain = f"volume={gain_db}dB," if gain_db else ""
+    parts = [f"[0:a]{gain}atrim=end_sample={length},asplit={len(windows)}" + "".join(f"[s{n}]" for n in range(len(windows)))]
+    for n, (start, end, fade) in enumerate(windows):
+        chain = f"[s{n}]atrim=start_sample={start - base}:end_sample={end - base},asetpts=PTS-STARTPTS"
+        if fade:
+            chain += f",afade=t=out:start_sample={fade[0] - start}:nb_samples={fade[1]}"
+        parts.append(chain + f"[w{n}]")
+    cmd = [
+        'ffmpeg', '-v', 'error', '-f', 's16le', '-ar', str(info['sample_rate']), '-ac', str(info['channels']),
+        '-skip_initial_bytes', str(info['data_offset'] + base * info['channels'] * 2), '-i', wav_path,
+        '-filter_complex', ";".join(parts)
+    ]
+    for n, (output_path, args) in enumerate(outputs):
+        cmd += ['-map', f'[w{n}]', '-map_metadata', '-1'] + args + ['-y', output_path]
+    result = run_ffmpeg(cmd, max(end - start for start, end, _ in windows) / info['sample_rate'], on_progress, cancel_event)
+    if result.returncode != 0:
+        raise RuntimeError(f"Encode failed: {result.stderr[:200]}")
+
+def encode_pcm_outputs(wav_path, frames, sample_rate, outputs, on_progress=None, cancel_event=None, gain_db=None, encode_workers=None, scratch_dir=None, source_hash=None):
+    """Encode a PCM WAV with the standard fade-out into every (path, format, quality) output.
+
+    Short outputs and WAV share one FFmpeg run; long compressed outputs are
+    encoded as parallel time ranges on up to ``encode_workers`` cores, which
+    are checkpointed by ``source_hash`` (see chunks.py) and joined with
+    temporary files under ``scratch_dir``. Returns the number of ranges
+    reused from an earlier run.
+    """
+    fade_samples = min(FADE_OUT_SECONDS * sample_rate, frames // 2)
+    fade = (frames - fade_samples, fade_samples)
+    chunks = chunk_count(frames, sample_rate, encode_workers)
+    chunked = [output for output in outputs if chunks > 1 and OUTPUT_FORMATS[output[1]]['chunk']]
+    direct = [output for output in outputs if output not in chunked]
+    encode_windows = partial(encode_pcm_windows, wav_path, gain_db=gain_db)
+    if direct:
+        encode_windows(
+            [(0, frames, fade)] * len(direct),
+            [(path, encoder_args(fmt, quality)) for path, fmt, quality in direct],
+            on_progress, cancel_event
+        )
+    if chunked:
+        return encode_chunked(
+            encode_windows, chunked, frames, sample_rate, fade, chunks, scratch_dir, encode_workers,
+            on_progress, cancel_event, timeline=source_hash and ("pcm", source_hash, gain_db)
+        )
+    return 0
+
+@traced("combine")
+@cache_lease()
+def process_combine_ffmpeg(input_paths, output_path, crossfade_duration, method="basic_crossfade", progress_callback=None, cancel_event=None, source_hashes=None, output_format="mp3", quality=None, extra_outputs=(), normalize=False, encode_workers=None):
+    """Combine tracks in order with crossfades and a fade-out, in one streaming pass.
+
+    ``extra_outputs`` lists more (path, format, quality) outputs encoded
+    from the same combined audio; ``normalize`` applies a gain from the
+    combined audio's cached loudness. Returns (success, message).
+    """
+    try:
+        if progress_callback:
+            progress_callback(10, f"🎚️ Decoding {len(input_paths)} tracks...")
+
+        def on_track(done, total):
+            if progress_callback:
+                progress_callback(10 + int(60 * done / total), f"🔗 Joined track {done}/{total}")
+
+        with stage("combine", tracks=len(input_paths)):
+            combined = combine_sources(input_paths, crossfade_duration, source_hashes, on_track, cancel_event, method=method)
+        outputs = [(output_path, output_format, quality)] + list(extra_outputs)
+        gain_db = None
+        if normalize:
+            gain_db = normalization_gain_db(get_loudness(
+                combined, on_progress=stage_progress(progress_callback, 65, 70, "📏 Measuring loudness"),
+                cancel_event=cancel_event
+            ))
+        if progress_callback:
+            progress_callback(70, "⚡ Encoding combined audio...")
+        # Only parallel-range encodes use scratch, up to about their output size
+        scratch_bytes = sum(
+            estimate_output_bytes(fmt, fmt_quality, combined['frames'] / combined['sample_rate'], combined['sample_rate'], combined['channels'])
+            for _, fmt, fmt_quality in outputs if OUTPUT_FORMATS[fmt]['chunk']
+        )
+        with Workspace("combine", scratch_bytes) as workspace, stage("encode", outputs=len(outputs)) as record:
+            resumed = encode_pcm_outputs(
+                combined['path'], combined['frames'], combined['sample_rate'], outputs,
+                stage_progress(progress_callback, 70, 90, "⚡ Encoding"), workspace.guard(cancel_event), gain_db,
+                encode_workers, workspace.path, combined['sha256']
+            )
+            record["resumed"] = resumed
+        if progress_callback:
+            progress_callback(90, "✅ Finalizing...")
+
+        duration = format_duration(combined['frames'] / combined['sample_rate'])
+        gain_note = f", normalized {gain_db:+.1f} dB" if normalize else ""
+        resumed_note = f", {resumed} encoded range{'s' if resumed > 1 else ''} resumed" if resumed else ""
+        return True, f"Success! {len(input_paths)} tracks combined ({duration}), crossfade d={crossfade_duration:.2f}s{gain_note}{resumed_note}"
+
+    except FFmpegCancelled:
+        return False, "Processing cancelled"
+    except FFmpegStalled as e:
+        return False, f"Processing stalled: {str(e)}"
+    except Exception as e:
+        return False, f"Processing error: {str(e)}"
+
+@traced("combine_extend")
+@cache_lease()
+def process_combine_extend_ffmpeg(input_paths, output_path, target_minutes, crossfade_duration, method="basic_crossfade", progress_callback=None, cancel_event=None, source_hashes=None, output_format="mp3", quality=None, extra_outputs=(), normalize=False, encode_workers=None):
+    """Combine tracks once, then extend the combined unit to the target duration.
+
+    Stage one joins the tracks into a cached intermediate (see
+    ``combine_sources``); stage two loops that intermediate with the
+    segment-copy extender, which finds it in the PCM cache by its playlist
+    hash and never touches the original inputs again. Returns (success, message).
+    """
+    try:
+        if progress_callback:
+            progress_callback(10, f"🎚️ Decoding {len(input_paths)} tracks...")
+
+        def on_track(done, total):
+            if progress_callback:
+                progress_callback(10 + int(40 * done / total), f"🔗 Joined track {done}/{total}")
+
+        with stage("combine", tracks=len(input_paths)):
+            combined = combine_sources(input_paths, crossfade_duration, source_hashes, on_track, cancel_event, method=method)
+    except FFmpegCancelled:
+        return False, "Processing cancelled"
+    except FFmpegStalled as e:
+        return False, f"Processing stalled: {str(e)}"
+    except Exception as e:
+        return False, f"Processing error: {str(e)}"
+
+    extend_progress = None
+    if progress_callback:
+        def extend_progress(percent, message):
+            # The extender reports 10-90%; it gets the second half of the bar
+            progress_callback(50 + int((percent - 10) / 2), message)
+
+    success, message = process_audio_ffmpeg(
+        combined['path'], output_path, target_minutes, crossfade_duration, method,
+        extend_progress, cancel_event, combined['sha256'], output_format, quality, extra_outputs, normalize,
+        encode_workers
+    )
+    if success:
+        message = f"Success! {len(input_paths)} tracks combined once, then {message.removeprefix('Success! ')}"
+    return success, message
@@ -0,0 +1,221 @@
+"""FFmpeg and ffprobe subprocess helpers"""
+import json
+import os
+import subprocess
+import threading
+import queue
+import time
+from collections import deque
+
+from .metrics import record_ffmpeg, stage
+
+def get_audio_info(audio_path):
+    """Get audio information using ffprobe"""
+    try:
+        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', audio_path]
+        with stage("probe"):
+            result = subprocess.run(cmd, capture_output=True, text=True)
+
+        if result.returncode == 0:
+            info = json.loads(result.stdout)
+            duration = float(info['format']['duration'])
+            audio = next((s for s in info.get('streams', []) if s.get('codec_type') == 'audio'), {})
+            return {
+                "duration": duration,
+                "format": info['format']['format_name'],
+                "sample_rate": int(audio.get('sample_rate', 44100)),
+                "channels": int(audio.get('channels', 2)),
+            }
+        return None
+    except:
+        return None
+
+# Kill FFmpeg only when its reported output time stops advancing this long
+FFMPEG_STALL_TIMEOUT = 60
+
+class FFmpegCancelled(Exception):
+    """Raised when a running FFmpeg job is cancelled"""
+
+class FFmpegStalled(Exception):
+    """Raised when FFmpeg stops making progress"""
+
+class AnyEvent:
+    """Reads as set once any of its events is set, for use as a ``cancel_event``"""
+
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+
+    def is_set(self):
+        return any(event.is_set() for event in self.events)
+
+def _reap(process):
+    """Wait for ``process`` and return its resource usage (None without os.wait4)"""
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+def run_ffmpeg(cmd, expected_seconds=None, on_progress=None, cancel_event=None, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """Run FFmpeg with live ``-progress`` reporting, cancellation and stall detection.
+
+    ``on_progress(fraction, speed, eta_seconds)`` is called for every progress
+    block FFmpeg emits. There is no wall-clock limit: the process is only
+    killed when ``cancel_event`` is set or ``out_time`` has not advanced for
+    ``stall_timeout`` seconds. Inside a job trace the run's wall time,
+    speed, CPU time and peak RSS are recorded (see metrics.py). Returns a
+    CompletedProcess with the tail of stderr, like
+    ``subprocess.run(..., capture_output=True, text=True)``.
+    """
+    cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    process = subprocess.Popen(
+        cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, errors='replace'
+    )
+    lines = queue.Queue()
+    stderr_tail = deque(maxlen=50)
+
+    def pump(stream, sink):
+        for line in stream:
+            sink(line.rstrip('\n'))
+        if stream is process.stdout:
+            lines.put(None)
+
+    readers = [
+        threading.Thread(target=pump, args=(process.stdout, lines.put), daemon=True),
+        threading.Thread(target=pump, args=(process.stderr, stderr_tail.append), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    started = time.monotonic()
+    last_advance = started
+    out_seconds = 0.0
+    speed = 0.0
+    block = {}
+    rusage = None
+    try:
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise FFmpegCancelled("Processing cancelled")
+            if time.monotonic() - last_advance > stall_timeout:
+                raise FFmpegStalled(f"FFmpeg made no progress for {stall_timeout}s")
+
+            try:
+                line = lines.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if line is None:
+                break
+
+            key, _, value = line.partition('=')
+            block[key.strip()] = value.strip()
+            if key != 'progress':
+                continue
+
+            # One complete progress block: out_time_us, speed, progress=continue|end
+            try:
+                current = int(block.get('out_time_us', '0')) / 1_000_000
+            except ValueError:
+                current = out_seconds
+            if current > out_seconds:
+                out_seconds = current
+                last_advance = time.monotonic()
+            try:
+                speed = float(block.get('speed', '0').rstrip('x'))
+            except ValueError:
+                # speed=N/A before the first frame is written
+                speed = 0.0
+
+            if on_progress and expected_seconds:
+                fraction = 1.0 if value.strip() == 'end' else min(out_seconds / expected_seconds, 1.0)
+                if speed > 0:
+                    eta = max(expected_seconds - out_seconds, 0) / speed
+                elif fraction > 0:
+                    eta = (time.monotonic() - started) * (1 - fraction) / fraction
+                else:
+                    eta = None
+                on_progress(fraction, speed, eta)
+            block = {}
+
+        rusage = _reap(process)
+    finally:
+        # Also reached when the progress callback raises (e.g. a Streamlit rerun)
+        if process.returncode is None:
+            process.kill()
+            rusage = _reap(process)
+        for reader in readers:
+            reader.join(timeout=1)
+        record_ffmpeg(cmd, time.monotonic() - started, rusage, out_seconds, speed)
+
+    return subprocess.CompletedProcess(cmd, process.returncode, None, "\n".join(stderr_tail))
+
+# Filters the render and analysis graphs are built from
+REQUIRED_FILTERS = (
+    "aeval", "afade", "aloop", "amix", "asetpts", "asplit", "atrim", "concat", "equalizer", "highshelf",
+    "loudnorm", "lowshelf", "volume",
+)
+# A failed probe is retried after this long, e.g. while packages.txt is still installing FFmpeg
+CAPABILITY_RETRY_SECONDS = 30
+
+def _ffmpeg_listing(option):
+    """Names from ``ffmpeg -encoders``/``-filters``: the word after each entry's flag column"""
+    result = subprocess.run(['ffmpeg', '-hide_banner', option], capture_output=True, text=True, timeout=10)
+    names = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        # Entries start with a flag column of dots and letters; the legend lines have '=' after it
+        if len(parts) >= 3 and parts[1] != '=' and set(parts[0]) <= set("VASFXBDTC|N."):
+            names.add(parts[1])
+    return frozenset(names)
+
+def probe_capabilities():
+    """Run FFmpeg to find its version, encoders and filters.
+
+    Returns a dict with ``available``, ``version`` (the first line of
+    ``ffmpeg -version``, or why FFmpeg is unusable), ``encoders`` and
+    ``filters`` (sets of names), ``libmp3lame`` and ``missing_filters``
+    (REQUIRED_FILTERS this build lacks).
+    """
+    capabilities = {
+        "available": False, "version": "FFmpeg not found", "encoders": frozenset(), "filters": frozenset(),
+        "libmp3lame": False, "missing_filters": list(REQUIRED_FILTERS),
+    }
+    try:
+        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=10)
+        if result.returncode != 0:
+            capabilities["version"] = "FFmpeg not working"
+            return capabilities
+        encoders = _ffmpeg_listing('-encoders')
+        filters = _ffmpeg_listing('-filters')
+    except (subprocess.TimeoutExpired, FileNotFoundError):
+        return capabilities
+    capabilities.update({
+        "available": True,
+        "version": result.stdout.split('\n')[0] if result.stdout else "Unknown version",
+        "encoders": encoders, "filters": filters, "libmp3lame": "libmp3lame" in encoders,
+        "missing_filters": [name for name in REQUIRED_FILTERS if name not in filters],
+    })
+    return capabilities
+
+_capabilities = None
+_capabilities_at = 0.0
+_capabilities_lock = threading.Lock()
+
+def ffmpeg_capabilities(refresh=False):
+    """probe_capabilities() once per process; a failed probe is retried after CAPABILITY_RETRY_SECONDS"""
+    global _capabilities, _capabilities_at
+    with _capabilities_lock:
+        stale = _capabilities is None or (
+            not _capabilities["available"] and time.monotonic() - _capabilities_at > CAPABILITY_RETRY_SECONDS
+        )
+        if refresh or stale:
+            _capabilities = probe_capabilities()
+            _capabilities_at = time.monotonic()
+        return _capabilities
+
+def check_ffmpeg():
+    """Check if FFmpeg is available and get version info"""
+    capabilities = ffmpeg_capabilities()
+    return capabilities["available"], capabilities["version"]
@@ -0,0 +1,460 @@
+"""Output formats, encoder arguments and container-level splicing"""
+import functools
+import mmap
+import os
+import struct
+import shutil
+
+from .ffmpeg import ffmpeg_capabilities, run_ffmpeg
+
+IO_CHUNK_BYTES = 1024 * 1024
+
+# MP3 (MPEG-1 Layer III) frame layout used for frame-accurate stream copy
+MP3_SAMPLE_RATES = (44100, 48000, 32000)  # header sample-rate index order
+MP3_BITRATES_KBPS = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+FADE_OUT_SECONDS = 3
+# Spliced MP3 and M4A outputs declare their encoder's priming and end padding
+# so players trim them back to the exact target length: LAME's delay goes in
+# the Info frame's LAME tag (decoders add their own 529 samples on top), and
+# the AAC encoder's priming in the M4A edit list
+MP3_ENCODER_DELAY = 576
+AAC_PRIMING_SAMPLES = 1024
+
+# How each output format is rendered. Spliceable formats are encoded as a
+# head, one loop unit and a tail on a shared frame grid and joined by frame
+# copy; ``preroll_frames`` of encoder context are encoded before/after each
+# piece and dropped, so the joins decode like one continuous encode. FLAC
+# frame headers carry absolute positions, so FLAC is encoded continuously
+# (still from the same decode and filter pass as the other formats).
+#
+# ``chunk`` is how long outputs encoded as parallel time ranges are joined
+# (see chunks.py): MP3/ADTS by frame copy like the loop pieces, FLAC by
+# renumbering the frames of every range after the first. WAV is a plain
+# copy already and is never chunked.
+#
+# ``encoder`` is the FFmpeg encoder the splicing was built around (frame
+# size, priming delay, LAME's bit reservoir switch); a format whose encoder
+# the installed FFmpeg lacks is not offered rather than swapped for another.
+FLAC_BLOCK_SAMPLES = 4608
+OUTPUT_FORMATS = {
+    "mp3": {"splice": "mp3", "chunk": "mp3", "frame_samples": 1152, "preroll_frames": 2, "mime": "audio/mp3",
+            "encoder": "libmp3lame"},
+    "m4a": {"splice": "adts", "chunk": "adts", "frame_samples": 1024, "preroll_frames": 4, "mime": "audio/mp4",
+            "encoder": "aac"},
+    "wav": {"splice": "pcm", "chunk": None, "frame_samples": 1, "preroll_frames": 0, "mime": "audio/wav",
+            "encoder": "pcm_s16le"},
+    "flac": {"splice": None, "chunk": "flac", "frame_samples": FLAC_BLOCK_SAMPLES, "preroll_frames": 0,
+             "mime": "audio/flac", "encoder": "flac"},
+}
+DEFAULT_QUALITY = {"mp3": "320k", "wav": "16-bit", "m4a": "high", "flac": "high"}
+AAC_HIGH_BITRATE = "256k"
+
+def supported_formats():
+    """Output formats whose encoder the installed FFmpeg has, in OUTPUT_FORMATS order"""
+    encoders = ffmpeg_capabilities()["encoders"]
+    # An FFmpeg whose encoder list could not be read is trusted with every format
+    return [fmt for fmt, spec in OUTPUT_FORMATS.items() if not encoders or spec["encoder"] in encoders]
+
+def encoder_args(output_format, quality=None, piece=False):
+    """FFmpeg codec/muxer arguments for one output; ``piece`` means raw frames for splicing"""
+    quality = quality or DEFAULT_QUALITY[output_format]
+    if output_format not in supported_formats():
+        raise RuntimeError(
+            f"{output_format.upper()} output needs FFmpeg's {OUTPUT_FORMATS[output_format]['encoder']} encoder, "
+            f"which this FFmpeg build does not have"
+        )
+    if output_format == "mp3":
+        args = ['-c:a', OUTPUT_FORMATS["mp3"]["encoder"], '-b:a', quality]
+        if piece:
+            # No bit reservoir, so every kept frame decodes on its own after a splice
+            args += ['-reservoir', '0', '-write_xing', '0', '-id3v2_version', '0', '-f', 'mp3']
+        return args
+    if output_format == "m4a":
+        bitrate = AAC_HIGH_BITRATE if quality == "high" else quality
+        return ['-c:a', OUTPUT_FORMATS["m4a"]["encoder"], '-b:a', bitrate, '-f', 'adts' if piece else 'mp4']
+    if output_format == "wav":
+        codec = 'pcm_s24le' if quality == "24-bit" else 'pcm_s16le'
+        return ['-c:a', codec] + (['-f', codec[4:]] if piece else ['-rf64', 'auto', '-f', 'wav'])
+    # Sources are 16-bit, whatever sample format the filter graph settled on.
+    # Pieces use a fixed block size so their frames can be renumbered onto one stream
+    args = ['-c:a', OUTPUT_FORMATS["flac"]["encoder"], '-sample_fmt', 's16']
+    return args + (['-frame_size', str(FLAC_BLOCK_SAMPLES)] if piece else []) + ['-f', 'flac']
+
+def estimate_output_bytes(output_format, quality, seconds, sample_rate, channels):
+    """Rough encoded size of ``seconds`` of audio, for sizing scratch space"""
+    quality = quality or DEFAULT_QUALITY[output_format]
+    pcm_bytes = seconds * sample_rate * channels * 2
+    if output_format == "wav":
+        return int(pcm_bytes * (1.5 if quality == "24-bit" else 1))
+    if output_format == "flac":
+        return int(pcm_bytes * 0.7)
+    bitrate = AAC_HIGH_BITRATE if quality == "high" else quality
+    return int(seconds * int(bitrate.rstrip('k')) * 1000 / 8)
+
+def get_wav_info(wav_path):
+    """Get exact sample count, layout and data offset of a PCM WAV or RF64 file"""
+    with open(wav_path, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+            raise RuntimeError(f"{os.path.basename(wav_path)} is not a WAV file")
+        info = {}
+        rf64_data_bytes = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise RuntimeError(f"No data chunk in {os.path.basename(wav_path)}")
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                # RF64 stores sizes past 4 GiB in the ds64 chunk
+                data_bytes = rf64_data_bytes if size == 0xFFFFFFFF and rf64_data_bytes is not None else size
+                info["frames"] = data_bytes // info["block_align"]
+                info["data_offset"] = f.tell()
+                del info["block_align"]
+                return info
+            body = f.read(min(size, 40))
+            if chunk_id == b'fmt ':
+                _, channels, sample_rate, _, block_align = struct.unpack('<HHIIH', body[:14])
+                info.update({"sample_rate": sample_rate, "channels": channels, "block_align": block_align})
+            elif chunk_id == b'ds64':
+                rf64_data_bytes = struct.unpack('<Q', body[8:16])[0]
+            f.seek(size + (size & 1) - len(body), os.SEEK_CUR)
+
+def frame_offsets(path, splice):
+    """Byte offsets of every frame in a raw MP3 or ADTS stream, plus the end offset"""
+    if os.path.getsize(path) == 0:
+        return [0]
+    offsets = []
+    pos = 0
+    # Mapped rather than read, so hour-long pieces are scanned without holding them in memory
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while pos < len(data):
+            offsets.append(pos)
+            if splice == "mp3":
+                header = int.from_bytes(data[pos:pos + 4], 'big')
+                if header >> 21 != 0x7FF or (header >> 17) & 0xF != 0b1101:
+                    raise RuntimeError(f"Unexpected MP3 frame header at byte {pos} of {os.path.basename(path)}")
+                bitrate = MP3_BITRATES_KBPS[(header >> 12) & 0xF] * 1000
+                sample_rate = MP3_SAMPLE_RATES[(header >> 10) & 0x3]
+                pos += 144 * bitrate // sample_rate + ((header >> 9) & 0x1)
+            else:
+                if data[pos] != 0xFF or data[pos + 1] & 0xF0 != 0xF0:
+                    raise RuntimeError(f"Unexpected ADTS frame header at byte {pos} of {os.path.basename(path)}")
+                pos += ((data[pos + 3] & 0x3) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+    offsets.append(pos)
+    return offsets
+
+def adts_frame_count(path):
+    """Number of frames in an ADTS stream, read header by header so a joined
+    output is never mapped whole"""
+    count = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(7)
+            if len(header) < 7:
+                return count
+            if header[0] != 0xFF or header[1] & 0xF0 != 0xF0:
+                raise RuntimeError(f"Unexpected ADTS frame header at byte {f.tell() - 7} of {os.path.basename(path)}")
+            f.seek(((header[3] & 0x3) << 11 | header[4] << 3 | header[5] >> 5) - 7, os.SEEK_CUR)
+            count += 1
+
+def copy_frames(src_path, dst_path, splice, first, count=None, frame_bytes=None):
+    """Keep ``count`` frames (all remaining if None) of ``src_path`` starting at frame ``first``.
+
+    ``splice`` is the format's splice kind; raw PCM uses ``frame_bytes`` per
+    sample frame instead of parsing headers.
+    """
+    if splice == "pcm":
+        total = os.path.getsize(src_path) // frame_bytes
+        offsets = None
+    else:
+        offsets = frame_offsets(src_path, splice)
+        total = len(offsets) - 1
+    last = total if count is None else first + count
+    if last > total:
+        raise RuntimeError(f"Segment too short: {total} frames, need {last}")
+    start, end = (first * frame_bytes, last * frame_bytes) if offsets is None else (offsets[first], offsets[last])
+
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        src.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = src.read(min(IO_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+
+def write_segments(pieces, out):
+    """Stream-copy (path, repeats) segments of raw frames into an open file"""
+    for path, repeats in pieces:
+        if repeats == 1:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, IO_CHUNK_BYTES)
+            continue
+        # Repeated segments are a single loop unit, small enough to hold once
+        with open(path, 'rb') as f:
+            data = f.read()
+        for _ in range(repeats):
+            out.write(data)
+
+def concat_segments(pieces, output_path):
+    """Stream-copy (path, repeats) segments of raw frames into one file"""
+    with open(output_path, 'wb') as out:
+        write_segments(pieces, out)
+
+# FLAC frame headers carry the frame number (UTF-8 coded) under a CRC-8,
+# and each frame ends with a CRC-16 over the whole frame. Joining ranges
+# that were encoded separately rewrites the numbers and patches both CRCs.
+FLAC_CRC16_POLY = 0x18005
+
+def _crc_table(poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & top else crc << 1) & mask
+        table.append(crc)
+    return table
+
+_CRC8_TABLE = _crc_table(0x07, 8)
+_CRC16_TABLE = _crc_table(FLAC_CRC16_POLY & 0xFFFF, 16)
+
+def flac_crc8(data):
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+def flac_crc16(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+def _gf2_mulmod16(a, b):
+    """a * b modulo the FLAC CRC-16 polynomial"""
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= FLAC_CRC16_POLY
+    return result
+
+@functools.lru_cache(maxsize=None)
+def _crc16_zeros(nbytes):
+    """x^(8 * nbytes) mod P: the CRC-16 state change over ``nbytes`` zero bytes"""
+    result, base = 1, 0x100
+    while nbytes:
+        if nbytes & 1:
+            result = _gf2_mulmod16(result, base)
+        base = _gf2_mulmod16(base, base)
+        nbytes >>= 1
+    return result
+
+def flac_utf8(value):
+    """FLAC's UTF-8 style coding of a frame or sample number"""
+    if value < 0x80:
+        return bytes([value])
+    length = 2
+    while value >> (5 * length + 1):
+        length += 1
+    tail = [0x80 | (value >> (6 * k)) & 0x3F for k in range(length - 2, -1, -1)]
+    return bytes([(0xFF << (8 - length)) & 0xFF | value >> (6 * (length - 1))] + tail)
+
+def flac_frame_header(data, pos):
+    """(header length including its CRC-8, frame number, length of the coded number) at ``pos``"""
+    first = data[pos + 4]
+    number_length = 1
+    if first & 0x80:
+        while number_length < 7 and first & (0x80 >> number_length):
+            number_length += 1
+    number = first if number_length == 1 else first & (0xFF >> (number_length + 1))
+    for byte in data[pos + 5:pos + 4 + number_length]:
+        number = number << 6 | byte & 0x3F
+    block_code, rate_code = data[pos + 2] >> 4, data[pos + 2] & 0xF
+    extra = (block_code == 6) + 2 * (block_code == 7) + (rate_code == 12) + 2 * (rate_code in (13, 14))
+    return 4 + number_length + extra + 1, number, number_length
+
+def flac_audio_offset(data):
+    """Offset of the first frame, after the fLaC marker and metadata blocks"""
+    if data[:4] != b'fLaC':
+        raise RuntimeError("Not a FLAC stream")
+    pos = 4
+    while True:
+        last = data[pos] & 0x80
+        pos += 4 + int.from_bytes(data[pos + 1:pos + 4], 'big')
+        if last:
+            return pos
+
+def flac_frames(data):
+    """Yield (offset, size) of every frame of a fixed-block-size FLAC stream.
+
+    Frames have no length field, so the next frame is the next sync code
+    whose header matches this stream's layout, carries the next frame
+    number and passes its CRC-8.
+    """
+    pos = flac_audio_offset(data)
+    layout = data[pos + 2] & 0x0F, data[pos + 3]
+    expected = 0
+    while pos < len(data):
+        header_length, number, _ = flac_frame_header(data, pos)
+        if number != expected:
+            raise RuntimeError(f"FLAC frame {expected} missing at byte {pos}")
+        end = pos + header_length
+        while True:
+            end = data.find(b'\xff\xf8', end)
+            if end < 0 or end + 6 > len(data):
+                end = len(data)
+                break
+            if (data[end + 2] & 0x0F, data[end + 3]) == layout:
+                candidate_length, candidate, _ = flac_frame_header(data, end)
+                if candidate == expected + 1 and flac_crc8(data[end:end + candidate_length - 1]) == data[end + candidate_length - 1]:
+                    break
+            end += 1
+        yield pos, end - pos
+        pos = end
+        expected += 1
+
+def join_flac_pieces(pieces, output_path):
+    """Join FLAC files of consecutive ranges into one stream.
+
+    ``pieces`` are (path, first_frame) pairs; each piece was encoded on its
+    own with FLAC_BLOCK_SAMPLES blocks, so its frames are renumbered to
+    start at ``first_frame``. Only the changed header bytes go through the
+    CRCs: CRC-16 is linear, so the new frame CRC is the old one plus the
+    header difference carried over the unchanged frame body.
+    """
+    total_samples = 0
+    with open(output_path, 'wb') as out:
+        for index, (path, first_frame) in enumerate(pieces):
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                audio_offset = flac_audio_offset(data)
+                streaminfo = bytearray(data[8:42])
+                total_samples += int.from_bytes(streaminfo[13:18], 'big') & 0xFFFFFFFFF
+                if index == 0:
+                    # STREAMINFO as the only metadata block; sizes are patched below
+                    out.write(b'fLaC' + bytes([0x80]) + (34).to_bytes(3, 'big') + streaminfo)
+                    first_info = streaminfo
+                if first_frame == 0:
+                    for offset in range(audio_offset, len(data), IO_CHUNK_BYTES):
+                        out.write(data[offset:offset + IO_CHUNK_BYTES])
+                    continue
+                for pos, size in flac_frames(data):
+                    header_length, number, number_length = flac_frame_header(data, pos)
+                    old_header = data[pos:pos + header_length]
+                    new_header = bytearray(
+                        data[pos:pos + 4] + flac_utf8(first_frame + number)
+                        + data[pos + 4 + number_length:pos + header_length - 1]
+                    )
+                    new_header.append(flac_crc8(new_header))
+                    body = size - header_length - 2
+                    delta = flac_crc16(old_header) ^ flac_crc16(new_header)
+                    crc = int.from_bytes(data[pos + size - 2:pos + size], 'big') ^ _gf2_mulmod16(delta, _crc16_zeros(body))
+                    out.write(new_header)
+                    out.write(data[pos + header_length:pos + size - 2])
+                    out.write(crc.to_bytes(2, 'big'))
+
+        # Frame sizes and MD5 are left unknown (zero), as the spec allows
+        first_info[4:10] = bytes(6)
+        total = int.from_bytes(first_info[10:18], 'big') & ~0xFFFFFFFFF | total_samples
+        first_info[10:18] = total.to_bytes(8, 'big')
+        first_info[18:34] = bytes(16)
+        out.seek(8)
+        out.write(first_info)
+
+WAV_HEADER_BYTES = 80
+
+def write_wav_header(out, data_bytes, sample_rate, channels, sample_bytes):
+    """Write a PCM WAV header, switching to RF64 when the data exceeds 4 GiB.
+
+    Both layouts are WAV_HEADER_BYTES long (small files carry a JUNK chunk
+    where RF64 has its ds64 chunk), so a streamed file can be written with a
+    placeholder header and patched in place once its length is known.
+    """
+    block_align = channels * sample_bytes
+    fmt_chunk = b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, sample_bytes * 8)
+    riff_bytes = WAV_HEADER_BYTES - 8 + data_bytes
+    if riff_bytes < 0xFFFFFFFF:
+        out.write(b'RIFF' + struct.pack('<I', riff_bytes) + b'WAVE' + b'JUNK' + struct.pack('<I', 28) + bytes(28) + fmt_chunk)
+        out.write(b'data' + struct.pack('<I', data_bytes))
+        return
+    ds64_chunk = b'ds64' + struct.pack('<IQQQI', 28, riff_bytes, data_bytes, data_bytes // block_align, 0)
+    out.write(b'RF64' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE' + ds64_chunk + fmt_chunk)
+    out.write(b'data' + struct.pack('<I', 0xFFFFFFFF))
+
+def remux_adts_to_m4a(adts_path, output_path, total_samples, sample_rate, on_progress=None, cancel_event=None):
+    """Move a joined ADTS stream into an M4A container without re-encoding.
+
+    Packets are shifted back by the encoder's priming and the last one is
+    shortened to the end padding, so the edit list (in a movie timescale of
+    ``sample_rate``) plays exactly ``total_samples``.
+    """
+    frames = adts_frame_count(adts_path)
+    padding = frames * OUTPUT_FORMATS["m4a"]["frame_samples"] - AAC_PRIMING_SAMPLES - total_samples
+    if not 0 <= padding < OUTPUT_FORMATS["m4a"]["frame_samples"]:
+        raise RuntimeError(f"M4A remux failed: {frames} AAC frames do not hold {total_samples} samples")
+    # setts works in the demuxer's time base; TB converts samples to it
+    retime = (
+        f"setts=ts=TS-{AAC_PRIMING_SAMPLES}/({sample_rate}*TB)"
+        f":duration=if(eq(N\\,{frames - 1})\\,DURATION-{padding}/({sample_rate}*TB)\\,DURATION)"
+    )
+    cmd = [
+        'ffmpeg', '-v', 'error', '-f', 'aac', '-i', adts_path,
+        '-c', 'copy', '-bsf:a', f"aac_adtstoasc,{retime}", '-map_metadata', '-1',
+        '-movie_timescale', str(sample_rate), '-f', 'mp4', '-y', output_path
+    ]
+    result = run_ffmpeg(cmd, total_samples / sample_rate, on_progress, cancel_event)
+    if result.returncode != 0:
+        raise RuntimeError(f"M4A remux failed: {result.stderr[:200]}")
+
+def lame_crc16(data):
+    """CRC-16/ARC, which guards the LAME tag"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def remux_mp3_gapless(mp3_path, output_path, total_samples, sample_rate, on_progress=None, cancel_event=None):
+    """Copy joined MP3 frames into ``output_path`` behind a LAME Info frame.
+
+    FFmpeg's muxer writes the Info frame (frame count, seek table, music CRC)
+    but only knows the encoder delay of streams it encoded itself, so the
+    delay and end padding that trim playback to ``total_samples`` are
+    patched into its LAME tag afterwards, with the tag's CRC.
+    """
+    cmd = [
+        'ffmpeg', '-v', 'error', '-f', 'mp3', '-i', mp3_path,
+        '-c', 'copy', '-map_metadata', '-1', '-write_xing', '1', '-f', 'mp3', '-y', output_path
+    ]
+    result = run_ffmpeg(cmd, total_samples / sample_rate, on_progress, cancel_event)
+    if result.returncode != 0:
+        raise RuntimeError(f"MP3 remux failed: {result.stderr[:200]}")
+
+    with open(output_path, 'r+b') as f:
+        start = 0
+        head = f.read(10)
+        if head[:3] == b'ID3':
+            start = 10 + sum((byte & 0x7F) << (7 * (3 - n)) for n, byte in enumerate(head[6:10]))
+        f.seek(start)
+        frame = bytearray(f.read(200))
+        mono = frame[3] >> 6 == 3
+        tag = 4 + (17 if mono else 32)
+        if frame[tag:tag + 4] not in (b'Info', b'Xing'):
+            raise RuntimeError("MP3 remux wrote no Info frame")
+        flags, frames = struct.unpack('>II', frame[tag + 4:tag + 12])
+        # The LAME tag follows the frame count, byte count, seek table and quality fields
+        lame = tag + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+        padding = frames * OUTPUT_FORMATS["mp3"]["frame_samples"] - MP3_ENCODER_DELAY - total_samples
+        if not flags & 1 or not 0 <= padding < 4096:
+            raise RuntimeError(f"MP3 remux failed: {frames} frames do not hold {total_samples} samples")
+        frame[lame + 21:lame + 24] = (MP3_ENCODER_DELAY << 12 | padding).to_bytes(3, 'big')
+        frame[lame + 34:lame + 36] = lame_crc16(frame[:lame + 34]).to_bytes(2, 'big')
+        f.seek(start)
+        f.write(frame[:lame + 36])
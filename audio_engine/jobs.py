@@ -0,0 +1,106 @@
+"""Background render jobs that outlive the request that started them.
+
+A Streamlit script run is interrupted and restarted by every widget
+interaction, so a render tied to it is lost on the first click. Jobs
+instead run on a process-wide executor and callers keep only the job's ID,
+polling its progress and fetching its result whenever they rerun or
+reconnect. Finished jobs are kept for JOB_TTL_SECONDS. Submitting the same
+work again while it is still running returns the running job.
+"""
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .ffmpeg import FFmpegCancelled
+
+# Threads only wait on FFmpeg and the scheduler, which limits how many renders run at once
+JOB_THREADS = int(os.environ.get("AUDIO_JOB_THREADS", "32"))
+JOB_TTL_SECONDS = 6 * 60 * 60
+
+class Job:
+    """State of one background job, written by its worker and read by pollers"""
+
+    def __init__(self, job_id, key, info):
+        self.id = job_id
+        self.key = key
+        self.info = info
+        self.state = "queued"
+        self.percent = 0
+        self.message = "Waiting to start"
+        # Free-form progress beyond percent/message, e.g. per-file status of a batch
+        self.detail = {}
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def update(self, percent, message):
+        """Progress callback for the job's work"""
+        self.percent = percent
+        self.message = message
+
+    def cancel(self):
+        self.cancel_event.set()
+
+class JobManager:
+    """Run ``work(job)`` callables in the background and look them up by ID"""
+
+    def __init__(self, max_threads=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_threads or JOB_THREADS, thread_name_prefix="job")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, work, key=None, info=None):
+        """Start ``work(job)`` and return the Job; its return value becomes ``job.result``.
+
+        If an unfinished job with the same ``key`` exists, that job is returned instead.
+        """
+        with self.lock:
+            self._expire()
+            if key is not None:
+                for job in self.jobs.values():
+                    if job.key == key and not job.done:
+                        return job
+            job = Job(secrets.token_urlsafe(8), key, info or {})
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, work)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job, work):
+        job.state = "running"
+        try:
+            job.result = work(job)
+            state = "done"
+        except Exception as e:
+            job.error = str(e)
+            state = "cancelled" if job.cancel_event.is_set() or isinstance(e, FFmpegCancelled) else "failed"
+        # Pollers and _expire read ``finished`` as soon as the job is done
+        job.finished = time.time()
+        job.state = state
+
+    def _expire(self):
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for job_id in [i for i, job in self.jobs.items() if job.done and job.finished < cutoff]:
+            del self.jobs[job_id]
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """The JobManager shared by every session in this process"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,287 @@
+"""Per-job stage timings and resource use, as a JSON Lines log and Prometheus metrics.
+
+A job (one extend or combine render) runs inside ``job_trace``; ``stage``
+blocks inside it time each step, and every FFmpeg run records the CPU time
+and peak RSS of its process (from ``os.wait4``), its speed and the bytes
+of its input and output files. Cache lookups count hits and misses. A
+finished job is appended to METRICS_LOG and added to process-wide totals
+that are rewritten to METRICS_PROM_FILE in the Prometheus text format
+(``prometheus_text()`` returns the same text for an HTTP endpoint).
+Outside a job trace all of this is a no-op. The trace follows the job into
+worker threads that are started with ``contextvars.copy_context().run``.
+
+UI script runs are timed too (``record_rerun``), against RERUN_BUDGET_SECONDS:
+a rerun happens on every widget change, so it should only do constant-time work.
+"""
+import contextvars
+import functools
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get("AUDIO_METRICS", "1") != "0"
+METRICS_DIR = os.environ.get("AUDIO_METRICS_DIR", os.path.join(tempfile.gettempdir(), "audio_editor_metrics"))
+METRICS_LOG = os.path.join(METRICS_DIR, "jobs.jsonl")
+METRICS_PROM_FILE = os.path.join(METRICS_DIR, "audio_engine.prom")
+JOB_SECONDS_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+RERUN_BUDGET_SECONDS = float(os.environ.get("AUDIO_RERUN_BUDGET_SECONDS", "0.25"))
+RERUN_SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+_trace = contextvars.ContextVar("audio_job_trace", default=None)
+_stage = contextvars.ContextVar("audio_job_stage", default=None)
+
+class JobTrace:
+    """Stages, FFmpeg runs and cache lookups of one job"""
+
+    def __init__(self, kind, labels):
+        self.id = secrets.token_hex(6)
+        self.kind = kind
+        self.labels = labels
+        self.status = "ok"
+        self.message = ""
+        self.started = time.time()
+        self.stages = []
+        self.cache = {}
+        self._clock = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.stages.append(record)
+
+    def count_cache(self, name, hit):
+        with self._lock:
+            counts = self.cache.setdefault(name, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def summary(self):
+        runs = [record for record in self.stages if record["stage"] == "ffmpeg"]
+        return {
+            "job": self.id, "kind": self.kind, **self.labels, "status": self.status, "message": self.message,
+            "started": round(self.started, 3), "seconds": round(time.perf_counter() - self._clock, 4),
+            "ffmpeg_runs": len(runs),
+            "ffmpeg_cpu_seconds": round(sum(r["cpu_user"] + r["cpu_system"] for r in runs), 3),
+            "ffmpeg_peak_rss_bytes": max((r["max_rss_bytes"] for r in runs), default=0),
+            "bytes_in": sum(r.get("bytes_in", 0) for r in runs),
+            "bytes_out": sum(r.get("bytes_out", 0) for r in runs),
+            "cache": self.cache,
+            "stages": self.stages,
+        }
+
+@contextmanager
+def job_trace(kind, **labels):
+    """Trace the block as one job of ``kind``; inside another job it only joins that one"""
+    current = _trace.get()
+    if current is not None:
+        yield current
+        return
+    trace = JobTrace(kind, labels)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.status, trace.message = "error", str(e) or type(e).__name__
+        raise
+    finally:
+        _trace.reset(token)
+        _finish(trace)
+
+def traced(kind):
+    """Decorator running a job function that returns (success, message) under ``job_trace``"""
+    def decorate(function):
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            with job_trace(kind) as trace:
+                success, message = function(*args, **kwargs)
+                if not success:
+                    trace.status, trace.message = "failed", message
+                return success, message
+        return run
+    return decorate
+
+@contextmanager
+def stage(name, **fields):
+    """Time the block as stage ``name``; yields the record so callers can add fields"""
+    trace = _trace.get()
+    record = {"stage": name, **fields}
+    if trace is None:
+        yield record
+        return
+    parent = _stage.get()
+    if parent:
+        record["parent"] = parent
+    token = _stage.set(name)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        _stage.reset(token)
+        record["seconds"] = round(time.perf_counter() - started, 4)
+        trace.add(record)
+
+def record_stage(name, seconds, **fields):
+    """Add a stage that was timed elsewhere (e.g. before the job started)"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add({"stage": name, "seconds": round(seconds, 4), **fields})
+
+def record_cache(name, hit):
+    trace = _trace.get()
+    if trace is not None:
+        trace.count_cache(name, hit)
+
+def _file_bytes(paths):
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except (OSError, TypeError):
+            pass
+    return total
+
+def record_ffmpeg(cmd, seconds, rusage, media_seconds=None, reported_speed=None):
+    """Add one finished FFmpeg run with its resource use.
+
+    ``rusage`` comes from ``os.wait4`` of the process; ``media_seconds`` is
+    how much output it produced, for the speed factor. ``reported_speed`` is
+    the ``speed=`` of FFmpeg's last progress block, kept as ``ffmpeg_speed``.
+    Input and output sizes are read from the ``-i`` and ``-y`` paths of ``cmd``.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return
+    inputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == '-i']
+    outputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == '-y']
+    record = {
+        "stage": "ffmpeg", "seconds": round(seconds, 4),
+        "cpu_user": round(rusage.ru_utime, 3) if rusage else 0.0,
+        "cpu_system": round(rusage.ru_stime, 3) if rusage else 0.0,
+        # Linux reports ru_maxrss in KiB
+        "max_rss_bytes": rusage.ru_maxrss * 1024 if rusage else 0,
+        "bytes_in": _file_bytes(path for path in inputs if not path.startswith(('-', 'pipe:'))),
+        "bytes_out": _file_bytes(outputs),
+    }
+    if media_seconds and seconds > 0:
+        record["speed"] = round(media_seconds / seconds, 2)
+    if reported_speed:
+        record["ffmpeg_speed"] = reported_speed
+    parent = _stage.get()
+    if parent:
+        record["parent"] = parent
+    trace.add(record)
+
+# Process-wide totals behind the Prometheus text
+_totals = {
+    "jobs": {}, "job_seconds": {}, "job_buckets": {}, "stage_seconds": {}, "stage_runs": {},
+    "cache": {}, "ffmpeg_runs": 0, "ffmpeg_cpu_user": 0.0, "ffmpeg_cpu_system": 0.0,
+    "ffmpeg_peak_rss_bytes": 0, "bytes_in": 0, "bytes_out": 0,
+    "rerun_buckets": [0] * (len(RERUN_SECONDS_BUCKETS) + 1), "rerun_seconds": 0.0, "reruns_over_budget": 0,
+}
+_totals_lock = threading.Lock()
+
+def record_rerun(seconds):
+    """Count one UI script run; returns False if it took longer than RERUN_BUDGET_SECONDS"""
+    within = seconds <= RERUN_BUDGET_SECONDS
+    with _totals_lock:
+        for n, bound in enumerate(RERUN_SECONDS_BUCKETS + (float("inf"),)):
+            if seconds <= bound:
+                _totals["rerun_buckets"][n] += 1
+        _totals["rerun_seconds"] += seconds
+        _totals["reruns_over_budget"] += not within
+    return within
+
+def _finish(trace):
+    summary = trace.summary()
+    with _totals_lock:
+        jobs = _totals["jobs"]
+        jobs[(trace.kind, trace.status)] = jobs.get((trace.kind, trace.status), 0) + 1
+        _totals["job_seconds"][trace.kind] = _totals["job_seconds"].get(trace.kind, 0.0) + summary["seconds"]
+        buckets = _totals["job_buckets"].setdefault(trace.kind, [0] * (len(JOB_SECONDS_BUCKETS) + 1))
+        for n, bound in enumerate(JOB_SECONDS_BUCKETS + (float("inf"),)):
+            if summary["seconds"] <= bound:
+                buckets[n] += 1
+        for record in trace.stages:
+            name = record["stage"]
+            _totals["stage_seconds"][name] = _totals["stage_seconds"].get(name, 0.0) + record["seconds"]
+            _totals["stage_runs"][name] = _totals["stage_runs"].get(name, 0) + 1
+            if name == "ffmpeg":
+                _totals["ffmpeg_runs"] += 1
+                _totals["ffmpeg_cpu_user"] += record["cpu_user"]
+                _totals["ffmpeg_cpu_system"] += record["cpu_system"]
+                _totals["ffmpeg_peak_rss_bytes"] = max(_totals["ffmpeg_peak_rss_bytes"], record["max_rss_bytes"])
+        for name, counts in trace.cache.items():
+            for result, count in counts.items():
+                _totals["cache"][(name, result)] = _totals["cache"].get((name, result), 0) + count
+        _totals["bytes_in"] += summary["bytes_in"]
+        _totals["bytes_out"] += summary["bytes_out"]
+        text = _prometheus_text_locked()
+
+    if not METRICS_ENABLED:
+        return
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with _totals_lock:
+            with open(METRICS_LOG, 'a') as f:
+                f.write(json.dumps(summary) + "\n")
+        tmp_path = f"{METRICS_PROM_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, METRICS_PROM_FILE)
+    except OSError:
+        pass  # Metrics never fail a render
+
+def _prometheus_text_locked():
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric("audio_jobs_total", "counter", "Finished jobs by kind and status",
+           [((("kind", kind), ("status", status)), count) for (kind, status), count in sorted(_totals["jobs"].items())])
+    histogram = []
+    for kind, buckets in sorted(_totals["job_buckets"].items()):
+        for bound, count in zip(JOB_SECONDS_BUCKETS + ("+Inf",), buckets):
+            histogram.append(((("kind", kind), ("le", bound)), count))
+    lines.append("# HELP audio_job_duration_seconds Wall time of finished jobs")
+    lines.append("# TYPE audio_job_duration_seconds histogram")
+    for labels, count in histogram:
+        lines.append("audio_job_duration_seconds_bucket{" + ",".join(f'{k}="{v}"' for k, v in labels) + f"}} {count}")
+    for kind, seconds in sorted(_totals["job_seconds"].items()):
+        lines.append(f'audio_job_duration_seconds_sum{{kind="{kind}"}} {seconds:.3f}')
+        lines.append(f'audio_job_duration_seconds_count{{kind="{kind}"}} {_totals["job_buckets"][kind][-1]}')
+    lines.append("# HELP audio_rerun_duration_seconds Wall time of UI script runs")
+    lines.append("# TYPE audio_rerun_duration_seconds histogram")
+    for bound, count in zip(RERUN_SECONDS_BUCKETS + ("+Inf",), _totals["rerun_buckets"]):
+        lines.append(f'audio_rerun_duration_seconds_bucket{{le="{bound}"}} {count}')
+    lines.append(f'audio_rerun_duration_seconds_sum {_totals["rerun_seconds"]:.4f}')
+    lines.append(f'audio_rerun_duration_seconds_count {_totals["rerun_buckets"][-1]}')
+    metric("audio_reruns_over_budget_total", "counter", f"UI script runs slower than {RERUN_BUDGET_SECONDS}s",
+           [((), _totals["reruns_over_budget"])])
+    metric("audio_stage_seconds_total", "counter", "Wall time spent per stage",
+           [((("stage", name),), f"{seconds:.3f}") for name, seconds in sorted(_totals["stage_seconds"].items())])
+    metric("audio_stage_runs_total", "counter", "Times each stage ran",
+           [((("stage", name),), count) for name, count in sorted(_totals["stage_runs"].items())])
+    metric("audio_ffmpeg_runs_total", "counter", "FFmpeg processes run by jobs", [((), _totals["ffmpeg_runs"])])
+    metric("audio_ffmpeg_cpu_seconds_total", "counter", "CPU time of FFmpeg processes",
+           [((("mode", "user"),), f"{_totals['ffmpeg_cpu_user']:.3f}"),
+            ((("mode", "system"),), f"{_totals['ffmpeg_cpu_system']:.3f}")])
+    metric("audio_ffmpeg_peak_rss_bytes", "gauge", "Largest peak RSS of any FFmpeg process",
+           [((), _totals["ffmpeg_peak_rss_bytes"])])
+    metric("audio_ffmpeg_bytes_total", "counter", "Bytes of FFmpeg input and output files",
+           [((("direction", "in"),), _totals["bytes_in"]), ((("direction", "out"),), _totals["bytes_out"])])
+    metric("audio_cache_requests_total", "counter", "Cache lookups by cache and result",
+           [((("cache", name), ("result", result)), count) for (name, result), count in sorted(_totals["cache"].items())])
+    return "\n".join(lines) + "\n"
+
+def prometheus_text():
+    """Process-wide job metrics in the Prometheus text exposition format"""
+    with _totals_lock:
+        return _prometheus_text_locked()
@@ -0,0 +1,159 @@
+"""Decoding sources once into the shared PCM cache"""
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+
+from .cache import shared_cache
+from .ffmpeg import FFmpegCancelled, get_audio_info, run_ffmpeg
+from .formats import MP3_SAMPLE_RATES, IO_CHUNK_BYTES, get_wav_info
+from .metrics import stage
+from .utils import stage_progress
+
+def decode_to_wav(input_path, wav_path, sample_rate, channels, expected_seconds=None, on_progress=None, cancel_event=None):
+    """Decode any supported input to 16-bit PCM WAV once"""
+    cmd = [
+        'ffmpeg', '-v', 'error', '-i', input_path, '-vn', '-bitexact',
+        '-map_metadata', '-1', '-ar', str(sample_rate), '-ac', str(channels),
+        '-c:a', 'pcm_s16le', '-y', wav_path
+    ]
+    result = run_ffmpeg(cmd, expected_seconds, on_progress, cancel_event)
+    if result.returncode != 0:
+        raise RuntimeError(f"Decode failed: {result.stderr[:200]}")
+
+# Decoded sources live in a shared PCM cache keyed by the source's content
+# hash; bump PCM_FORMAT_VERSION if canonical_pcm_format changes
+PCM_CACHE_DIR = os.environ.get("AUDIO_PCM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "audio_editor_pcm"))
+PCM_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_PCM_CACHE_MAX_BYTES", str(5 * 1024**3)))
+PCM_FORMAT_VERSION = 1
+# Sources decoded ahead of their render, e.g. while the user is still choosing settings
+PREFETCH_THREADS = int(os.environ.get("AUDIO_PREFETCH_THREADS", "2"))
+PREFETCH_POLL_SECONDS = 0.5
+
+def get_pcm_cache():
+    """One decoded-source cache shared by every session in this process"""
+    return shared_cache(PCM_CACHE_DIR, PCM_CACHE_MAX_BYTES, "pcm")
+
+def hash_file(path):
+    """sha256 of a file, read in chunks"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(IO_CHUNK_BYTES), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def canonical_pcm_format(info):
+    """Sample rate and channel count every render of this source works in"""
+    sample_rate = info['sample_rate'] if info['sample_rate'] in MP3_SAMPLE_RATES else 44100
+    return sample_rate, min(info['channels'], 2)
+
+def ingest_source(input_path, source_hash=None, pcm_cache=None, progress_callback=None, cancel_event=None, pcm_format=None):
+    """Decode a source once into the shared PCM cache and describe the result.
+
+    The first call for a given source probes and decodes it to canonical
+    16-bit WAV; every later render, analysis or re-render of the same bytes
+    (at any duration or output format) reuses that file without running
+    ffprobe or a decoder. ``pcm_format`` forces a (sample_rate, channels)
+    layout, e.g. so tracks being combined share one. Returns the WAV info
+    plus ``path``, ``sha256`` and whether it was a cache hit.
+    """
+    with stage("ingest") as record:
+        if source_hash:
+            _wait_for_prefetch(source_hash, progress_callback, cancel_event)
+        source = _ingest_source(input_path, source_hash, pcm_cache, progress_callback, cancel_event, pcm_format)
+        record.update(cached=source['cached'], frames=source['frames'])
+    return source
+
+def _ingest_source(input_path, source_hash, pcm_cache, progress_callback, cancel_event, pcm_format):
+    pcm_cache = pcm_cache or get_pcm_cache()
+    if not source_hash:
+        with stage("hash"):
+            source_hash = hash_file(input_path)
+    key = hashlib.sha256(f"pcm-v{PCM_FORMAT_VERSION}:{source_hash}".encode()).hexdigest()
+    forced_key = pcm_format and hashlib.sha256(f"pcm-v{PCM_FORMAT_VERSION}:{source_hash}:{pcm_format[0]}x{pcm_format[1]}".encode()).hexdigest()
+
+    path = pcm_cache.get(key, "wav")
+    if pcm_format and path:
+        info = get_wav_info(path)
+        if (info['sample_rate'], info['channels']) != tuple(pcm_format):
+            path = None
+    if pcm_format and not path:
+        path = pcm_cache.get(forced_key, "wav")
+    cached = path is not None
+    if not cached:
+        info = get_audio_info(input_path)
+        if not info:
+            raise RuntimeError("Could not analyze audio file")
+        sample_rate, channels = canonical_pcm_format(info)
+        if pcm_format and tuple(pcm_format) != (sample_rate, channels):
+            key = forced_key
+            sample_rate, channels = pcm_format
+
+        if progress_callback:
+            progress_callback(15, "🎚️ Decoding source once...")
+        tmp_path = pcm_cache.reserve(key, "wav")
+        try:
+            decode_to_wav(
+                input_path, tmp_path, sample_rate, channels, info['duration'],
+                stage_progress(progress_callback, 15, 30, "🎚️ Decoding source"), cancel_event
+            )
+            path = pcm_cache.commit(key, "wav", tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    source = get_wav_info(path)
+    source.update({"path": path, "sha256": source_hash, "cached": cached})
+    return source
+
+_prefetches = {}
+_prefetch_executor = None
+_prefetch_lock = threading.Lock()
+
+def prefetch_source(input_path, source_hash):
+    """Start ingesting a source into the PCM cache in the background and return the Future.
+
+    A render of the same source that starts meanwhile waits for it in
+    ingest_source rather than decoding a second copy. Prefetches run on
+    PREFETCH_THREADS threads outside the job scheduler and are not cancelled.
+    """
+    global _prefetch_executor
+    with _prefetch_lock:
+        future = _prefetches.get(source_hash)
+        if future is not None:
+            return future
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_THREADS, thread_name_prefix="prefetch")
+        future = _prefetch_executor.submit(_ingest_source, input_path, source_hash, None, None, None, None)
+        _prefetches[source_hash] = future
+
+    def forget(done):
+        with _prefetch_lock:
+            if _prefetches.get(source_hash) is done:
+                del _prefetches[source_hash]
+
+    future.add_done_callback(forget)
+    return future
+
+def _wait_for_prefetch(source_hash, progress_callback, cancel_event):
+    """Block until a running prefetch of ``source_hash`` is done; its errors are left to the caller's own ingest"""
+    with _prefetch_lock:
+        future = _prefetches.get(source_hash)
+    if future is None or future.done():
+        return
+    with stage("prefetch_wait"):
+        if progress_callback:
+            progress_callback(15, "🎚️ Finishing the decode started on upload...")
+        while not wait([future], PREFETCH_POLL_SECONDS).done:
+            if cancel_event is not None and cancel_event.is_set():
+                raise FFmpegCancelled("Processing cancelled")
+
+def load_pcm(wav_path):
+    """Read-only numpy.memmap of a cached 16-bit WAV, shaped (frames, channels)"""
+    info = get_wav_info(wav_path)
+    return np.memmap(
+        wav_path, dtype='<i2', mode='r', offset=info['data_offset'],
+        shape=(info['frames'], info['channels'])
+    )
@@ -0,0 +1,577 @@
+"""Extending a source by looping one seamless, stream-copied unit"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+
+from .analysis import SEAM_METHODS, find_loop_points, get_loudness, normalization_gain_db, plan_seam
+from .cache import cache_lease
+from .chunks import ENCODE_WORKERS, chunk_count, encode_chunked
+from .ffmpeg import FFmpegCancelled, FFmpegStalled, run_ffmpeg
+from .formats import (
+    FADE_OUT_SECONDS, OUTPUT_FORMATS, concat_segments, copy_frames, encoder_args,
+    estimate_output_bytes, get_wav_info, remux_adts_to_m4a, remux_mp3_gapless, write_segments, write_wav_header,
+)
+from .metrics import stage, traced
+from .pcm import ingest_source
+from .scheduler import PRIORITY_BATCH, JobRejected
+from .utils import format_duration, stage_progress
+from .workspace import Workspace
+
+# Seconds of audio kept either side of the seam and before the fade-out in previews
+PREVIEW_CONTEXT_SECONDS = 4
+# Loop units up to this long are looped in memory by aloop; longer ones are
+# read back from the cached PCM at offsets, so no window buffers a whole unit
+LOOP_BUFFER_SECONDS = 60
+PREVIEW_QUALITY = "192k"
+
+def plan_loop(total_samples, sample_rate, crossfade_duration, frame_samples=1, loop_start=0, loop_end=None):
+    """Choose a loop unit length that is a whole number of encoder frames.
+
+    The source plays from the top, then loops back from ``loop_end`` (the
+    end of the file by default) to ``loop_start``. The loop unit is the
+    crossfaded seam followed by the untouched middle of that span. Its
+    length is rounded down to a multiple of ``frame_samples`` by stretching
+    the crossfade by less than one frame, so every repeat of the unit starts
+    on the same frame boundary and can be stream-copied. Each output format
+    gets its own plan (see loop_frame_samples), so the stretch is at most one
+    frame of that format; the returned ``crossfade_samples`` is the one used.
+    """
+    loop_end = total_samples if loop_end is None else loop_end
+    span = loop_end - loop_start
+    crossfade_samples = min(int(round(crossfade_duration * sample_rate)), span // 2)
+    loop_samples = (span - crossfade_samples) // frame_samples * frame_samples
+    if loop_samples < frame_samples or span - loop_samples > loop_samples:
+        return None
+    return {
+        "loop_samples": loop_samples,
+        "crossfade_samples": span - loop_samples,
+        "loop_start": loop_start,
+        "intro_samples": loop_start + loop_samples,
+        "sample_rate": sample_rate,
+    }
+
+def loop_frame_samples(output_format):
+    """Frame size the loop unit of ``output_format`` is snapped to (1 unless it is stream-copied)"""
+    spec = OUTPUT_FORMATS[output_format]
+    return spec['frame_samples'] if spec['splice'] else 1
+
+def plan_extend(source, crossfade_duration, method, frame_samples=1, normalize=False, progress_callback=None, cancel_event=None):
+    """Loop plan of an ingested source with its seam and normalization gain; None if too short"""
+    loop_points = {}
+    if SEAM_METHODS[method].get('loop_search'):
+        if progress_callback:
+            progress_callback(32, "🎯 Finding phase-aligned loop points...")
+        points = find_loop_points(source, crossfade_duration, frame_samples)
+        loop_points = {"loop_start": points["loop_start"], "loop_end": points["loop_end"]}
+    plan = plan_loop(source['frames'], source['sample_rate'], crossfade_duration, frame_samples, **loop_points)
+    if not plan:
+        return None
+    plan = plan_seam(method, source, plan)
+    if loop_points:
+        plan['loop_points_found'] = points["score"] is not None
+    if normalize:
+        if progress_callback:
+            progress_callback(34, "📏 Measuring loudness...")
+        plan['gain_db'] = normalization_gain_db(get_loudness(
+            source, on_progress=stage_progress(progress_callback, 34, 40, "📏 Measuring loudness"),
+            cancel_event=cancel_event
+        ))
+    return plan
+
+def loop_points_note(plan):
+    """Message suffix when the phase-aligned search fell back to looping the whole file"""
+    if plan.get('loop_points_found') is False:
+        return ", no phase-aligned loop points found (looped the whole file)"
+    return ""
+
+def build_loop_filter(plan, windows):
+    """Build one filter graph that renders several windows of the looped timeline.
+
+    The timeline is the intro (first play of the source) followed by the
+    crossfaded loop unit repeated forever with ``aloop``; the seam comes from
+    the plan's method (see SEAM_METHODS). Each window is a
+    (start, end, fade) tuple in timeline samples, where ``fade`` is an
+    optional (start_sample, nb_samples) fade-out, and becomes output label
+    ``[w{index}]``. The graph has the same size for 2 loops or 2000, and
+    windows past the intro seek into the unit, so the samples processed
+    depend on the window lengths only.
+    """
+    loop = plan['loop_samples']
+    xfade = plan['crossfade_samples']
+    intro = plan['intro_samples']
+    loop_start = plan['loop_start']
+    method = plan.get('method', "basic_crossfade")
+    seam = plan.get('seam', {"curve": SEAM_METHODS[method]['curve']})
+    needs_intro = [start < intro for start, _, _ in windows]
+
+    gain = f"volume={plan['gain_db']}dB," if plan.get('gain_db') else ""
+    parts = [
+        f"[0:a]{gain}asplit={3 + sum(needs_intro)}[t][h][m]" + "".join(f"[i{n}]" for n in range(sum(needs_intro))),
+        f"[t]atrim=start_sample={intro}:end_sample={intro + xfade},asetpts=PTS-STARTPTS[tail]",
+        f"[h]atrim=start_sample={loop_start}:end_sample={loop_start + xfade},asetpts=PTS-STARTPTS[head]",
+        SEAM_METHODS[method]['build'](xfade, plan['sample_rate'], seam),
+        f"[m]atrim=start_sample={loop_start + xfade}:end_sample={intro},asetpts=PTS-STARTPTS[middle]",
+        f"[seam][middle]concat=n=2:v=0:a=1,asplit={len(windows)}" + "".join(f"[u{n}]" for n in range(len(windows))),
+    ]
+
+    intro_index = 0
+    for n, (start, end, fade) in enumerate(windows):
+        if needs_intro[n]:
+            chain = (
+                f"[i{intro_index}]atrim=end_sample={intro}[intro{n}];"
+                f"[u{n}]aloop=loop=-1:size={loop}[loop{n}];"
+                f"[intro{n}][loop{n}]concat=n=2:v=0:a=1,atrim=start_sample={start}:end_sample={end}"
+            )
+            intro_index += 1
+        else:
+            offset = (start - intro) % loop
+            chain = f"[u{n}]aloop=loop=-1:size={loop},atrim=start_sample={offset}:end_sample={offset + end - start}"
+        chain += ",asetpts=PTS-STARTPTS"
+        if fade:
+            chain += f",afade=t=out:start_sample={fade[0] - start}:nb_samples={fade[1]}"
+        parts.append(chain + f"[w{n}]")
+
+    return ";".join(parts)
+
+def encode_loop_windows(wav_path, plan, windows, outputs, on_progress=None, cancel_event=None):
+    """Encode windows of the looped timeline in one FFmpeg run.
+
+    ``outputs`` holds one (path, encoder_args) per window, so N formats share
+    a single read of the source and a single filter graph. Loop units longer
+    than LOOP_BUFFER_SECONDS go through encode_loop_excerpts instead, whose
+    memory does not grow with the unit.
+    """
+    if plan['loop_samples'] > LOOP_BUFFER_SECONDS * plan['sample_rate']:
+        encode_loop_excerpts(wav_path, plan, windows, outputs, on_progress, cancel_event)
+        return
+    cmd = ['ffmpeg', '-v', 'error', '-i', wav_path, '-filter_complex', build_loop_filter(plan, windows)]
+    for n, (output_path, args) in enumerate(outputs):
+        cmd += ['-map', f'[w{n}]', '-map_metadata', '-1'] + args + ['-y', output_path]
+    # FFmpeg reports the furthest output, i.e. the longest window
+    expected_seconds = max(end - start for start, end, _ in windows) / plan['sample_rate']
+    result = run_ffmpeg(cmd, expected_seconds, on_progress, cancel_event)
+    if result.returncode != 0:
+        raise RuntimeError(f"Segment encode failed: {result.stderr[:200]}")
+
+def loop_timeline_pieces(plan, start, end):
+    """Split [start, end) of the looped timeline into ("source", from, to) and ("seam", from, to) pieces.
+
+    Source pieces are sample ranges of the source, seam pieces ranges of the
+    crossfaded seam; played in order they are the timeline's samples.
+    """
+    intro = plan['intro_samples']
+    loop = plan['loop_samples']
+    xfade = plan['crossfade_samples']
+    pieces = []
+    position = start
+    while position < end:
+        if position < intro:
+            stop = min(end, intro)
+            pieces.append(("source", position, stop))
+        else:
+            offset = (position - intro) % loop
+            if offset < xfade:
+                stop = min(end, position + xfade - offset)
+                pieces.append(("seam", offset, offset + stop - position))
+            else:
+                stop = min(end, position + loop - offset)
+                pieces.append(("source", plan['loop_start'] + offset, plan['loop_start'] + offset + stop - position))
+        position = stop
+    return pieces
+
+def encode_loop_excerpts(wav_path, plan, windows, outputs, on_progress=None, cancel_event=None):
+    """Encode windows of the looped timeline without reading the rest of the source.
+
+    Same seam graph, gain and fade-out as build_loop_filter, but each
+    (start, end, fade) window is put together from its loop_timeline_pieces,
+    every source piece opened as raw PCM at its offset. The cost depends on
+    the window lengths only, and the pieces are streamed, where
+    build_loop_filter has to buffer a whole loop unit to seek into it. A
+    window takes two inputs per loop unit it spans.
+    """
+    info = get_wav_info(wav_path)
+    xfade = plan['crossfade_samples']
+    method = plan.get('method', "basic_crossfade")
+    seam = plan.get('seam', {"curve": SEAM_METHODS[method]['curve']})
+    gain = f"volume={plan['gain_db']}dB," if plan.get('gain_db') else ""
+    offsets = []
+
+    def read(first, count, label):
+        offsets.append(first)
+        return f"[{len(offsets) - 1}:a]{gain}atrim=end_sample={count},asetpts=PTS-STARTPTS[{label}]"
+
+    window_pieces = [loop_timeline_pieces(plan, start, end) for start, end, _ in windows]
+    seams = sum(kind == "seam" for pieces in window_pieces for kind, _, _ in pieces)
+    parts = []
+    if seams:
+        parts += [
+            read(plan['intro_samples'], xfade, "tail"),
+            read(plan['loop_start'], xfade, "head"),
+            SEAM_METHODS[method]['build'](xfade, plan['sample_rate'], seam),
+            f"[seam]asplit={seams}" + "".join(f"[z{n}]" for n in range(seams)),
+        ]
+    seam_index = 0
+    for n, ((start, _, fade), pieces) in enumerate(zip(windows, window_pieces)):
+        labels = [f"p{n}_{k}" for k in range(len(pieces))]
+        for label, (kind, first, last) in zip(labels, pieces):
+            if kind == "source":
+                parts.append(read(first, last - first, label))
+            else:
+                parts.append(f"[z{seam_index}]atrim=start_sample={first}:end_sample={last},asetpts=PTS-STARTPTS[{label}]")
+                seam_index += 1
+        chain = "".join(f"[{label}]" for label in labels) + f"concat=n={len(labels)}:v=0:a=1"
+        if fade:
+            chain += f",afade=t=out:start_sample={fade[0] - start}:nb_samples={fade[1]}"
+        parts.append(chain + f"[w{n}]")
+
+    cmd = ['ffmpeg', '-v', 'error']
+    for first in offsets:
+        cmd += [
+            '-f', 's16le', '-ar', str(info['sample_rate']), '-ac', str(info['channels']),
+            '-skip_initial_bytes', str(info['data_offset'] + first * info['channels'] * 2), '-i', wav_path,
+        ]
+    cmd += ['-filter_complex', ";".join(parts)]
+    for n, (output_path, args) in enumerate(outputs):
+        cmd += ['-map', f'[w{n}]', '-map_metadata', '-1'] + args + ['-y', output_path]
+    result = run_ffmpeg(cmd, max(end - start for start, end, _ in windows) / plan['sample_rate'], on_progress, cancel_event)
+    if result.returncode != 0:
+        raise RuntimeError(f"Excerpt encode failed: {result.stderr[:200]}")
+
+def encode_loop_passes(wav_path, passes, workers=None, on_progress=None, cancel_event=None):
+    """Run (plan, windows, outputs) encode passes side by side, ``workers`` at a time.
+
+    Each pass is one encode_loop_windows run; progress is the combined
+    fraction of all passes' window samples. The first failure is raised
+    after the running passes have finished.
+    """
+    sizes = [sum(end - start for start, end, _ in windows) for _, windows, _ in passes]
+    fractions = [0.0] * len(passes)
+    lock = threading.Lock()
+    parallel = min(len(passes), workers or ENCODE_WORKERS)
+
+    def pass_progress(index):
+        if not on_progress:
+            return None
+
+        def report(fraction, speed, eta):
+            with lock:
+                fractions[index] = fraction
+                overall = sum(f * size for f, size in zip(fractions, sizes)) / sum(sizes)
+            on_progress(overall, speed and speed * parallel, eta)
+        return report
+
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="pass") as executor:
+        # Each pass's FFmpeg run is recorded in the caller's job trace
+        futures = [
+            executor.submit(copy_context().run, encode_loop_windows, wav_path, plan, windows, outputs, pass_progress(index), cancel_event)
+            for index, (plan, windows, outputs) in enumerate(passes)
+        ]
+    for future in futures:
+        future.result()
+
+def plan_segments(plan, target_samples, fade_samples, frame_samples, margin):
+    """Lay the output out as head + repeated body block + fade-out tail.
+
+    All boundaries sit on the format's global encoder frame grid. The body
+    block is one loop unit of frames whose encoder context (``margin``
+    frames either side) lies entirely inside the looped region, so each copy
+    matches what a continuous encode would produce there. Returns None when
+    the target is too short to repeat it.
+    """
+    body_frames = plan['loop_samples'] // frame_samples
+    head_frames = -(-plan['intro_samples'] // frame_samples) + margin
+    last_clean_frame = (target_samples - fade_samples) // frame_samples - margin
+    repeats = (last_clean_frame - head_frames) // body_frames
+    if repeats < 1:
+        return None
+    return {
+        "head_frames": head_frames,
+        "body_frames": body_frames,
+        "repeats": repeats,
+        "tail_frame": head_frames + repeats * body_frames,
+    }
+
+@traced("extend")
+@cache_lease()
+def process_audio_ffmpeg(input_path, output_path, target_minutes, crossfade_duration, method="basic_crossfade", progress_callback=None, cancel_event=None, source_hash=None, output_format="mp3", quality=None, extra_outputs=(), normalize=False, encode_workers=None):
+    """Extend audio by encoding one seamless loop unit and stream-copying it.
+
+    The source is decoded once into the shared PCM cache (``source_hash``
+    skips re-hashing a file whose hash is already known). A constant-size
+    filter graph then renders the head, one crossfaded loop unit and the
+    fade-out tail, which are the only samples encoded. The full duration is
+    assembled by copying those encoded frames, so encode cost no longer grows
+    with the target duration.
+
+    ``extra_outputs`` lists more (path, format, quality) outputs rendered from
+    the same cached decode. Each format is planned on its own frame grid, so
+    its crossfade moves by less than one of its frames. Formats on the same
+    grid (WAV and FLAC) share one FFmpeg pass, saving a read of the source
+    and a filter graph; passes for different grids run side by side on up
+    to ``encode_workers`` cores. ``normalize`` applies the gain
+    from the source's cached loudness measurement in the graph. Outputs that
+    cannot be stream-copied (FLAC) are encoded as parallel time ranges when
+    long enough (see chunks.py). Setting
+    ``cancel_event`` stops the running FFmpeg step.
+    """
+
+    target_duration = target_minutes * 60
+    outputs = [(output_path, output_format, quality)] + list(extra_outputs)
+
+    try:
+        if progress_callback:
+            progress_callback(10, "🔍 Analyzing audio...")
+        source = ingest_source(input_path, source_hash, progress_callback=progress_callback, cancel_event=cancel_event)
+        source_wav = source['path']
+        sample_rate = source['sample_rate']
+        if progress_callback and source['cached']:
+            progress_callback(30, "♻️ Using cached decode of this source")
+
+        # One plan per frame grid: formats sharing a grid share the loop unit
+        plans = {}
+        with stage("plan", method=method, grids=len({loop_frame_samples(fmt) for _, fmt, _ in outputs})):
+            for _, fmt, _ in outputs:
+                frame = loop_frame_samples(fmt)
+                if frame not in plans:
+                    plans[frame] = plan_extend(source, crossfade_duration, method, frame, normalize, progress_callback, cancel_event)
+        if not all(plans.values()):
+            return False, "Audio is too short to loop with this crossfade"
+        plan = plans[loop_frame_samples(output_format)]
+
+        target_samples = int(round(target_duration * sample_rate))
+        fade_samples = min(FADE_OUT_SECONDS * sample_rate, target_samples // 2)
+        fade = (target_samples - fade_samples, fade_samples)
+        loops = target_samples / plan['loop_samples']
+        chunks = chunk_count(target_samples, sample_rate, encode_workers)
+        # Scratch holds full-length MP3/M4A joins and parallel-range encodes, and
+        # otherwise only pieces of about one loop unit
+        piece_seconds = max(p['intro_samples'] + 2 * p['loop_samples'] for p in plans.values()) / sample_rate + FADE_OUT_SECONDS
+        scratch_bytes = sum(
+            estimate_output_bytes(
+                fmt, fmt_quality, target_duration if fmt in ("mp3", "m4a") or OUTPUT_FORMATS[fmt]['chunk'] and chunks > 1 else piece_seconds,
+                sample_rate, source['channels']
+            )
+            for _, fmt, fmt_quality in outputs
+        )
+
+        with Workspace("extend", scratch_bytes) as workspace:
+            work_dir = workspace.path
+            cancel_event = workspace.guard(cancel_event)
+            # One pass per plan: formats sharing a grid share the read and graph
+            passes = {}
+            spliced_outputs = []
+            chunked_outputs = {}
+            for index, (path, fmt, fmt_quality) in enumerate(outputs):
+                spec = OUTPUT_FORMATS[fmt]
+                frame = spec['frame_samples']
+                margin = spec['preroll_frames']
+                fmt_plan = plans[loop_frame_samples(fmt)]
+                layout = spec['splice'] and plan_segments(fmt_plan, target_samples, fade_samples, frame, margin)
+                if not layout and spec['chunk'] and chunks > 1:
+                    chunked_outputs.setdefault(loop_frame_samples(fmt), []).append((path, fmt, fmt_quality))
+                    continue
+                if not layout:
+                    # Short targets and FLAC: one encode straight into the container
+                    windows, encodes = passes.setdefault(loop_frame_samples(fmt), ([], []))
+                    windows.append((0, target_samples, fade))
+                    encodes.append((path, encoder_args(fmt, fmt_quality)))
+                    continue
+
+                # Each piece is encoded with pre/post-roll and trimmed back to
+                # its frames on the global grid, so the joins are gapless
+                head_frames = layout['head_frames']
+                body_frames = layout['body_frames']
+                tail_frame = layout['tail_frame']
+                windows, encodes = passes.setdefault(loop_frame_samples(fmt), ([], []))
+                windows += [
+                    (0, (head_frames + margin) * frame, None),
+                    ((head_frames - margin) * frame, (head_frames + body_frames + margin) * frame, None),
+                    ((tail_frame - margin) * frame, target_samples, fade),
+                ]
+                raw_paths = [os.path.join(work_dir, f"{index}_{name}.raw") for name in ("head", "body", "tail")]
+                encodes += [(raw_path, encoder_args(fmt, fmt_quality, piece=True)) for raw_path in raw_paths]
+                spliced_outputs.append((index, fmt, fmt_quality, layout, raw_paths))
+
+            if progress_callback:
+                formats = ", ".join(fmt.upper() for _, fmt, _ in outputs)
+                progress_callback(40, f"⚡ Encoding {formats} ({loops:.1f} crossfaded loops)...")
+            resumed = 0
+            with stage("encode", passes=len(passes), chunks=chunks if chunked_outputs else 1) as record:
+                if passes:
+                    encode_loop_passes(
+                        source_wav, [(plans[frame], windows, encodes) for frame, (windows, encodes) in passes.items()], encode_workers,
+                        stage_progress(progress_callback, 40, 50 if chunked_outputs else 75, "⚡ Encoding"), cancel_event
+                    )
+                steps = len(chunked_outputs)
+                for step, (frame, group) in enumerate(chunked_outputs.items()):
+                    resumed += encode_chunked(
+                        partial(encode_loop_windows, source_wav, plans[frame]), group, target_samples, sample_rate,
+                        fade, chunks, work_dir, encode_workers,
+                        stage_progress(
+                            progress_callback, 50 + 25 * step // steps, 50 + 25 * (step + 1) // steps, f"⚡ Encoding {chunks} ranges"
+                        ),
+                        cancel_event,
+                        timeline=("extend", source['sha256'], plans[frame])
+                    )
+                if chunked_outputs:
+                    record["resumed"] = resumed
+
+            if progress_callback and spliced_outputs:
+                progress_callback(75, "📦 Stream-copying loop units...")
+
+            descriptions = []
+            with stage("assemble") as record:
+                for index, fmt, fmt_quality, layout, raw_paths in spliced_outputs:
+                    path = outputs[index][0]
+                    spec = OUTPUT_FORMATS[fmt]
+                    margin = spec['preroll_frames']
+                    frame_bytes = None
+                    if spec['splice'] == "pcm":
+                        sample_bytes = 3 if fmt_quality == "24-bit" else 2
+                        frame_bytes = source['channels'] * sample_bytes
+
+                    head_path, body_path, tail_path = (os.path.join(work_dir, f"{index}_{name}.seg") for name in ("head", "body", "tail"))
+                    copy_frames(raw_paths[0], head_path, spec['splice'], 0, layout['head_frames'], frame_bytes)
+                    copy_frames(raw_paths[1], body_path, spec['splice'], margin, layout['body_frames'], frame_bytes)
+                    copy_frames(raw_paths[2], tail_path, spec['splice'], margin, None, frame_bytes)
+                    pieces = [(head_path, 1), (body_path, layout['repeats']), (tail_path, 1)]
+
+                    if spec['splice'] == "mp3":
+                        # Whole MP3 frames on one grid: joining is a plain frame copy
+                        mp3_path = os.path.join(work_dir, f"{index}_joined.mp3")
+                        concat_segments(pieces, mp3_path)
+                        remux_mp3_gapless(
+                            mp3_path, path, target_samples, sample_rate,
+                            stage_progress(progress_callback, 75, 90, "📦 Writing MP3 header"), cancel_event
+                        )
+                    elif spec['splice'] == "pcm":
+                        data_bytes = sum(os.path.getsize(p) * n for p, n in pieces)
+                        with open(path, 'wb') as out:
+                            write_wav_header(out, data_bytes, sample_rate, source['channels'], sample_bytes)
+                            write_segments(pieces, out)
+                    else:
+                        # ADTS frames join like MP3 frames; only the container needs FFmpeg
+                        adts_path = os.path.join(work_dir, f"{index}_joined.aac")
+                        concat_segments(pieces, adts_path)
+                        remux_adts_to_m4a(
+                            adts_path, path, target_samples, sample_rate,
+                            stage_progress(progress_callback, 75, 90, "📦 Remuxing M4A"), cancel_event
+                        )
+                    descriptions.append(f"{fmt.upper()} segment copy ({layout['repeats']} loop units)")
+                record["bytes_out"] = sum(os.path.getsize(outputs[index][0]) for index, *_ in spliced_outputs)
+
+            copied = {index for index, *_ in spliced_outputs}
+            parallel = {path for group in chunked_outputs.values() for path, _, _ in group}
+            resumed_note = f", {resumed} resumed" if resumed else ""
+            descriptions += [
+                f"{fmt.upper()} parallel encode ({chunks} ranges{resumed_note})" if path in parallel else f"{fmt.upper()} direct encode"
+                for index, (path, fmt, _) in enumerate(outputs) if index not in copied
+            ]
+
+            if progress_callback:
+                progress_callback(90, "✅ Finalizing...")
+
+            gain_note = f", normalized {plan['gain_db']:+.1f} dB" if normalize else ""
+            return True, (
+                f"Success! {', '.join(descriptions)}, crossfade d={plan['crossfade_samples'] / sample_rate:.2f}s"
+                f"{gain_note}{loop_points_note(plan)}"
+            )
+
+    except FFmpegCancelled:
+        return False, "Processing cancelled"
+    except FFmpegStalled as e:
+        return False, f"Processing stalled: {str(e)}"
+    except Exception as e:
+        return False, f"Processing error: {str(e)}"
+
+def batch_worker_count(num_jobs):
+    """One extend job per CPU core, never more workers than jobs"""
+    return max(1, min(num_jobs, os.cpu_count() or 1))
+
+def process_batch_ffmpeg(jobs, target_minutes, crossfade_duration, method="basic_crossfade", progress_callback=None, cancel_event=None, max_workers=None, output_format="mp3", quality=None, normalize=False, scheduler=None):
+    """Run extend jobs for many files concurrently on a bounded worker pool.
+
+    ``jobs`` is a list of (input_path, output_path) pairs, optionally with the
+    input's sha256 as a third item. Each job's work runs
+    in its own FFmpeg child processes, so a pool of N threads keeps N encoders
+    busy on N cores. ``progress_callback(index, percent, message)`` is called
+    from the worker threads. With a JobScheduler, every job also waits for
+    a batch-priority slot of it before starting. Returns (success, message)
+    per job, in order.
+    """
+    def run_job(index, input_path, output_path, source_hash=None):
+        if cancel_event is not None and cancel_event.is_set():
+            return False, "Processing cancelled"
+        on_progress = on_wait = None
+        if progress_callback:
+            def on_progress(percent, message):
+                progress_callback(index, percent, message)
+
+            def on_wait(position, eta):
+                progress_callback(index, 0, f"⏳ Queued #{position}, starts in ~{format_duration(eta)}")
+
+        def render():
+            return process_audio_ffmpeg(
+                input_path, output_path, target_minutes, crossfade_duration,
+                method, on_progress, cancel_event, source_hash, output_format, quality,
+                normalize=normalize, encode_workers=encode_workers
+            )
+
+        if scheduler is None:
+            return render()
+        try:
+            with scheduler.slot("extend", target_minutes * 60, priority=PRIORITY_BATCH, cancel_event=cancel_event, on_wait=on_wait):
+                return render()
+        except JobRejected as e:
+            return False, str(e)
+        except FFmpegCancelled:
+            return False, "Processing cancelled"
+
+    workers = max_workers or batch_worker_count(len(jobs))
+    # Jobs already run side by side; each only splits its encode over the cores left
+    encode_workers = max(1, ENCODE_WORKERS // workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extend") as executor:
+        futures = [executor.submit(run_job, i, *job) for i, job in enumerate(jobs)]
+        return [future.result() for future in futures]
+
+@traced("preview")
+@cache_lease()
+def render_seam_preview(input_path, seam_path, ending_path, target_minutes, crossfade_duration, method="basic_crossfade", source_hash=None, output_format="mp3", normalize=False, cancel_event=None):
+    """Render the first loop seam and the fade-out ending of an extend job as two short MP3s.
+
+    The loop plan, seam graph, gain and fade-out are the ones
+    process_audio_ffmpeg uses for ``output_format``, but only
+    PREVIEW_CONTEXT_SECONDS either side of the seam and before the fade-out
+    are read and encoded (see encode_loop_excerpts). Once the source is in
+    the PCM cache this takes a fraction of a second at any source length and
+    target duration.
+    Returns (success, message).
+    """
+    try:
+        source = ingest_source(input_path, source_hash, cancel_event=cancel_event)
+        plan = plan_extend(source, crossfade_duration, method, loop_frame_samples(output_format), normalize, cancel_event=cancel_event)
+        if not plan:
+            return False, "Audio is too short to loop with this crossfade"
+
+        sample_rate = source['sample_rate']
+        context = PREVIEW_CONTEXT_SECONDS * sample_rate
+        target_samples = int(round(target_minutes * 60 * sample_rate))
+        fade_samples = min(FADE_OUT_SECONDS * sample_rate, target_samples // 2)
+        seam = plan['intro_samples']
+        windows = [
+            (max(0, seam - context), seam + plan['crossfade_samples'] + context, None),
+            (max(0, target_samples - fade_samples - context), target_samples, (target_samples - fade_samples, fade_samples)),
+        ]
+        args = encoder_args("mp3", PREVIEW_QUALITY)
+        encode_loop_excerpts(source['path'], plan, windows, [(seam_path, args), (ending_path, args)], cancel_event=cancel_event)
+        return True, (
+            f"First seam at {format_duration(seam / sample_rate)}, crossfade d={plan['crossfade_samples'] / sample_rate:.2f}s"
+            f"{loop_points_note(plan)}"
+        )
+
+    except FFmpegCancelled:
+        return False, "Processing cancelled"
+    except Exception as e:
+        return False, f"Preview failed: {str(e)}"
@@ -0,0 +1,165 @@
+"""Process-wide admission control for render jobs.
+
+Every Streamlit session runs in the same process, so without coordination
+ten users clicking Process at once start ten sets of FFmpeg processes that
+all slow each other down. Renders instead take a slot from one shared
+JobScheduler: at most ``max_concurrent`` run at a time and the rest wait in
+a priority queue, FIFO within a priority. A job's cost is estimated from
+its output duration with a per-kind rate that is refined from the jobs
+that finished, which gives waiting users an estimated start time; a job
+whose estimate is over the budget is rejected before it queues.
+"""
+import bisect
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .ffmpeg import FFmpegCancelled
+from .metrics import record_stage
+
+MAX_CONCURRENT_JOBS = int(os.environ.get("AUDIO_MAX_CONCURRENT_JOBS", "0")) or os.cpu_count() or 1
+JOB_BUDGET_SECONDS = float(os.environ.get("AUDIO_JOB_BUDGET_SECONDS", str(30 * 60)))
+# Start-up cost of any render (probe, seam, FFmpeg launches)
+JOB_BASE_SECONDS = 5.0
+# Initial seconds of work per second of output and output format, until
+# finished jobs of the kind have been measured. Extend stream-copies its
+# loop unit for MP3/M4A, combine decodes and encodes every second.
+JOB_RATES = {"extend": 1 / 1000, "combine": 1 / 100, "combine_extend": 1 / 500}
+JOB_RATE_SMOOTHING = 0.3
+JOB_WAIT_POLL_SECONDS = 0.5
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+class JobRejected(Exception):
+    """Raised when a job's estimated cost is over the scheduler's budget"""
+
+class Ticket:
+    """A job's place in the scheduler, from queueing until it finishes"""
+
+    def __init__(self, seq, kind, priority, output_seconds, cost_seconds):
+        self.seq = seq
+        self.kind = kind
+        self.priority = priority
+        self.output_seconds = output_seconds
+        self.cost_seconds = cost_seconds
+        self.started = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class JobScheduler:
+    """Admit at most ``max_concurrent`` jobs at a time, in priority then arrival order"""
+
+    def __init__(self, max_concurrent=None, budget_seconds=None):
+        self.max_concurrent = max_concurrent or MAX_CONCURRENT_JOBS
+        self.budget_seconds = budget_seconds or JOB_BUDGET_SECONDS
+        self.rates = dict(JOB_RATES)
+        self.queue = []
+        self.running = set()
+        self._seq = itertools.count()
+        self._changed = threading.Condition()
+
+    def estimate(self, kind, output_seconds, outputs=1):
+        """Estimated wall seconds of a job rendering ``outputs`` formats of ``output_seconds``"""
+        with self._changed:
+            rate = self.rates.get(kind, max(JOB_RATES.values()))
+        return JOB_BASE_SECONDS + output_seconds * outputs * rate
+
+    @contextmanager
+    def slot(self, kind, output_seconds, outputs=1, priority=PRIORITY_INTERACTIVE, cancel_event=None, on_wait=None):
+        """Wait for a free slot, hold it for the ``with`` block and yield the Ticket.
+
+        Raises JobRejected at once if the estimated cost is over the budget,
+        and FFmpegCancelled if ``cancel_event`` is set while waiting.
+        ``on_wait(position, eta_seconds)`` is called from the waiting thread
+        every JOB_WAIT_POLL_SECONDS, outside the scheduler's lock.
+        """
+        cost = self.estimate(kind, output_seconds, outputs)
+        if cost > self.budget_seconds:
+            raise JobRejected(
+                f"Estimated processing time {cost / 60:.0f} min exceeds the {self.budget_seconds / 60:.0f} min "
+                f"limit per job; shorten the duration or render fewer formats"
+            )
+        ticket = Ticket(next(self._seq), kind, priority, output_seconds * outputs, cost)
+        queued = time.monotonic()
+        with self._changed:
+            bisect.insort(self.queue, ticket)
+        try:
+            while True:
+                with self._changed:
+                    if self.queue[0] is ticket and len(self.running) < self.max_concurrent:
+                        self.queue.pop(0)
+                        ticket.started = time.monotonic()
+                        self.running.add(ticket)
+                        # The next one in line may fit as well
+                        self._changed.notify_all()
+                        break
+                    position, eta = self._queue_position(ticket)
+                if cancel_event is not None and cancel_event.is_set():
+                    raise FFmpegCancelled("Processing cancelled")
+                if on_wait:
+                    on_wait(position, eta)
+                with self._changed:
+                    self._changed.wait(JOB_WAIT_POLL_SECONDS)
+        except BaseException:
+            # Cancelled, or the waiting session was interrupted by a rerun
+            with self._changed:
+                if ticket in self.queue:
+                    self.queue.remove(ticket)
+                    self._changed.notify_all()
+            raise
+        record_stage("queue", ticket.started - queued, estimate_seconds=round(cost, 1))
+
+        completed = False
+        try:
+            yield ticket
+            completed = True
+        finally:
+            with self._changed:
+                self.running.discard(ticket)
+                if completed and ticket.output_seconds >= 60:
+                    self._learn(ticket, time.monotonic() - ticket.started)
+                self._changed.notify_all()
+
+    def status(self):
+        """Running and queued job counts for display"""
+        with self._changed:
+            return {"running": len(self.running), "queued": len(self.queue), "max_concurrent": self.max_concurrent}
+
+    def _queue_position(self, ticket):
+        """1-based position of a queued ticket and seconds until it should start.
+
+        Replays the queue on the running jobs' estimated remaining times,
+        each queued job taking the slot that frees up first. Caller holds the lock.
+        """
+        now = time.monotonic()
+        free_at = sorted(max(0.0, t.cost_seconds - (now - t.started)) for t in self.running)
+        free_at += [0.0] * (self.max_concurrent - len(free_at))
+        heapq.heapify(free_at)
+        for position, queued in enumerate(self.queue, 1):
+            start = heapq.heappop(free_at)
+            if queued is ticket:
+                return position, start
+            heapq.heappush(free_at, start + queued.cost_seconds)
+        return len(self.queue), 0.0
+
+    def _learn(self, ticket, elapsed):
+        """Move the kind's rate towards what this job actually took. Caller holds the lock."""
+        measured = max(0.0, elapsed - JOB_BASE_SECONDS) / ticket.output_seconds
+        rate = self.rates.get(ticket.kind, measured)
+        self.rates[ticket.kind] = rate + JOB_RATE_SMOOTHING * (measured - rate)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """The JobScheduler shared by every session and thread in this process"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler()
+        return _scheduler
@@ -0,0 +1,80 @@
+"""Parameter validation and progress formatting"""
+
+def create_percentage_progress(current, total, message):
+    """Create percentage-based progress display"""
+    percentage = int((current / total) * 100) if total > 0 else 0
+    return f"{percentage}% - {message}"
+
+def format_duration(seconds):
+    """Format duration in seconds to readable format"""
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+def stage_progress(progress_callback, start, end, label):
+    """Map one FFmpeg step's live progress onto the [start, end] percent range"""
+    if not progress_callback:
+        return None
+
+    def on_progress(fraction, speed, eta):
+        details = f"{fraction:.0%}"
+        if speed:
+            details += f" · {speed:.1f}x"
+        if eta is not None:
+            details += f" · ETA {format_duration(eta)}"
+        progress_callback(int(start + (end - start) * fraction), f"{label} ({details})")
+
+    return on_progress
+
+def check_loops(target_duration_ms, original_duration_ms):
+    """Error message if looping ``original_duration_ms`` up to the target needs too many loops"""
+    if original_duration_ms <= 0:
+        return "Could not determine the audio's duration"
+    loops_needed = target_duration_ms / original_duration_ms
+    if loops_needed > 1000:
+        return f"Too many loops required ({loops_needed:.0f}x). Consider a shorter target duration."
+    return None
+
+def validate_parameters(mode: str, target_duration_ms: int, original_duration_ms: int, crossfade_duration: float, num_files: int) -> tuple[bool, str]:
+    """Validate processing parameters based on mode.
+
+    For combine_extend ``original_duration_ms`` is the combined length; pass
+    0 there while it is unknown to skip the loop check.
+    """
+
+    if crossfade_duration < 0:
+        return False, "Crossfade duration cannot be negative"
+
+    if mode == "extend":
+        if target_duration_ms <= 0:
+            return False, "Target duration must be greater than 0"
+        if target_duration_ms > 24 * 60 * 60 * 1000:  # 24 hours
+            return False, "Target duration cannot exceed 24 hours"
+        error = check_loops(target_duration_ms, original_duration_ms)
+        if error:
+            return False, error
+
+    elif mode == "batch_extend":
+        if num_files < 1:
+            return False, "Upload at least 1 file to extend"
+        if target_duration_ms <= 0:
+            return False, "Target duration must be greater than 0"
+        if target_duration_ms > 24 * 60 * 60 * 1000:  # 24 hours
+            return False, "Target duration cannot exceed 24 hours"
+
+    elif mode == "combine":
+        if num_files < 2:
+            return False, "Need at least 2 files to combine"
+
+    elif mode == "combine_extend":
+        if num_files < 2:
+            return False, "Need at least 2 files to combine and extend"
+        if target_duration_ms <= 0:
+            return False, "Target duration must be greater than 0"
+        if original_duration_ms:
+            error = check_loops(target_duration_ms, original_duration_ms)
+            if error:
+                return False, error
+
+    return True, "Parameters valid"
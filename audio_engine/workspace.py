@@ -0,0 +1,193 @@
+"""Per-job scratch directories with a disk quota and an orphan sweeper.
+
+Every render gets its own directory under the scratch root, on tmpfs when
+its estimated scratch use fits there. While the job runs, a monitor thread
+refreshes the directory's lease file and stops the job's FFmpeg steps if
+the directory grows past its quota. The directory is removed when the job
+ends, however it ends; directories left behind by a killed process stop
+having their lease refreshed and are removed by the sweeper.
+"""
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+
+from .ffmpeg import AnyEvent
+from .metrics import stage
+
+SCRATCH_DIR = os.environ.get("AUDIO_SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "audio_editor_scratch"))
+# Jobs whose estimated scratch use fits in half of the tmpfs free space run there
+SCRATCH_TMPFS_DIR = os.environ.get(
+    "AUDIO_SCRATCH_TMPFS_DIR", "/dev/shm/audio_editor_scratch" if os.path.isdir("/dev/shm") else ""
+)
+SCRATCH_TMPFS_FRACTION = 0.5
+SCRATCH_QUOTA_BYTES = int(os.environ.get("AUDIO_SCRATCH_QUOTA_BYTES", str(20 * 1024**3)))
+SCRATCH_MAX_BYTES = int(os.environ.get("AUDIO_SCRATCH_MAX_BYTES", str(50 * 1024**3)))
+# A workspace whose lease is older than this belongs to a dead process
+SCRATCH_LEASE_SECONDS = 60
+# Orphans are kept this long for inspection unless the scratch root is over SCRATCH_MAX_BYTES
+SCRATCH_ORPHAN_SECONDS = int(os.environ.get("AUDIO_SCRATCH_ORPHAN_SECONDS", str(15 * 60)))
+SCRATCH_MONITOR_SECONDS = 1.0
+SCRATCH_SWEEP_SECONDS = 60
+LEASE_FILE = ".lease"
+
+class ScratchQuotaExceeded(Exception):
+    """Raised when a job's scratch directory grows past its quota"""
+
+def directory_bytes(path):
+    """Total size of the files under ``path``"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+_tmpfs_reserved = 0
+_tmpfs_lock = threading.Lock()
+
+def _claim_tmpfs(estimate_bytes):
+    """Reserve ``estimate_bytes`` of tmpfs if it fits next to the jobs already there"""
+    global _tmpfs_reserved
+    if not SCRATCH_TMPFS_DIR or estimate_bytes is None:
+        return False
+    try:
+        os.makedirs(SCRATCH_TMPFS_DIR, exist_ok=True)
+        free = shutil.disk_usage(SCRATCH_TMPFS_DIR).free
+    except OSError:
+        return False
+    with _tmpfs_lock:
+        if _tmpfs_reserved + estimate_bytes > free * SCRATCH_TMPFS_FRACTION:
+            return False
+        _tmpfs_reserved += estimate_bytes
+        return True
+
+def _release_tmpfs(estimate_bytes):
+    global _tmpfs_reserved
+    with _tmpfs_lock:
+        _tmpfs_reserved -= estimate_bytes
+
+class Workspace:
+    """Scratch directory of one job, used as a context manager.
+
+    ``estimate_bytes`` is the job's expected peak scratch use and decides
+    between tmpfs and disk; ``quota_bytes`` caps it. Pass ``guard(cancel_event)``
+    to the job's FFmpeg steps so they are stopped when the quota is hit;
+    leaving the block then raises ScratchQuotaExceeded.
+    """
+
+    def __init__(self, kind, estimate_bytes=None, quota_bytes=None):
+        self.kind = kind
+        self.estimate_bytes = estimate_bytes
+        self.quota_bytes = quota_bytes or SCRATCH_QUOTA_BYTES
+        self.exceeded = threading.Event()
+        self.path = None
+        self.on_tmpfs = False
+        self._done = threading.Event()
+
+    def __enter__(self):
+        start_sweeper()
+        self.on_tmpfs = _claim_tmpfs(self.estimate_bytes)
+        root = SCRATCH_TMPFS_DIR if self.on_tmpfs else SCRATCH_DIR
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, f"{self.kind}-{os.getpid()}-{secrets.token_hex(6)}")
+        os.makedirs(self.path)
+        self._touch_lease()
+        self._monitor = threading.Thread(target=self._watch, name=f"workspace-{self.kind}", daemon=True)
+        self._monitor.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._done.set()
+        self._monitor.join()
+        with stage("cleanup", bytes=directory_bytes(self.path)):
+            shutil.rmtree(self.path, ignore_errors=True)
+        if self.on_tmpfs:
+            _release_tmpfs(self.estimate_bytes)
+        # A job that hit the quota fails on whatever its stopped step raised
+        if exc_type is not None and self.exceeded.is_set():
+            raise ScratchQuotaExceeded(
+                f"Scratch space for this job exceeded its {self.quota_bytes / 1024**2:,.0f} MB quota"
+            ) from exc
+        return False
+
+    def guard(self, cancel_event=None):
+        """A cancel_event that is also set when this workspace goes over its quota"""
+        return AnyEvent(cancel_event, self.exceeded)
+
+    def _touch_lease(self):
+        with open(os.path.join(self.path, LEASE_FILE), 'w') as f:
+            f.write(str(os.getpid()))
+
+    def _watch(self):
+        last_lease = time.time()
+        while not self._done.wait(SCRATCH_MONITOR_SECONDS):
+            if directory_bytes(self.path) > self.quota_bytes:
+                self.exceeded.set()
+            if time.time() - last_lease > SCRATCH_LEASE_SECONDS / 4:
+                try:
+                    self._touch_lease()
+                except OSError:
+                    pass
+                last_lease = time.time()
+
+def sweep_scratch(now=None):
+    """Remove orphaned workspaces under every scratch root.
+
+    A workspace is orphaned once its lease has not been refreshed for
+    SCRATCH_LEASE_SECONDS (or it has none). Orphans older than
+    SCRATCH_ORPHAN_SECONDS are removed; younger ones go too, oldest first,
+    while all workspaces together exceed SCRATCH_MAX_BYTES. Returns the
+    number of workspaces removed.
+    """
+    now = now or time.time()
+    workspaces = []
+    for root in {SCRATCH_DIR, SCRATCH_TMPFS_DIR} - {""}:
+        try:
+            entries = list(os.scandir(root))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                touched = os.stat(os.path.join(entry.path, LEASE_FILE)).st_mtime
+            except FileNotFoundError:
+                touched = entry.stat(follow_symlinks=False).st_mtime
+            workspaces.append((touched, entry.path, directory_bytes(entry.path)))
+
+    total = sum(size for _, _, size in workspaces)
+    removed = 0
+    for touched, path, size in sorted(workspaces):
+        if now - touched < SCRATCH_LEASE_SECONDS:
+            continue
+        if now - touched > SCRATCH_ORPHAN_SECONDS or total > SCRATCH_MAX_BYTES:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+    return removed
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+def start_sweeper():
+    """Start the background sweeper once per process"""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is not None:
+            return
+
+        def sweep_forever():
+            while True:
+                try:
+                    sweep_scratch()
+                except OSError:
+                    pass
+                time.sleep(SCRATCH_SWEEP_SECONDS)
+
+        _sweeper = threading.Thread(target=sweep_forever, name="scratch-sweeper", daemon=True)
+        _sweeper.start()
@@ -0,0 +1,272 @@
+"""Benchmark the render pipeline across source lengths, target durations,
+methods and output formats.
+
+Sources are generated offline with FFmpeg's lavfi sources. Every case runs
+in a fresh worker process with an empty PCM cache, so wall time and peak
+RSS (the worker plus its FFmpeg children) are measured cold and per case.
+
+    python benchmark.py --suite quick
+    python benchmark.py --suite full --output bench.json --save-baseline
+    python benchmark.py --reruns 50
+
+``--reruns`` instead times Streamlit reruns of app.py (a crossfade slider
+drag each), on the empty page and with a source uploaded, and fails when
+either median is over the rerun budget.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.environ.get("AUDIO_BENCH_DIR", os.path.join(tempfile.gettempdir(), "audio_editor_bench"))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# A case regresses when it is this much slower than the baseline and the
+# difference is above the noise floor
+REGRESSION_TOLERANCE = 0.25
+REGRESSION_MIN_SECONDS = 0.5
+
+# name: (lavfi source graph, seconds, container)
+SOURCES = {
+    "sine_30s_mp3": ("sine=frequency=440:sample_rate=44100", 30, "mp3"),
+    "noise_30s_wav": ("anoisesrc=color=pink:sample_rate=44100:amplitude=0.3", 30, "wav"),
+    "sine_3m_flac": ("sine=frequency=220:sample_rate=48000", 180, "flac"),
+    "noise_10m_mp3": ("anoisesrc=color=brown:sample_rate=44100:amplitude=0.3", 600, "mp3"),
+}
+
+SUITES = {
+    # Loop counts from below one repeat (direct encode) up to thousands
+    "quick": (
+        [("sine_30s_mp3", minutes, "basic_crossfade", "mp3") for minutes in (1, 10, 120)]
+        + [("sine_30s_mp3", 120, method, "mp3") for method in ("smooth_curves", "eq_matched", "phase_aligned", "dynamic_normalized")]
+        + [("noise_30s_wav", 120, "basic_crossfade", fmt) for fmt in ("wav", "m4a", "flac")]
+    ),
+    "full": (
+        [(source, minutes, "basic_crossfade", "mp3") for source in SOURCES for minutes in (1, 10, 120, 480, 1440)]
+        + [(source, 1440, method, "mp3") for source in ("sine_30s_mp3", "noise_10m_mp3")
+           for method in ("smooth_curves", "eq_matched", "phase_aligned", "dynamic_normalized")]
+        + [(source, minutes, "basic_crossfade", fmt) for source in ("noise_30s_wav", "sine_3m_flac")
+           for minutes in (120, 1440) for fmt in ("wav", "m4a", "flac")]
+    ),
+}
+
+def generate_source(name):
+    """Render a synthetic source once and reuse it across runs"""
+    graph, seconds, container = SOURCES[name]
+    path = os.path.join(BENCH_DIR, "sources", f"{name}.{container}")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{container}"
+        subprocess.run(
+            ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f"{graph}:duration={seconds}",
+             '-ac', '2', '-y', tmp_path],
+            check=True
+        )
+        os.replace(tmp_path, path)
+    return path
+
+def case_id(source, minutes, method, output_format):
+    return f"{source}/{minutes}m/{method}/{output_format}"
+
+def run_case(case):
+    """Worker side: render one case against a cold PCM cache and report measurements"""
+    import audio_engine
+    from audio_engine.metrics import job_trace
+
+    output_path = os.path.join(case["work_dir"], f"out.{case['format']}")
+    started = time.perf_counter()
+    # The render joins this trace, so its FFmpeg runs can be read back here
+    with job_trace("extend") as trace:
+        success, message = audio_engine.process_audio_ffmpeg(
+            case["input"], output_path, case["minutes"], case["crossfade"], case["method"],
+            output_format=case["format"]
+        )
+    wall = time.perf_counter() - started
+    # FFmpeg's own speed= of the longest run in the encode stage; the
+    # stream-copy join that follows can take longer but encodes nothing
+    runs = [record for record in trace.stages if record["stage"] == "ffmpeg" and record.get("parent") == "encode"]
+    encode = max(runs, key=lambda record: record["seconds"], default={})
+    peak_rss_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {
+        "ok": success,
+        "message": message,
+        "wall_seconds": round(wall, 3),
+        # Seconds of output audio per second of the whole job's wall time; not
+        # FFmpeg's speed=, which only covers one FFmpeg run
+        "output_realtime_factor": round(case["minutes"] * 60 / wall, 1) if wall > 0 else None,
+        "ffmpeg_speed": encode.get("ffmpeg_speed"),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "output_bytes": os.path.getsize(output_path) if success else None,
+    }
+
+def run_in_worker(case):
+    """Run a case in a fresh interpreter so caches and peak RSS start from zero"""
+    with tempfile.TemporaryDirectory(prefix="bench_", dir=BENCH_DIR) as work_dir:
+        env = dict(os.environ, AUDIO_PCM_CACHE_DIR=os.path.join(work_dir, "pcm"))
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", json.dumps(dict(case, work_dir=work_dir))],
+            capture_output=True, text=True, env=env
+        )
+    if result.returncode != 0:
+        return {"ok": False, "message": result.stderr.strip()[-300:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def ffmpeg_version():
+    try:
+        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+        return result.stdout.split('\n')[0]
+    except FileNotFoundError:
+        return None
+
+def run_suite(suite, crossfade, repeat):
+    """Run every case of a suite, keeping the fastest of ``repeat`` runs"""
+    results = []
+    cases = SUITES[suite]
+    for index, (source, minutes, method, output_format) in enumerate(cases, 1):
+        name = case_id(source, minutes, method, output_format)
+        source_seconds = SOURCES[source][1]
+        case = {
+            "input": generate_source(source), "minutes": minutes, "crossfade": crossfade,
+            "method": method, "format": output_format,
+        }
+        runs = [run_in_worker(case) for _ in range(repeat)]
+        ok_runs = [run for run in runs if run.get("ok")]
+        best = min(ok_runs, key=lambda run: run["wall_seconds"]) if ok_runs else runs[-1]
+        results.append(dict(
+            best, case=name, source=source, target_minutes=minutes, method=method, format=output_format,
+            loops=round(minutes * 60 / (source_seconds - crossfade), 1),
+        ))
+        status = f"{best['wall_seconds']:8.2f}s {best['output_realtime_factor']:>9}x realtime (ffmpeg {best['ffmpeg_speed']}x) {best['peak_rss_mb']:7.1f} MB" if best.get("ok") else f"FAILED: {best['message']}"
+        print(f"[{index}/{len(cases)}] {name:<48} {status}", flush=True)
+    return results
+
+# Source uploaded for the rerun timings with a file loaded
+RERUN_SOURCE = "sine_3m_flac"
+
+def measure_reruns(count):
+    """Seconds of app reruns, each triggered by moving the crossfade slider, per scenario.
+
+    "welcome" is the page without uploads; "upload" has a source in the
+    uploader, so every rerun also validates it and starts the seam preview
+    for the new crossfade.
+    """
+    from streamlit.testing.v1 import AppTest
+    from audio_engine import prometheus_text
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    source = generate_source(RERUN_SOURCE)
+    with open(source, 'rb') as f:
+        upload = (os.path.basename(source), f.read(), "audio/flac")
+
+    def script_seconds():
+        # The app times each run of its script, without AppTest's own overhead
+        for line in prometheus_text().splitlines():
+            if line.startswith("audio_rerun_duration_seconds_sum "):
+                return float(line.split()[1])
+        return 0.0
+
+    timings = {}
+    for scenario in ("welcome", "upload"):
+        app = AppTest.from_file(app_path, default_timeout=60)
+        # The first run imports the engine and probes FFmpeg; the upload's first run submits its ingest
+        app.run()
+        if scenario == "upload":
+            app.file_uploader[0].set_value(upload)
+            app.run()
+        timings[scenario] = []
+        for n in range(count):
+            app.slider[0].set_value(1.0 + n % 50 / 10)
+            started = script_seconds()
+            app.run()
+            timings[scenario].append(script_seconds() - started)
+            if app.exception:
+                raise RuntimeError(app.exception[0].message)
+    return timings
+
+def compare(results, baseline):
+    """Cases that got slower than the baseline beyond tolerance"""
+    previous = {result["case"]: result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get(result["case"])
+        if not before or not before.get("ok"):
+            continue
+        if not result.get("ok"):
+            regressions.append((result["case"], before["wall_seconds"], None))
+            continue
+        slower = result["wall_seconds"] - before["wall_seconds"]
+        if slower > REGRESSION_MIN_SECONDS and result["wall_seconds"] > before["wall_seconds"] * (1 + REGRESSION_TOLERANCE):
+            regressions.append((result["case"], before["wall_seconds"], result["wall_seconds"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the audio render pipeline")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--crossfade", type=float, default=3.0, help="Crossfade seconds for every case")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case; the fastest is kept")
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--reruns", type=int, help="Time this many UI reruns against the rerun budget instead")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_case(json.loads(args.worker))))
+        return 0
+
+    if args.reruns:
+        from audio_engine.metrics import RERUN_BUDGET_SECONDS
+
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        status = 0
+        for scenario, timings in measure_reruns(args.reruns).items():
+            timings.sort()
+            median = timings[len(timings) // 2]
+            print(f"{scenario}: {len(timings)} reruns, median {median * 1000:.1f} ms, max {timings[-1] * 1000:.1f} ms "
+                  f"(budget {RERUN_BUDGET_SECONDS * 1000:.0f} ms)")
+            if median > RERUN_BUDGET_SECONDS:
+                status = 1
+        return status
+
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    report = {
+        "suite": args.suite,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(), "python": platform.python_version(),
+            "cpus": os.cpu_count(), "ffmpeg": ffmpeg_version(),
+        },
+        "results": run_suite(args.suite, args.crossfade, args.repeat),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report["results"], json.load(f))
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.2f}s -> {'failed' if after is None else f'{after:.2f}s'}")
+        if regressions:
+            status = 1
+        else:
+            print(f"No regressions against {args.baseline}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
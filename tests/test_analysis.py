@@ -0,0 +1,19 @@
+import numpy as np
+
+from audio_engine.analysis import analyze_loop_points
+
+def tone(seconds, sample_rate=44100, freq=220.0):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    mono = (np.sin(2 * np.pi * freq * t) * 8000).astype(np.int16)
+    return np.stack([mono, mono], axis=1)
+
+def test_long_crossfade_still_searches_for_loop_points():
+    # 10 s is the longest crossfade the UI offers, beyond the default search span
+    points = analyze_loop_points(tone(90), 44100, 10.0, 1152)
+    assert points["score"] is not None
+    assert 0 <= points["loop_start"] < points["loop_end"] - 10 * 44100
+    assert points["loop_end"] <= 90 * 44100
+
+def test_too_short_source_falls_back_to_whole_file():
+    points = analyze_loop_points(tone(40), 44100, 10.0, 1152)
+    assert points == {"loop_start": 0, "loop_end": 40 * 44100, "score": None}
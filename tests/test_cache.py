@@ -0,0 +1,39 @@
+import os
+import threading
+
+from audio_engine.cache import DiskCache, cache_lease
+
+def commit_bytes(cache, key, ext, size):
+    tmp_path = cache.reserve(key, ext)
+    with open(tmp_path, 'wb') as f:
+        f.write(bytes(size))
+    return cache.commit(key, ext, tmp_path)
+
+def test_commit_keeps_entries_a_running_job_uses(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000)
+    with cache_lease():
+        # A combined playlist bigger than the whole budget, then the job's loudness JSON
+        wav = commit_bytes(cache, "combined", "wav", 5000)
+        commit_bytes(cache, "loudness", "json", 10)
+        assert os.path.exists(wav)
+
+        # Another session's commit (outside this job's lease) does not evict it either
+        other = threading.Thread(target=commit_bytes, args=(cache, "other", "json", 10))
+        other.start()
+        other.join()
+        assert os.path.exists(wav)
+
+    commit_bytes(cache, "later", "json", 10)
+    assert not os.path.exists(wav)
+
+def test_lookup_pins_entry_and_release_unpins_it(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000)
+    track = commit_bytes(cache, "track", "wav", 800)
+    with cache_lease():
+        assert cache.get("track", "wav") == track
+        commit_bytes(cache, "next", "wav", 800)
+        assert os.path.exists(track)
+
+        cache.release(track)
+        commit_bytes(cache, "after", "json", 10)
+        assert not os.path.exists(track)
@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from audio_engine import chunks
+from audio_engine.chunks import lock_checkpoint, plan_chunks, sweep_checkpoints
+
+def make_checkpoint(root, name, size, age):
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "0_0.raw"), 'wb') as f:
+        f.write(bytes(size))
+    manifest = os.path.join(path, chunks.MANIFEST_FILE)
+    with open(manifest, 'w') as f:
+        json.dump({}, f)
+    touched = time.time() - age
+    os.utime(manifest, (touched, touched))
+    return path
+
+def test_plan_chunks_puts_inner_bounds_on_the_grid():
+    ranges = plan_chunks(10_000, 1152, 3)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 10_000
+    assert all(start % 1152 == 0 for start, _ in ranges)
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+
+def test_lock_excludes_other_holders_until_released(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunks, "CHECKPOINT_DIR", str(tmp_path))
+    path = str(tmp_path / "key")
+    lock = lock_checkpoint(path)
+    assert lock is not None
+    assert lock_checkpoint(path) is None
+
+    # Another process (the CLI next to the web app) sees the same lock
+    probe = "import sys; from audio_engine import chunks; print(chunks.lock_checkpoint(sys.argv[1]) is None)"
+    held = subprocess.run([sys.executable, "-c", probe, path], capture_output=True, text=True, cwd=os.getcwd())
+    assert held.stdout.strip() == "True"
+
+    lock.close()
+    relocked = lock_checkpoint(path)
+    assert relocked is not None
+    relocked.close()
+
+def test_sweep_bounds_total_size_and_skips_held_checkpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunks, "CHECKPOINT_DIR", str(tmp_path))
+    monkeypatch.setattr(chunks, "CHECKPOINT_MAX_BYTES", 2500)
+    held = make_checkpoint(str(tmp_path), "held", 1000, age=300)
+    oldest_free = make_checkpoint(str(tmp_path), "old", 1000, age=200)
+    newer = make_checkpoint(str(tmp_path), "new", 1000, age=100)
+    lock = lock_checkpoint(held)
+
+    sweep_checkpoints()
+
+    assert os.path.exists(held)
+    assert not os.path.exists(oldest_free) and not os.path.exists(f"{oldest_free}.lock")
+    assert os.path.exists(newer)
+    lock.close()
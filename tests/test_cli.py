@@ -0,0 +1,32 @@
+import json
+import os
+
+import pytest
+
+from audio_engine.cli import ManifestError, load_manifest
+
+def write_manifest(tmp_path, data):
+    path = tmp_path / "jobs.json"
+    path.write_text(json.dumps(data))
+    return str(path)
+
+def test_job_overrides_manifest_defaults(tmp_path):
+    path = write_manifest(tmp_path, {
+        "defaults": {"crossfade": 5, "format": "flac", "normalize": True},
+        "jobs": [
+            {"input": "a.wav", "output": "out/a.mp3", "target_minutes": 60},
+            {"input": "b.wav", "output": "out/b.wav", "target_minutes": 30, "crossfade": 2, "format": "wav"},
+        ],
+    })
+    first, second = load_manifest(path)
+
+    assert first["crossfade"] == 5.0 and first["format"] == "flac" and first["normalize"]
+    assert second["crossfade"] == 2.0 and second["format"] == "wav" and second["normalize"]
+    # Built-in defaults still fill what neither the manifest nor the job sets
+    assert second["method"] == "basic_crossfade"
+    assert second["inputs"] == [os.path.join(str(tmp_path), "b.wav")]
+
+def test_missing_field_names_the_job(tmp_path):
+    path = write_manifest(tmp_path, [{"input": "a.wav", "output": "a.mp3", "target_minutes": 60}, {"input": "b.wav", "target_minutes": 60}])
+    with pytest.raises(ManifestError, match="job 2: missing output"):
+        load_manifest(path)
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from audio_engine.formats import (
+    _crc16_zeros, _gf2_mulmod16, copy_frames, flac_crc8, flac_crc16, flac_frame_header, flac_utf8, get_wav_info,
+    lame_crc16, write_wav_header,
+)
+
+def mp3_frame(index, padding):
+    # MPEG-1 Layer III, 128 kbps, 44.1 kHz: 417 bytes, 418 with the padding bit
+    header = bytes([0xFF, 0xFB, 0x90 | padding << 1, 0x00])
+    return header + bytes([index]) * (417 + padding - 4)
+
+def test_copy_frames_cuts_mp3_on_frame_headers(tmp_path):
+    frames = [mp3_frame(index, index % 2) for index in range(5)]
+    src = tmp_path / "piece.mp3"
+    src.write_bytes(b"".join(frames))
+
+    copy_frames(str(src), str(tmp_path / "body.mp3"), "mp3", 1, 3)
+    assert (tmp_path / "body.mp3").read_bytes() == b"".join(frames[1:4])
+    copy_frames(str(src), str(tmp_path / "tail.mp3"), "mp3", 3)
+    assert (tmp_path / "tail.mp3").read_bytes() == b"".join(frames[3:])
+    with pytest.raises(RuntimeError, match="too short"):
+        copy_frames(str(src), str(tmp_path / "long.mp3"), "mp3", 2, 4)
+
+def flac_header(number):
+    # Fixed 4608-sample blocks at 44.1 kHz, stereo, 16-bit
+    header = bytearray(b"\xff\xf8\x59\x18" + flac_utf8(number))
+    header.append(flac_crc8(header))
+    return bytes(header)
+
+def test_renumbered_flac_header_crc_is_patched_without_rereading_the_body():
+    for number in (0, 127, 128, 5000, 2 ** 20):
+        header = flac_header(number)
+        assert flac_frame_header(header, 0) == (len(header), number, len(header) - 5)
+
+    body = os.urandom(3000)
+    old_header, new_header = flac_header(0), flac_header(5000)
+    delta = flac_crc16(old_header) ^ flac_crc16(new_header)
+    patched = flac_crc16(old_header + body) ^ _gf2_mulmod16(delta, _crc16_zeros(len(body)))
+    assert patched == flac_crc16(new_header + body)
+
+@pytest.mark.parametrize("data_bytes, riff", [(4 * 44100, b"RIFF"), (5 * 2 ** 30, b"RF64")])
+def test_wav_header_switches_to_rf64_past_4_gib(tmp_path, data_bytes, riff):
+    path = tmp_path / "out.wav"
+    with open(path, "wb") as out:
+        write_wav_header(out, data_bytes, 44100, 2, 2)
+    assert path.read_bytes()[:4] == riff
+    assert get_wav_info(str(path)) == {
+        "sample_rate": 44100, "channels": 2, "frames": data_bytes // 4, "data_offset": os.path.getsize(path),
+    }
+
+def test_lame_tag_crc_is_crc16_arc():
+    assert lame_crc16(b"123456789") == 0xBB3D
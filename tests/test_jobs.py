@@ -0,0 +1,48 @@
+import threading
+
+from audio_engine import jobs
+from audio_engine.jobs import JobManager
+
+def test_finished_is_set_before_job_reports_done(monkeypatch):
+    finished_when_done = []
+
+    class RecordingJob(jobs.Job):
+        def __setattr__(self, name, value):
+            if name == "state" and value in ("done", "failed", "cancelled"):
+                finished_when_done.append(self.finished)
+            super().__setattr__(name, value)
+
+    monkeypatch.setattr(jobs, "Job", RecordingJob)
+    manager = JobManager(max_threads=1)
+    job = manager.submit(lambda job: "result")
+    manager.submit(lambda job: 1 / 0)
+    manager.executor.shutdown(wait=True)
+
+    assert job.result == "result"
+    assert len(finished_when_done) == 2 and None not in finished_when_done
+
+def test_failed_and_cancelled_jobs():
+    manager = JobManager(max_threads=2)
+
+    def fail(job):
+        raise RuntimeError("boom")
+
+    def cancelled(job):
+        job.cancel()
+        raise RuntimeError("stopped")
+
+    failed = manager.submit(fail)
+    stopped = manager.submit(cancelled)
+    manager.executor.shutdown(wait=True)
+
+    assert failed.state == "failed" and failed.error == "boom" and failed.finished is not None
+    assert stopped.state == "cancelled"
+
+def test_same_key_returns_running_job():
+    manager = JobManager(max_threads=1)
+    release = threading.Event()
+    first = manager.submit(lambda job: release.wait(), key="render")
+    assert manager.submit(lambda job: None, key="render") is first
+    release.set()
+    manager.executor.shutdown(wait=True)
+    assert manager.get(first.id) is first
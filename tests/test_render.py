@@ -0,0 +1,18 @@
+from audio_engine.render import plan_segments
+
+def test_segments_keep_encoder_context_inside_the_loop():
+    # 10 s intro, 30 s loop unit at 44.1 kHz, MP3 frames with two frames of context
+    plan = {"intro_samples": 441000, "loop_samples": 1323000 // 1152 * 1152}
+    target, fade, frame, margin = 3600 * 44100, 3 * 44100, 1152, 2
+    layout = plan_segments(plan, target, fade, frame, margin)
+
+    assert layout["body_frames"] * frame == plan["loop_samples"]
+    # The first body frame's pre-roll starts after the intro
+    assert (layout["head_frames"] - margin) * frame >= plan["intro_samples"]
+    # The last copy's post-roll ends before the fade-out
+    assert (layout["tail_frame"] + margin) * frame <= target - fade
+    assert layout["tail_frame"] == layout["head_frames"] + layout["repeats"] * layout["body_frames"]
+
+def test_target_without_room_for_one_loop_unit_is_not_spliced():
+    plan = {"intro_samples": 441000, "loop_samples": 1323000 // 1152 * 1152}
+    assert plan_segments(plan, 40 * 44100, 3 * 44100, 1152, 2) is None